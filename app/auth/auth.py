@@ -26,7 +26,7 @@ ACCESS_TOKEN_EXPIRE_MINUTES = 30
 async def set_credentials(
     username: str,
     password: str,
-    postgres_client: asyncpg.Connection,
+    postgres_client: asyncpg.Pool | asyncpg.Connection,
     token: Optional[str] = None,
 ) -> bool:
     """
@@ -40,7 +40,7 @@ async def set_credentials(
     password : str
         The password of the admin user.
 
-    postgres_client : asyncpg.Connection
+    postgres_client : asyncpg.Pool | asyncpg.Connection
         The PostgreSQL client.
 
     token : Optional[str], optional
@@ -85,7 +85,7 @@ async def set_credentials(
 async def check_credentials(
     username: str,
     password: str,
-    postgres_client: asyncpg.Connection,
+    postgres_client: asyncpg.Pool | asyncpg.Connection,
 ) -> bool:
     """
     Checks the credentials of a user.
@@ -98,7 +98,7 @@ async def check_credentials(
     password : str
         The password of the user.
 
-    postgres_client : asyncpg.Connection
+    postgres_client : asyncpg.Pool | asyncpg.Connection
         The PostgreSQL client.
 
     Returns
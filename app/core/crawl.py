@@ -16,6 +16,7 @@ import re
 from urllib.parse import urlparse, urlunparse
 from .process import Response
 from .utility import get_base_site, clean_urls, handle_relative_url
+from .storage import PotentialUrlCounter
 from app.models.app_types import AsyncList
 import time
 
@@ -52,6 +53,7 @@ async def crawler(
     seen_urls: Optional[AsyncList] = [],
     max_iter: Optional[int] = -1,
     message_queue: Optional[asyncio.Queue] = None,
+    potential_url_counter: Optional[PotentialUrlCounter] = None,
 ) -> None:
     """
     Simple asynchronous crawling function that continuously reads
@@ -91,6 +93,10 @@ async def crawler(
 
     message_queue : asyncio.Queue, optional
         The queue used by the crawler to stream messages back to the client, if provided.
+
+    potential_url_counter : PotentialUrlCounter, optional
+        Counts sightings of the links the filter rejects, as potential
+        urls to add to the crawlable set in the future, if provided.
     """
     num_iter = 0
     while True:
@@ -126,6 +132,10 @@ async def crawler(
         url = await url_queue.get()
         url_queue.task_done()
 
+        # Woken up to end the crawl?
+        if end.is_set():
+            break
+
         print(f"Crawling {url}")
 
         await message_queue.put(f"Crawler: crawling url: {url}")
@@ -175,6 +185,12 @@ async def crawler(
         addable_urls = filter_func(all_links, **filter_kwargs)
         addable_urls.sort()
 
+        # Count the rejected links as potential urls
+        if potential_url_counter is not None:
+            await potential_url_counter.add(
+                list(set(all_links).difference(addable_urls))
+            )
+
         # Retrieve seen urls
         if type(seen_urls) == AsyncList:
             all_urls = await seen_urls.get_all()
@@ -18,12 +18,21 @@ import datetime
 import httpx
 from urllib.parse import urlparse
 from typing import List, Optional
-from app.core.storage import get_seed_urls
+from app.core.storage import (
+    get_seed_urls,
+    ResourceWriter,
+    EmbeddingWriter,
+    PotentialUrlCounter,
+    begin_bulk_ingest,
+    end_bulk_ingest,
+    rebuild_links,
+)
+from .rank import update_authority
 
 
 async def gather(
     vector_client: AsyncQdrantClient,
-    db_client: asyncpg.Connection,
+    db_client: asyncpg.Pool | asyncpg.Connection,
     model: sentence_transformers.SentenceTransformer,
     pause: asyncio.Event,
     end: asyncio.Event,
@@ -31,6 +40,10 @@ async def gather(
     revisit_delta: Optional[datetime.timedelta] = datetime.timedelta(days=1),
     max_iter: Optional[int] = -1,
     regex_patterns: Optional[List[str]] | None = None,
+    resource_writer: Optional[ResourceWriter] = None,
+    embedding_writer: Optional[EmbeddingWriter] = None,
+    potential_url_counter: Optional[PotentialUrlCounter] = None,
+    bulk_ingest: Optional[bool] = False,
 ):
     """
     Sets up the queues for the crawler and processor and starts the
@@ -42,7 +55,7 @@ async def gather(
     vector_client : QdrantClient
         The Qdrant client to use for storing vectors.
 
-    db_client : asyncpg.Connection
+    db_client : asyncpg.Pool | asyncpg.Connection
         The PostgreSQL client to use for storing data.
 
     model : sentence_transformers.SentenceTransformer
@@ -71,6 +84,28 @@ async def gather(
     regex_patterns : List[str] | None, optional
         A list of regex patterns to filter urls by. Generally this
         could be something like a set of seed urls to crawl. If
+        None, the base seed urls are used.
+
+    resource_writer : ResourceWriter, optional
+        The buffer used to batch resource writes to postgres. If None,
+        one is created for the crawl. It's flushed when the crawl
+        finishes.
+
+    embedding_writer : EmbeddingWriter, optional
+        The queue used to batch embedding writes to qdrant. If None,
+        one is created for the crawl. It's flushed when the crawl
+        finishes.
+
+    potential_url_counter : PotentialUrlCounter, optional
+        Counts the links the crawler doesn't follow in memory and
+        writes them to postgres in batches. If None, one is created
+        for the crawl. It's flushed when the crawl finishes.
+
+    bulk_ingest : bool, optional
+        Turns off HNSW indexing in qdrant for the length of the crawl
+        and rebuilds the index in one pass when it ends. This makes
+        large initial crawls much faster. The link graph and the pages'
+        authority are rebuilt at the end too. Defaults to False.
     """
 
     # Create a queue for the crawler
@@ -125,6 +160,32 @@ async def gather(
 
     print("seen urls:", seen_urls)
 
+    # Create a buffer for batching resource writes
+    if resource_writer is None:
+        resource_writer = ResourceWriter(db_client)
+
+    resource_writer.start()
+
+    # Create a queue for batching embedding writes
+    if embedding_writer is None:
+        embedding_writer = EmbeddingWriter(
+            vector_client,
+            db_client,
+            resource_writer=resource_writer,
+        )
+
+    embedding_writer.start()
+
+    # Create a counter for batching potential url writes
+    if potential_url_counter is None:
+        potential_url_counter = PotentialUrlCounter(db_client)
+
+    potential_url_counter.start()
+
+    # Defer indexing until the crawl is complete
+    if bulk_ingest:
+        indexing_threshold = await begin_bulk_ingest(vector_client)
+
     # Create a process coroutine
     process_task = asyncio.create_task(
         process(
@@ -136,6 +197,8 @@ async def gather(
             end,
             max_iter=max_iter,
             message_queue=message_queue,
+            resource_writer=resource_writer,
+            embedding_writer=embedding_writer,
         )
     )
 
@@ -163,9 +226,52 @@ async def gather(
             seen_urls=seen_urls,
             max_iter=max_iter,
             message_queue=message_queue,
+            potential_url_counter=potential_url_counter,
         )
     )
 
-    # Wait for the process coroutine to finish
-    print("waiting for process and crawler tasks", flush=True)
-    await asyncio.gather(process_task, crawler_task)
+    # Wake the tasks if they're waiting on empty queues when ended
+    wake_task = asyncio.create_task(
+        wake_on_end(end, url_queue, response_queue)
+    )
+
+    try:
+        # Wait for the process coroutine to finish
+        print("waiting for process and crawler tasks", flush=True)
+        await asyncio.gather(process_task, crawler_task)
+
+        # Write any resources and embeddings left in the buffers
+        await resource_writer.close()
+        await embedding_writer.close()
+        await potential_url_counter.close()
+
+    finally:
+        wake_task.cancel()
+
+        # Index everything ingested during the crawl, and rank the pages
+        # by the links between them now the linked pages are logged
+        if bulk_ingest:
+            await end_bulk_ingest(vector_client, indexing_threshold)
+
+            if await rebuild_links(db_client):
+                await update_authority(db_client)
+
+
+async def wake_on_end(end: asyncio.Event, *queues: asyncio.Queue):
+    """
+    Waits for the crawl to be ended, then puts None on each of the
+    queues so any task blocked waiting on an empty queue wakes up and
+    sees the end event.
+
+    Parameters
+    ----------
+    end : asyncio.Event
+        The event that ends the crawl.
+
+    *queues : asyncio.Queue
+        The queues to wake up.
+    """
+    await end.wait()
+
+    for queue in queues:
+        queue.put_nowait(None)
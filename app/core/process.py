@@ -14,12 +14,19 @@ from qdrant_client import AsyncQdrantClient
 import sentence_transformers
 from dataclasses import dataclass
 from typing import Optional
-from .storage import store_embedding, Resource, log_resource
+from .storage import (
+    store_embedding,
+    Resource,
+    log_resource,
+    ResourceWriter,
+    EmbeddingWriter,
+)
 import asyncio
 import asyncpg
-from datetime import datetime
+from datetime import datetime, timezone
 from .utility import clean_urls, handle_relative_url, get_base_site
 import time
+from urllib.parse import urlparse, urljoin
 
 
 @dataclass
@@ -34,15 +41,19 @@ async def process(
     response_queue: asyncio.Queue,
     model: sentence_transformers.SentenceTransformer,
     vector_client: AsyncQdrantClient,
-    db_client: asyncpg.Connection,
+    db_client: asyncpg.Pool | asyncpg.Connection,
     pause: asyncio.Event,
     end: asyncio.Event,
     max_iter: Optional[int] = -1,
     message_queue: Optional[asyncio.Queue] = None,
+    resource_writer: Optional[ResourceWriter] = None,
+    embedding_writer: Optional[EmbeddingWriter] = None,
 ):
     """
     Processes responses collected by the crawler, turning them into
-    embeddings, and other metadata used for searching.
+    embeddings, and other metadata used for searching. Resources and
+    embeddings are buffered in the resource and embedding writers if
+    they're provided, otherwise they're stored one page at a time.
     """
     num_iter = 0
     while True:
@@ -74,6 +85,10 @@ async def process(
         response: Response = await response_queue.get()
         response_queue.task_done()
 
+        # Woken up to end the crawl?
+        if end.is_set():
+            break
+
         if response.type == "webpage":
             soup = response.soup
 
@@ -82,6 +97,10 @@ async def process(
             )
             start_time = time.time()
 
+            # Read the page's metadata before the text extraction strips
+            # the head's tags out of the soup
+            page_metadata = extract_page_metadata(soup, response.url)
+
             # Process webpage
             vectors, metadata = await process_html_to_vectors(soup, model)
 
@@ -89,14 +108,6 @@ async def process(
                 f"Processor: finished processing webpage into vectors and meta in {time.time() - start_time} seconds"
             )
 
-            metadata["url"] = response.url
-
-            # Store the vectors and metadata
-            vectors = vectors.tolist()
-            metadata = [metadata] * len(vectors)
-
-            await store_embedding(vectors, metadata, vector_client)
-
             # Get the base site
             base_site = get_base_site(response.url)
 
@@ -117,21 +128,41 @@ async def process(
             links = handle_relative_url(links, response.url, base_site)
             links.sort()
 
-            # TODO: Setup a swtich statement or function for this that checks if the
-            # resource is already present in the database before adding it.
-            # Log a new resource
-            if response.url_id == -1:
-                # Create a new resource
-                resource = Resource(
-                    url=response.url,
-                    firstVisited=datetime.now(),
-                    lastVisited=datetime.now(),
-                    allVisits=1,
-                    externalLinks=links,
-                )
+            # Log the resource, revisits update the existing row's visit
+            # counters rather than adding a new one. It's logged before
+            # the embeddings, which are stored against its id
+            visited = datetime.now()
+            resource = Resource(
+                url=response.url,
+                firstVisited=visited,
+                lastVisited=visited,
+                allVisits=1,
+                externalLinks=links,
+                chunks=metadata.pop("chunks"),
+                **page_metadata,
+            )
 
+            if resource_writer is not None:
+                await resource_writer.add(resource)
+            else:
                 await log_resource(resource, db_client)
 
+            metadata |= {
+                "url": response.url,
+                "site": urlparse(response.url).netloc.lower(),
+                "type": response.type,
+                "visited": visited.isoformat(),
+            }
+
+            # Store the vectors and metadata, the vectors are kept as a
+            # numpy array until they're sent to qdrant
+            metadata = [metadata] * len(vectors)
+
+            if embedding_writer is not None:
+                await embedding_writer.add(vectors, metadata)
+            else:
+                await store_embedding(vectors, metadata, vector_client, db_client)
+
     return None
 
 
@@ -142,8 +173,8 @@ async def process_html_to_vectors(
 ) -> None:
     """
     Processes a BeautifulSoup object into a list of sentences and turns each of them
-    into a vector using the sentence_transformers model. Puts the vectors into a Qdrant
-    collection.
+    into a vector using the sentence_transformers model. Returns the vectors and
+    the page's metadata, which holds the text of each chunk under "chunks".
     """
     # Extract visible text from the soup
     visible_text = extract_visible_text(soup)
@@ -162,11 +193,84 @@ async def process_html_to_vectors(
     vectors = model.encode(sequences, convert_to_numpy=True)
     vectors = vectors.astype(np.float32)
 
-    metadata = {}
+    metadata = {"chunks": sequences}
 
     return vectors, metadata
 
 
+def extract_page_metadata(
+    soup: BeautifulSoup,
+    url: str,
+) -> dict:
+    """
+    Extracts the metadata shown with a webpage's search results from its
+    head. Open Graph tags are preferred over the plain HTML ones, and
+    missing values are left empty apart from the site name and favicon,
+    which fall back to the url's domain and the site's favicon.ico.
+
+    Parameters
+    ----------
+    soup : BeautifulSoup
+        The BeautifulSoup object of the webpage.
+
+    url : str
+        The url of the webpage, used to resolve relative favicon links.
+
+    Returns
+    -------
+    dict
+        The page's title, siteName, description, published date and
+        favicon, keyed as the Resource fields they're stored in.
+    """
+
+    def meta_content(*keys: str) -> str:
+        # First non-empty meta tag matching one of the names or properties
+        for key in keys:
+            tag = soup.find("meta", attrs={"property": key}) or soup.find(
+                "meta", attrs={"name": key}
+            )
+            if tag is not None and tag.get("content", "").strip():
+                return tag["content"].strip()
+
+        return ""
+
+    title = meta_content("og:title")
+    if not title and soup.title is not None and soup.title.string:
+        title = soup.title.string.strip()
+
+    site_name = meta_content("og:site_name", "application-name")
+
+    description = meta_content("og:description", "description")
+
+    # Published dates are ISO 8601 strings, stored as naive UTC times
+    published_text = meta_content("article:published_time", "date")
+    if not published_text:
+        tag = soup.find(attrs={"itemprop": "datePublished"})
+        if tag is not None:
+            published_text = tag.get("content") or tag.get("datetime") or ""
+
+    try:
+        published = datetime.fromisoformat(published_text.strip())
+        if published.tzinfo is not None:
+            published = published.astimezone(timezone.utc).replace(tzinfo=None)
+    except ValueError:
+        published = None
+
+    favicon = soup.find(
+        "link",
+        rel=lambda rel: rel is not None and rel.lower() == "icon",
+        href=True,
+    )
+
+    return {
+        "title": title,
+        "siteName": site_name or urlparse(url).netloc,
+        "description": description,
+        "published": published,
+        "favicon": urljoin(url, favicon["href"] if favicon else "/favicon.ico"),
+    }
+
+
 def extract_visible_text(
     soup: BeautifulSoup,
 ):
@@ -0,0 +1,167 @@
+"""
+Description:
+    Ranks the crawled pages by the links between them with PageRank,
+    giving each an authority score that's blended into search scores.
+
+Created:
+    2026-10-19
+"""
+
+import asyncio
+import asyncpg
+import numpy as np
+from functools import partial
+from scipy import sparse
+from .storage import acquire_connection, bump_index_generation
+
+# Query used to store the authority of each resource, given the resource
+# ids and their authorities
+UPDATE_AUTHORITY_QUERY = """UPDATE resources
+    SET authority = ranked.authority
+    FROM unnest($1::int[], $2::float8[]) AS ranked (id, authority)
+    WHERE resources.id = ranked.id"""
+
+
+def compute_pagerank(
+    sources: np.ndarray,
+    targets: np.ndarray,
+    num_nodes: int,
+    damping: float = 0.85,
+    tolerance: float = 1e-6,
+    max_iter: int = 100,
+) -> np.ndarray:
+    """
+    Computes the PageRank of each node of a graph by power iteration
+    over a sparse transition matrix. Nodes without outgoing links share
+    their rank with every node.
+
+    Parameters
+    ----------
+    sources : np.ndarray
+        The node each link comes from, as positions from 0 to num_nodes.
+
+    targets : np.ndarray
+        The node each link goes to, as positions from 0 to num_nodes.
+
+    num_nodes : int
+        The number of nodes in the graph.
+
+    damping : float, optional
+        The chance of following a link rather than jumping to a random
+        node. Defaults to 0.85.
+
+    tolerance : float, optional
+        The total change in rank between iterations that counts as
+        converged. Defaults to 1e-6.
+
+    max_iter : int, optional
+        The maximum number of iterations. Defaults to 100.
+
+    Returns
+    -------
+    np.ndarray
+        The rank of each node, summing to 1.
+    """
+    if num_nodes == 0:
+        return np.zeros(0)
+
+    # Each link passes on an equal share of its source's rank
+    out_degree = np.bincount(sources, minlength=num_nodes)
+    transitions = sparse.csr_matrix(
+        (1.0 / out_degree[sources], (targets, sources)),
+        shape=(num_nodes, num_nodes),
+    )
+    dangling = out_degree == 0
+
+    rank = np.full(num_nodes, 1.0 / num_nodes)
+    for _ in range(max_iter):
+        new_rank = (
+            damping * (transitions @ rank + rank[dangling].sum() / num_nodes)
+            + (1 - damping) / num_nodes
+        )
+
+        converged = np.abs(new_rank - rank).sum() < tolerance
+        rank = new_rank
+
+        if converged:
+            break
+
+    return rank
+
+
+async def update_authority(
+    db_client: asyncpg.Pool | asyncpg.Connection,
+    damping: float = 0.85,
+) -> bool:
+    """
+    Computes the PageRank of every resource from the links table and
+    stores it as the resource's authority. Authority is scaled so a page
+    without any links to it has an authority of 0, the same as pages
+    crawled since the last update, and the highest ranked resource has
+    an authority of 1. Without any links every resource gets 0, so the
+    link graph never penalises a page. The ranking runs in a worker
+    thread so the event loop isn't blocked. Cached search results are
+    dropped as their scores are out of date.
+
+    Parameters
+    ----------
+    db_client : asyncpg.Pool | asyncpg.Connection
+        The PostgreSQL client the resources and links are stored with.
+
+    damping : float, optional
+        The damping factor of PageRank, see compute_pagerank. Defaults
+        to 0.85.
+
+    Returns
+    -------
+    bool
+        True if the authorities were updated successfully, False
+        otherwise.
+    """
+    try:
+        async with acquire_connection(db_client) as connection:
+            ids = await connection.fetch("SELECT id FROM resources ORDER BY id")
+            links = await connection.fetch("SELECT source_id, target_id FROM links")
+
+        ids = np.array([row["id"] for row in ids], dtype=np.int64)
+        if len(ids) == 0:
+            return True
+
+        # Turn the resource ids into positions in the matrix
+        sources = np.searchsorted(ids, [row["source_id"] for row in links])
+        targets = np.searchsorted(ids, [row["target_id"] for row in links])
+
+        rank = await asyncio.get_running_loop().run_in_executor(
+            None,
+            partial(
+                compute_pagerank,
+                sources.astype(np.int64),
+                targets.astype(np.int64),
+                len(ids),
+                damping=damping,
+            ),
+        )
+
+        # The rank a page gets without inlinks, from random jumps and
+        # the pages without links alone
+        dangling = np.bincount(sources, minlength=len(ids)) == 0
+        baseline = ((1 - damping) + damping * rank[dangling].sum()) / len(ids)
+
+        spread = rank.max() - baseline
+        if spread > 1e-12:
+            authority = np.clip((rank - baseline) / spread, 0, 1)
+        else:
+            authority = np.zeros(len(ids))
+
+        await db_client.execute(
+            UPDATE_AUTHORITY_QUERY, ids.tolist(), authority.tolist()
+        )
+
+        bump_index_generation()
+
+        return True
+
+    except Exception as e:
+        print("Failed to update authority with error:", e)
+
+        return False
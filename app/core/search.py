@@ -9,77 +9,1291 @@ Created:
 
 import sentence_transformers
 from qdrant_client import AsyncQdrantClient
-from qdrant_client.models import ScoredPoint
-from typing import List, Dict, Any
+from qdrant_client.models import (
+    ScoredPoint,
+    PointGroup,
+    SearchParams,
+    QuantizationSearchParams,
+    Filter,
+    FieldCondition,
+    MatchAny,
+    MatchValue,
+    DatetimeRange,
+    RecommendQuery,
+    RecommendInput,
+    RecommendStrategy,
+)
+from typing import List, Dict, Any, Tuple, Optional, AsyncIterator
+import asyncio
+from concurrent.futures import Future, ThreadPoolExecutor
+from functools import partial
+from dataclasses import asdict, dataclass, field, replace
+from datetime import datetime, timezone
+from urllib.parse import urlparse
 import numpy as np
+import re
+import base64
+import hashlib
+import json
+import math
+import uuid
 import asyncpg
 from app.models.data_types import Result
+from app.models.app_types import (
+    LRUCache,
+    TTLCache,
+    SemanticCache,
+    SingleFlight,
+)
+from app.core.storage import get_index_generation
+
+# Full text search over the chunks, ranking resources by their best chunk
+LEXICAL_SEARCH_QUERY = """SELECT resource_id, chunk, rank FROM (
+        SELECT DISTINCT ON (chunks.resource_id)
+            chunks.resource_id,
+            chunks.chunk,
+            ts_rank_cd(chunks.tsv, query) AS rank
+        FROM chunks
+        JOIN resources ON resources.id = chunks.resource_id,
+            websearch_to_tsquery('english', $1) AS query
+        WHERE chunks.tsv @@ query
+            AND ($3::text[] IS NULL
+                OR lower(substring(resources.url FROM '^[^:]+://([^/]+)')) = ANY($3))
+            AND ($4::timestamp IS NULL OR resources.lastVisited >= $4)
+            AND ($5::timestamp IS NULL OR resources.lastVisited < $5)
+        ORDER BY chunks.resource_id, rank DESC
+    ) AS best
+    ORDER BY rank DESC
+    LIMIT $2"""
+
+# Parses a query into the tsquery lexical search matches it with
+LEXICAL_QUERY_QUERY = "SELECT websearch_to_tsquery('english', $1)::text"
+
+# Looks up the results' resources along with the text of their best
+# chunks, given the resource ids and chunk positions
+RESULTS_QUERY = """SELECT resources.id, resources.url, chunks.content,
+        coalesce(resources.title, '') AS title,
+        coalesce(resources.siteName, '') AS site_name,
+        coalesce(resources.favicon, '') AS favicon,
+        coalesce(to_char(resources.published, 'YYYY-MM-DD'), '') AS published,
+        resources.authority
+    FROM unnest($1::int[], $2::int[]) AS best (resource_id, chunk)
+    JOIN resources ON resources.id = best.resource_id
+    LEFT JOIN chunks ON chunks.resource_id = best.resource_id
+        AND chunks.chunk = best.chunk"""
+
+# Rank constant for reciprocal rank fusion
+RRF_K = 60
+
+# Most a resource's score is raised by its link authority, as a fraction
+# of the score
+AUTHORITY_WEIGHT = 0.2
+
+# Number of words in a result's snippet
+SNIPPET_LENGTH = 40
+
+# Search operators pulled out of queries, like site:example.com
+QUERY_OPERATOR = re.compile(r"(?<!\S)(site|after|before|type):(\S+)", re.IGNORECASE)
+
+# How many times the number of results are fetched as candidates for
+# diversifying the results
+MMR_OVERSAMPLING = 3
+
+# Most stored chunks averaged into the vector of a page or site
+MAX_RECOMMEND_POINTS = 1024
+
+# Deepest a search can be paged through, in resources
+MAX_SEARCH_DEPTH = 1000
+
+# Embeddings of recent queries, keyed by their normalised text
+query_embedding_cache = LRUCache(max_size=4096)
+
+# Parsed lexical queries of recent queries, keyed by their normalised text
+lexical_query_cache = LRUCache(max_size=4096)
+
+# Results of recent searches, keyed by the search and index generation
+search_result_cache = TTLCache(max_size=1024, ttl=300.0)
+
+# Results of recent searches, keyed by the similarity of their queries so
+# paraphrased queries share results
+semantic_result_cache = SemanticCache(max_size=256, threshold=0.95, ttl=300.0)
+
+# Seconds results that missed out on reranking are cached for, short so
+# the reranked results replace them soon after load drops
+UNRERANKED_CACHE_TTL = 30.0
+
+# Reranks run one at a time on their own thread, so reranks that ran out
+# of time can't hold up query encoding in the default executor
+rerank_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="rerank")
+
+# The rerank running on the rerank executor, if any
+_rerank_future: Optional[Future] = None
+
+# Mean vectors of sites, keyed by the site and index generation
+site_centroid_cache = LRUCache(max_size=1024)
+
+# Searches in flight, keyed the same way as the search result cache
+search_flights = SingleFlight()
+
+
+class EncodingBatcher:
+    """
+    Batches query encoding across concurrent searches. Queries wait a
+    few milliseconds for others to arrive and are then encoded together
+    in one forward pass of the model, run in a worker thread so the
+    event loop isn't blocked. Each caller gets back its own vector.
+
+    Parameters
+    ----------
+    model : sentence_transformers.SentenceTransformer
+        The model used to encode the queries.
+
+    max_wait : float, optional
+        The maximum number of seconds a query waits for others before
+        it's encoded. Defaults to 5 milliseconds.
+
+    max_batch_size : int, optional
+        The number of waiting queries that are encoded straight away.
+        Defaults to 64.
+    """
+
+    def __init__(
+        self,
+        model: sentence_transformers.SentenceTransformer,
+        max_wait: float = 0.005,
+        max_batch_size: int = 64,
+    ):
+        self._model = model
+        self._max_wait = max_wait
+        self._max_batch_size = max_batch_size
+        self._pending: List[Tuple[str, asyncio.Future]] = []
+        self._flush_task: Optional[asyncio.Task] = None
+        self._batch_tasks: set[asyncio.Task] = set()
+
+    async def encode(self, query: str) -> np.ndarray:
+        """
+        Encodes a query as part of the next batch.
+
+        Parameters
+        ----------
+        query : str
+            The query text.
+
+        Returns
+        -------
+        np.ndarray
+            The query's embedding.
+        """
+        future = asyncio.get_running_loop().create_future()
+        self._pending.append((query, future))
+
+        # Encode a full batch now, otherwise wait for more queries
+        if len(self._pending) >= self._max_batch_size:
+            self._start_batch()
+
+        elif self._flush_task is None:
+            self._flush_task = asyncio.create_task(self._flush_after_wait())
+
+        return await future
+
+    def _start_batch(self):
+        """
+        Takes the waiting queries and encodes them in the background.
+        """
+        if self._flush_task is not None:
+            self._flush_task.cancel()
+            self._flush_task = None
+
+        batch, self._pending = self._pending, []
+
+        task = asyncio.create_task(self._encode_batch(batch))
+        self._batch_tasks.add(task)
+        task.add_done_callback(self._batch_tasks.discard)
+
+    async def _flush_after_wait(self):
+        """
+        Encodes the waiting queries once the maximum wait has passed.
+        """
+        await asyncio.sleep(self._max_wait)
+
+        self._flush_task = None
+        self._start_batch()
+
+    async def _encode_batch(self, batch: List[Tuple[str, asyncio.Future]]):
+        """
+        Encodes a batch of queries in a worker thread and hands each
+        caller its vector.
+        """
+        queries = [query for query, _ in batch]
+
+        try:
+            vectors = await asyncio.get_running_loop().run_in_executor(
+                None,
+                partial(self._model.encode, queries, convert_to_numpy=True),
+            )
+
+        except Exception as e:
+            for _, future in batch:
+                if not future.done():
+                    future.set_exception(e)
+
+            return
+
+        for (_, future), vector in zip(batch, vectors):
+            if not future.done():
+                future.set_result(vector)
+
+
+@dataclass(frozen=True)
+class SearchFilters:
+    sites: Tuple[str, ...] = ()
+    after: Optional[datetime] = None
+    before: Optional[datetime] = None
+    types: Tuple[str, ...] = ()
+
+
+@dataclass(frozen=True)
+class SearchOptions:
+    match_limit: int = 30
+    group_size: int = 3
+    aggregation: str = "sum"
+    hybrid: bool = True
+    rerank_top_n: int = 0
+    rerank_budget: float = 0.2
+    filters: SearchFilters = field(default_factory=SearchFilters)
+    diversity: float = 0.0
+    site_limit: int = 0
+    authority_weight: float = AUTHORITY_WEIGHT
 
 
 async def get_top_matches(
     query: str,
-    model: sentence_transformers.SentenceTransformer,
+    model: sentence_transformers.SentenceTransformer | EncodingBatcher,
     vector_client: AsyncQdrantClient,
-    postgres_client: asyncpg.Connection,
-    limit: int = 50,
+    postgres_client: asyncpg.Pool | asyncpg.Connection,
+    match_limit: int = 30,
+    group_size: int = 3,
+    aggregation: str = "sum",
+    hybrid: bool = True,
+    reranker: Optional[sentence_transformers.CrossEncoder] = None,
+    rerank_top_n: int = 20,
+    rerank_budget: float = 0.2,
+    diversity: float = 0.0,
+    site_limit: int = 0,
+    authority_weight: float = AUTHORITY_WEIGHT,
+    use_cache: bool = True,
+) -> List[Result]:
+    """
+    Search the qdrant database for the query and returns the best
+    matching resources. Chunk hits are grouped by resource in qdrant,
+    so a single long page can't crowd out the other results, and each
+    resource is scored by aggregating the scores of its best chunks.
+    Hybrid searches also run a full text search over the chunks in
+    postgres, and merge the two rankings with reciprocal rank fusion.
+    Search operators in the query narrow down the resources searched,
+    see parse_query.
+
+    Parameters
+    ----------
+    query : str
+        The text to search for, which may include search operators.
+
+    model : sentence_transformers.SentenceTransformer | EncodingBatcher
+        The model used to embed the query, see embed_query.
+
+    vector_client : AsyncQdrantClient
+        The Qdrant client to search.
+
+    postgres_client : asyncpg.Pool | asyncpg.Connection
+        The PostgreSQL client the resources are looked up with.
+
+    match_limit : int, optional
+        The maximum number of resources to return. Defaults to 30.
+
+    group_size : int, optional
+        The number of best chunks scored for each resource. Defaults
+        to 3.
+
+    aggregation : str, optional
+        How the chunk scores of a resource are combined, see
+        aggregate_scores. Defaults to "sum".
+
+    hybrid : bool, optional
+        Merge the vector search with a lexical search, which finds
+        exact tokens like error codes and version strings. Results are
+        then scored by reciprocal rank fusion. Defaults to True.
+
+    reranker : sentence_transformers.CrossEncoder, optional
+        A cross encoder that reorders the best results by reading the
+        query and each result's best chunk together. Results keep their
+        first stage scores. Defaults to None, no reranking.
+
+    rerank_top_n : int, optional
+        The number of best results that are reranked. Defaults to 20.
+
+    rerank_budget : float, optional
+        The maximum number of seconds spent reranking, after which the
+        first stage order is used. Defaults to 0.2.
+
+    diversity : float, optional
+        How much results are penalised for being like the results ranked
+        above them, from 0 to 1, see maximal_marginal_relevance.
+        Defaults to 0, no diversification.
+
+    site_limit : int, optional
+        The maximum number of results from one site. Defaults to 0, no
+        limit.
+
+    authority_weight : float, optional
+        The most a resource's score is raised by its authority from the
+        link graph, as a fraction of the score. Defaults to 0.2.
+
+    use_cache : bool, optional
+        Reuse the query's embedding and results from earlier searches,
+        including searches for queries whose embeddings are within the
+        semantic cache's cosine threshold. Cached results are dropped
+        once new embeddings are written to the index. Defaults to True.
+
+    Returns
+    -------
+    List[Result]
+        The results ordered from best to worst.
+    """
+    query, options = build_search_options(
+        query,
+        match_limit=match_limit,
+        group_size=group_size,
+        aggregation=aggregation,
+        hybrid=hybrid,
+        reranker=reranker,
+        rerank_top_n=rerank_top_n,
+        rerank_budget=rerank_budget,
+        diversity=diversity,
+        site_limit=site_limit,
+        authority_weight=authority_weight,
+    )
+
+    # Repeat searches against the same index reuse the results
+    cache_key = (normalise_query(query), options, get_index_generation())
+
+    if use_cache:
+        results = search_result_cache.get(cache_key)
+        if results is not None:
+            return list(results)
+
+    # Concurrent identical searches share one search of the index
+    results = []
+    async for _, results in search_flights.stream(
+        cache_key,
+        search_stages,
+        query,
+        model,
+        vector_client,
+        postgres_client,
+        cache_key,
+        reranker=reranker,
+        use_cache=use_cache,
+    ):
+        pass
+
+    return list(results)
+
+
+def build_search_options(
+    query: str,
+    match_limit: int = 30,
+    group_size: int = 3,
+    aggregation: str = "sum",
+    hybrid: bool = True,
+    reranker: Optional[sentence_transformers.CrossEncoder] = None,
+    rerank_top_n: int = 20,
+    rerank_budget: float = 0.2,
+    diversity: float = 0.0,
+    site_limit: int = 0,
+    authority_weight: float = AUTHORITY_WEIGHT,
+) -> Tuple[str, SearchOptions]:
+    """
+    Splits the search operators off a query and gathers them with the
+    other options of a search, which together with the query text
+    decide its results. Takes the same arguments as get_top_matches.
+
+    Returns
+    -------
+    Tuple[str, SearchOptions]
+        The query text without its operators, and the search's options.
+    """
+    query, filters = parse_query(query)
+
+    options = SearchOptions(
+        match_limit=match_limit,
+        group_size=group_size,
+        aggregation=aggregation,
+        hybrid=hybrid,
+        rerank_top_n=rerank_top_n if reranker is not None else 0,
+        rerank_budget=rerank_budget,
+        filters=filters,
+        diversity=diversity,
+        site_limit=site_limit,
+        authority_weight=authority_weight,
+    )
+
+    return query, options
+
+
+async def get_result_page(
+    query: str,
+    model: sentence_transformers.SentenceTransformer | EncodingBatcher,
+    vector_client: AsyncQdrantClient,
+    postgres_client: asyncpg.Pool | asyncpg.Connection,
+    page_size: int = 30,
+    page_token: Optional[str] = None,
+    use_cache: bool = True,
+    **search_options,
+) -> Tuple[List[Result], Optional[str]]:
+    """
+    Returns one page of the results of a search, and a token for the
+    next page. The depth of the search doubles as the pages go on, so
+    the first page only searches for as many resources as it shows.
+    Each deeper search only adds the resources the shallower searches
+    missed, which keeps the order of earlier pages fixed. The shallower
+    searches, and later pages that fit in an earlier depth, are served
+    from the search result cache.
+
+    Parameters
+    ----------
+    query : str
+        The text to search for.
+
+    model : sentence_transformers.SentenceTransformer | EncodingBatcher
+        The model used to embed the query, see embed_query.
+
+    vector_client : AsyncQdrantClient
+        The Qdrant client to search.
+
+    postgres_client : asyncpg.Pool | asyncpg.Connection
+        The PostgreSQL client the resources are looked up with.
+
+    page_size : int, optional
+        The number of results in a page. Defaults to 30.
+
+    page_token : str, optional
+        The token returned with the previous page. Defaults to None,
+        the first page.
+
+    use_cache : bool, optional
+        Reuse the results of earlier searches, see get_top_matches.
+        Defaults to True.
+
+    **search_options
+        The other options of the search, see get_top_matches.
+
+    Returns
+    -------
+    Tuple[List[Result], Optional[str]]
+        The page's results, and the token for the next page or None if
+        this is the last page.
+
+    Raises
+    ------
+    ValueError
+        If the page token is malformed or belongs to another search.
+    """
+    # Tokens are tied to everything that orders the results except the
+    # depth, which changes from page to page
+    identity = search_identity(*build_search_options(query, **search_options))
+
+    offset, cursor = 0, None
+    if page_token is not None:
+        offset, cursor = decode_page_token(page_token, identity)
+
+    # Search deep enough to reach the end of the page, doubling the depth
+    # from one page so consecutive pages share the cached searches
+    windows = math.ceil((offset + page_size) / page_size)
+    depths = [
+        min(page_size * 2**i, MAX_SEARCH_DEPTH)
+        for i in range(math.ceil(math.log2(windows)) + 1)
+    ]
+
+    # Deeper searches can reorder the resources, so each only extends
+    # the results of the shallower ones
+    results = []
+    for depth in depths:
+        deeper = await get_top_matches(
+            query,
+            model,
+            vector_client,
+            postgres_client,
+            match_limit=depth,
+            use_cache=use_cache,
+            **search_options,
+        )
+
+        seen = {result.url for result in results}
+        results += [result for result in deeper if result.url not in seen]
+
+    start = find_cursor(results, offset, cursor)
+    page = results[start : start + page_size]
+
+    # There may be more results if this page is full and the search ran
+    # out of depth before it ran out of results
+    next_token = None
+    if len(page) == page_size and (
+        start + page_size < len(results)
+        or (len(deeper) == depth and depth < MAX_SEARCH_DEPTH)
+    ):
+        next_token = encode_page_token(identity, offset + page_size, page[-1])
+
+    return page, next_token
+
+
+def encode_page_token(identity: str, offset: int, last: Result) -> str:
+    """
+    Encodes the position after a page of results as an opaque token. It
+    holds the identity of the search, the offset of the next page and
+    the url of the page's last result as a cursor.
+
+    Parameters
+    ----------
+    identity : str
+        The identity of the search, see search_identity.
+
+    offset : int
+        The position of the first result of the next page.
+
+    last : Result
+        The last result of the page.
+
+    Returns
+    -------
+    str
+        The url safe page token.
+    """
+    token = {"q": identity, "o": offset, "u": last.url}
+
+    return base64.urlsafe_b64encode(json.dumps(token).encode()).decode()
+
+
+def decode_page_token(page_token: str, identity: str) -> Tuple[int, str]:
+    """
+    Decodes a page token made by encode_page_token for the search.
+
+    Parameters
+    ----------
+    page_token : str
+        The page token.
+
+    identity : str
+        The identity of the search the token is used with, see
+        search_identity.
+
+    Returns
+    -------
+    Tuple[int, str]
+        The offset of the next page, and the url of the last result
+        before it.
+
+    Raises
+    ------
+    ValueError
+        If the token is malformed or belongs to another search.
+    """
+    try:
+        token = json.loads(base64.urlsafe_b64decode(page_token.encode()))
+        offset, cursor = int(token["o"]), str(token["u"])
+        token_identity = token["q"]
+
+    except (ValueError, TypeError, KeyError) as e:
+        raise ValueError("Malformed page token") from e
+
+    if token_identity != identity:
+        raise ValueError("Page token belongs to another search")
+
+    if offset < 0:
+        raise ValueError("Malformed page token")
+
+    return offset, cursor
+
+
+def search_identity(query: str, options: SearchOptions) -> str:
+    """
+    Hashes the normalised query text and the options of a search other
+    than its depth, which between them decide the order of its results.
+    The hash is stable across processes, so tokens work on any worker.
+
+    Parameters
+    ----------
+    query : str
+        The query text without its operators.
+
+    options : SearchOptions
+        The options of the search, see build_search_options.
+
+    Returns
+    -------
+    str
+        The search's identity.
+    """
+    search = {
+        "query": normalise_query(query),
+        "options": asdict(replace(options, match_limit=0)),
+    }
+    encoded = json.dumps(search, sort_keys=True, default=str).encode()
+
+    return hashlib.sha256(encoded).hexdigest()[:16]
+
+
+def find_cursor(
+    results: List[Result],
+    offset: int,
+    cursor: Optional[str],
+) -> int:
+    """
+    Finds where the next page starts in a list of results. The offset
+    is used if the result before it is the cursor, which holds unless
+    the index has changed since the last page. Then the page starts
+    after the cursor's url, or failing that at the offset. Scores aren't
+    used, as reranked and diversified results aren't ordered by score.
+
+    Parameters
+    ----------
+    results : List[Result]
+        The results ordered from best to worst.
+
+    offset : int
+        The offset of the page.
+
+    cursor : str, optional
+        The url of the last result before the page, None for the first
+        page.
+
+    Returns
+    -------
+    int
+        The position of the page's first result.
+    """
+    if cursor is None:
+        return offset
+
+    if 0 < offset <= len(results) and results[offset - 1].url == cursor:
+        return offset
+
+    for i, result in enumerate(results):
+        if result.url == cursor:
+            return i + 1
+
+    return min(offset, len(results))
+
+
+async def stream_top_matches(
+    query: str,
+    model: sentence_transformers.SentenceTransformer | EncodingBatcher,
+    vector_client: AsyncQdrantClient,
+    postgres_client: asyncpg.Pool | asyncpg.Connection,
     match_limit: int = 30,
-) -> List[Dict[str, Any]]:
+    group_size: int = 3,
+    aggregation: str = "sum",
+    hybrid: bool = True,
+    reranker: Optional[sentence_transformers.CrossEncoder] = None,
+    rerank_top_n: int = 20,
+    rerank_budget: float = 0.2,
+    diversity: float = 0.0,
+    site_limit: int = 0,
+    authority_weight: float = AUTHORITY_WEIGHT,
+    use_cache: bool = True,
+) -> AsyncIterator[Tuple[str, List[Result]]]:
+    """
+    Searches like get_top_matches, but yields the results of each stage
+    of the search as soon as it ends, see search_stages. The first
+    stage's results arrive without waiting on the reranker. Takes the
+    same arguments as get_top_matches.
+
+    Yields
+    ------
+    Tuple[str, List[Result]]
+        The name of the stage and its results, ordered from best to
+        worst. The last results yielded are final.
+    """
+    query, options = build_search_options(
+        query,
+        match_limit=match_limit,
+        group_size=group_size,
+        aggregation=aggregation,
+        hybrid=hybrid,
+        reranker=reranker,
+        rerank_top_n=rerank_top_n,
+        rerank_budget=rerank_budget,
+        diversity=diversity,
+        site_limit=site_limit,
+        authority_weight=authority_weight,
+    )
+
+    cache_key = (normalise_query(query), options, get_index_generation())
+
+    if use_cache:
+        results = search_result_cache.get(cache_key)
+        if results is not None:
+            yield "cached", list(results)
+            return
+
+    # Concurrent identical searches share one search of the index, and
+    # each stream gets every stage of it
+    async for stage, results in search_flights.stream(
+        cache_key,
+        search_stages,
+        query,
+        model,
+        vector_client,
+        postgres_client,
+        cache_key,
+        reranker=reranker,
+        use_cache=use_cache,
+    ):
+        yield stage, list(results)
+
+
+async def search_stages(
+    query: str,
+    model: sentence_transformers.SentenceTransformer | EncodingBatcher,
+    vector_client: AsyncQdrantClient,
+    postgres_client: asyncpg.Pool | asyncpg.Connection,
+    cache_key: Tuple[str, SearchOptions, int],
+    reranker: Optional[sentence_transformers.CrossEncoder] = None,
+    use_cache: bool = True,
+) -> AsyncIterator[Tuple[str, List[Result]]]:
+    """
+    Runs a search in stages, yielding the results as each stage ends.
+    The "ranked" results come first, in the order of the first stage
+    retrieval, followed by the "reranked" results if a reranker is used
+    and finishes within its budget. Results found in the semantic cache
+    are yielded once as "cached". The last results yielded are final,
+    and are cached once the stages are done.
+    """
+    _, options, _ = cache_key
+
+    # Hybrid searches match stemmed lexemes, so only paraphrases that
+    # parse to the same lexical query share results
+    semantic_context = cache_key[1:]
+    if options.hybrid:
+        semantic_context += (
+            await parse_lexical_query(query, postgres_client, use_cache=use_cache),
+        )
+
+    # Embed the query
+    search_vector = await embed_query(query, model, use_cache=use_cache)
+
+    # A paraphrase of a recent search reuses its results, with snippets
+    # highlighting this query's terms
+    if use_cache:
+        cached = semantic_result_cache.get(search_vector, context=semantic_context)
+        if cached is not None:
+            results = [
+                result.model_copy(
+                    update=dict(
+                        zip(
+                            ("snippet", "snippetHighlights"),
+                            build_snippet(content, query),
+                        )
+                    )
+                )
+                for result, content in zip(*cached)
+            ]
+            search_result_cache.set(cache_key, results)
+            yield "cached", list(results)
+            return
+
+    # Diversified results are picked from a larger pool of candidates
+    diversify = options.diversity > 0 or options.site_limit > 0
+    candidate_limit = options.match_limit
+    if diversify:
+        candidate_limit *= MMR_OVERSAMPLING
+
+    # Get the best chunks of the best resources, and the best lexical
+    # matches at the same time
+    searches = [
+        fetch_grouped_matches(
+            vector_client,
+            search_vector,
+            limit=candidate_limit,
+            group_size=options.group_size,
+            query_filter=build_filter(options.filters),
+            with_vectors=options.diversity > 0,
+        )
+    ]
+
+    if options.hybrid:
+        searches.append(
+            fetch_lexical_matches(
+                query,
+                postgres_client,
+                limit=candidate_limit,
+                filters=options.filters,
+            )
+        )
+
+    groups, *lexical_matches = await asyncio.gather(*searches)
+
+    # Score each resource from its chunks
+    top_resources = [
+        (
+            group.id,
+            aggregate_scores(
+                [hit.score for hit in group.hits], options.aggregation
+            ),
+        )
+        for group in groups
+    ]
+
+    # Order the resources by their aggregated score
+    top_resources.sort(key=lambda x: x[1], reverse=True)
+
+    # The best chunk of each resource, preferring the vector match
+    best_chunks = {}
+    for group in groups:
+        best_chunks[group.id] = group.hits[0].payload.get("chunk", -1)
+
+    # Merge the vector and lexical rankings
+    if options.hybrid:
+        for resource_id, chunk, _ in lexical_matches[0]:
+            best_chunks.setdefault(resource_id, chunk)
+
+        top_resources = reciprocal_rank_fusion(
+            [
+                [resource_id for resource_id, _ in top_resources],
+                [resource_id for resource_id, _, _ in lexical_matches[0]],
+            ]
+        )[:candidate_limit]
+
+    # Get the resources' urls, page metadata and best chunks by primary key
+    rows = await postgres_client.fetch(
+        RESULTS_QUERY,
+        [resource_id for resource_id, _ in top_resources],
+        [best_chunks[resource_id] for resource_id, _ in top_resources],
+    )
+    rows = {row["id"]: row for row in rows}
+    # Blend in the authority of the resources from the link graph, it
+    # comes with the rows so it costs nothing extra
+    weight = options.authority_weight
+    top_resources = [
+        (resource_id, score + weight * rows[resource_id]["authority"] * abs(score))
+        for resource_id, score in top_resources
+        if resource_id in rows
+    ]
+    if weight > 0:
+        top_resources.sort(key=lambda x: x[1], reverse=True)
+
+    # Pick the results that add the most to the ones before them. Each
+    # resource is represented by its best chunk, resources only found by
+    # the lexical search don't have one and count as unlike the others
+    if diversify:
+        vectors = None
+        if options.diversity > 0:
+            best_vectors = {group.id: group.hits[0].vector for group in groups}
+            vectors = np.array(
+                [
+                    best_vectors.get(resource_id, np.zeros_like(search_vector))
+                    for resource_id, _ in top_resources
+                ],
+                dtype=np.float32,
+            )
+
+        sites = [
+            urlparse(rows[resource_id]["url"]).netloc
+            for resource_id, _ in top_resources
+        ]
+
+        order = maximal_marginal_relevance(
+            np.array([score for _, score in top_resources]),
+            vectors,
+            sites,
+            limit=options.match_limit,
+            diversity=options.diversity,
+            site_limit=options.site_limit,
+        )
+        top_resources = [top_resources[i] for i in order]
+
+    # Add the metadata and snippets to the results, and send them on
+    # while the reranker runs
+    top_urls = [
+        build_result(rows[resource_id], score, query)
+        for resource_id, score in top_resources
+    ]
+    contents = [rows[resource_id]["content"] or "" for resource_id, _ in top_resources]
+
+    yield "ranked", top_urls
+
+    # Reorder the best candidates with the cross encoder, if there's time
+    reranked = True
+    if options.rerank_top_n > 0 and reranker is not None:
+        candidates = top_resources[: options.rerank_top_n]
+
+        order = await rerank(
+            query,
+            contents[: len(candidates)],
+            reranker,
+            budget=options.rerank_budget,
+        )
+
+        if order is None:
+            reranked = False
+        else:
+            top_urls = [top_urls[i] for i in order] + top_urls[len(order) :]
+            contents = [contents[i] for i in order] + contents[len(order) :]
+            yield "reranked", top_urls
+
+    # Results that missed out on reranking are only kept for a short time
+    if use_cache:
+        ttl = None if reranked else UNRERANKED_CACHE_TTL
+        search_result_cache.set(cache_key, top_urls, ttl=ttl)
+        semantic_result_cache.set(
+            search_vector, (top_urls, contents), context=semantic_context, ttl=ttl
+        )
+
+
+async def rerank(
+    query: str,
+    texts: List[str],
+    reranker: sentence_transformers.CrossEncoder,
+    budget: float = 0.2,
+) -> Optional[List[int]]:
+    """
+    Scores each text against the query with a cross encoder, which
+    reads the query and text together and so ranks more precisely than
+    comparing embeddings. The model runs on the rerank executor's single
+    thread under a time budget. A rerank that runs out of time can't be
+    stopped, so reranking is skipped until it finishes.
+
+    Parameters
+    ----------
+    query : str
+        The query text.
+
+    texts : List[str]
+        The texts of the candidates to rerank.
+
+    reranker : sentence_transformers.CrossEncoder
+        The cross encoder to score the candidates with.
+
+    budget : float, optional
+        The maximum number of seconds to wait for the scores. Defaults
+        to 0.2.
+
+    Returns
+    -------
+    List[int] | None
+        The candidates' indexes from best to worst, or None if the
+        reranker was busy, the budget ran out or the model failed.
+    """
+    global _rerank_future
+
+    if not texts:
+        return []
+
+    if _rerank_future is not None and not _rerank_future.done():
+        print("Reranker is busy, using first stage order")
+
+        return None
+
+    _rerank_future = rerank_executor.submit(
+        reranker.predict, [(query, text) for text in texts]
+    )
+
+    try:
+        scores = await asyncio.wait_for(
+            asyncio.wrap_future(_rerank_future), timeout=budget
+        )
+
+    except asyncio.TimeoutError:
+        print("Reranking ran out of time, using first stage order")
+
+        return None
+
+    except Exception as e:
+        print("Reranking failed with error:", e)
+
+        return None
+
+    return [int(idx) for idx in np.argsort(-np.asarray(scores), kind="stable")]
+
+
+def build_result(row: asyncpg.Record, score: float, query: str) -> Result:
+    """
+    Builds a result from its row of the results query, with a snippet
+    of its best chunk highlighting the query's terms.
+
+    Parameters
+    ----------
+    row : asyncpg.Record
+        The resource's row of the results query.
+
+    score : float
+        The resource's score.
+
+    query : str
+        The query text.
+
+    Returns
+    -------
+    Result
+        The result.
+    """
+    snippet, highlights = build_snippet(row["content"] or "", query)
+
+    return Result(
+        title=row["title"],
+        siteName=row["site_name"],
+        url=row["url"],
+        snippet=snippet,
+        score=score,
+        faviconLocation=row["favicon"],
+        published=row["published"],
+        snippetHighlights=highlights,
+    )
+
+
+def build_snippet(
+    content: str,
+    query: str,
+    length: int = SNIPPET_LENGTH,
+) -> Tuple[str, List[Tuple[int, int]]]:
+    """
+    Builds a snippet from a result's best chunk. The snippet is the run
+    of words that contains the most query terms, and the positions of
+    the query terms in it are returned so they can be highlighted.
+
+    Parameters
+    ----------
+    content : str
+        The text of the chunk.
+
+    query : str
+        The query text.
+
+    length : int, optional
+        The number of words in the snippet. Defaults to 40.
+
+    Returns
+    -------
+    Tuple[str, List[Tuple[int, int]]]
+        The snippet and the start and end character positions of each
+        query term in it.
+    """
+    terms = set(query_terms(query))
+    words = content.split()
+
+    if not words:
+        return "", []
+
+    # Count the query terms in every window of words
+    matches = np.array(
+        [
+            any(token in terms for token in re.findall(r"\w+", word.lower()))
+            for word in words
+        ],
+        dtype=int,
+    )
+    window_counts = np.convolve(matches, np.ones(length, dtype=int), mode="valid")
+    start = int(np.argmax(window_counts)) if len(words) > length else 0
+
+    snippet = " ".join(words[start : start + length])
+
+    highlights = [
+        (match.start(), match.end())
+        for match in re.finditer(r"\w+", snippet)
+        if match.group().lower() in terms
+    ]
+
+    return snippet, highlights
+
+
+def query_terms(query: str) -> Tuple[str, ...]:
+    """
+    Splits a query into its distinct lowercase terms, which are the
+    words snippets highlight and the tokens lexical search matches.
+
+    Parameters
+    ----------
+    query : str
+        The query text.
+
+    Returns
+    -------
+    Tuple[str, ...]
+        The query's terms in sorted order.
     """
-    Search the qdrant database for the query and returns the
+    return tuple(sorted(set(re.findall(r"\w+", query.lower()))))
+
+
+def normalise_query(query: str) -> str:
     """
-    # Embed the query
-    search_vector = model.encode(query, convert_to_numpy=True)
+    Normalises a query so searches that only differ in case or spacing
+    share cache entries.
+
+    Parameters
+    ----------
+    query : str
+        The query text.
+
+    Returns
+    -------
+    str
+        The normalised query.
+    """
+    return " ".join(query.lower().split())
+
+
+def parse_query(query: str) -> Tuple[str, SearchFilters]:
+    """
+    Pulls the search operators out of a query. The operators are
+    site:, for pages of a site given by its domain or any of its urls,
+    after: and before:, for pages visited on or after and before an ISO
+    date, and type:, for a content type such as webpage. Sites and
+    types can be repeated to search any of them. Operators whose values
+    can't be read are left in the query text.
+
+    Parameters
+    ----------
+    query : str
+        The query text.
 
-    # Get the matches
-    matches = await fetch_matches(vector_client, search_vector, limit=limit)
+    Returns
+    -------
+    Tuple[str, SearchFilters]
+        The query text without its operators, and the filters they set.
+    """
+    sites, types, dates = [], [], {}
+
+    def pull_operator(match: re.Match) -> str:
+        operator, value = match.group(1).lower(), match.group(2)
+
+        if operator == "site":
+            sites.append((urlparse(value).netloc or value).lower())
+
+        elif operator == "type":
+            types.append(value.lower())
 
-    # Get the best urls by summing scores
-    urls = {}
-    for match in matches:
-        url = match.payload["text"]["url"]
-        if url in urls:
-            urls[url] += match.score
         else:
-            urls[url] = match.score
+            try:
+                date = datetime.fromisoformat(value)
+            except ValueError:
+                return match.group(0)
 
-    # Order the urls by summed score
-    top_urls = sorted(urls.items(), key=lambda x: x[1], reverse=True)
+            # Visit times are stored as naive times
+            if date.tzinfo is not None:
+                date = date.astimezone(timezone.utc).replace(tzinfo=None)
 
-    # Reduce the returned urls to the match limit
-    top_urls = top_urls[:match_limit]
+            dates[operator] = date
 
-    # Get the url strings for searching
-    top_url_strings = [url for url, _ in top_urls]
+        return ""
 
-    # Get the extra metadata
-    url_meta = await postgres_client.fetch(
-        "SELECT * FROM resources WHERE url = Any($1::text[])", top_url_strings
+    text = " ".join(QUERY_OPERATOR.sub(pull_operator, query).split())
+
+    filters = SearchFilters(
+        sites=tuple(sorted(set(sites))),
+        after=dates.get("after"),
+        before=dates.get("before"),
+        types=tuple(sorted(set(types))),
     )
 
-    # Add the metadata to the results and return
-    top_urls = [
-        Result(
-            title="",
-            siteName="",
-            url=url[0],
-            snippet="",
-            score=url[1],
-            faviconLocation="",
-            published="",
-        )
-        for url in top_urls
-    ]
+    return text, filters
+
+
+def build_filter(filters: SearchFilters) -> Optional[Filter]:
+    """
+    Turns search filters into a filter on the payloads of the chunks in
+    qdrant. Each condition is on an indexed payload field.
+
+    Parameters
+    ----------
+    filters : SearchFilters
+        The search filters.
+
+    Returns
+    -------
+    Optional[Filter]
+        The payload filter, or None if there are no filters.
+    """
+    conditions = []
+
+    if filters.sites:
+        conditions.append(
+            FieldCondition(key="site", match=MatchAny(any=list(filters.sites)))
+        )
+
+    if filters.types:
+        conditions.append(
+            FieldCondition(key="type", match=MatchAny(any=list(filters.types)))
+        )
+
+    if filters.after is not None or filters.before is not None:
+        conditions.append(
+            FieldCondition(
+                key="visited",
+                range=DatetimeRange(gte=filters.after, lt=filters.before),
+            )
+        )
+
+    if not conditions:
+        return None
+
+    return Filter(must=conditions)
+
+
+async def embed_query(
+    query: str,
+    model: sentence_transformers.SentenceTransformer | EncodingBatcher,
+    use_cache: bool = True,
+) -> np.ndarray:
+    """
+    Embeds a query with the model, reusing the embedding of an earlier
+    query with the same normalised text.
+
+    Parameters
+    ----------
+    query : str
+        The query text.
+
+    model : sentence_transformers.SentenceTransformer | EncodingBatcher
+        The model used to embed the query, or a batcher that encodes
+        it together with other concurrent queries.
+
+    use_cache : bool, optional
+        Look the embedding up in, and add it to, the query embedding
+        cache. Defaults to True.
+
+    Returns
+    -------
+    np.ndarray
+        The query's embedding.
+    """
+    query = normalise_query(query)
 
-    return top_urls
+    if use_cache:
+        search_vector = query_embedding_cache.get(query)
+        if search_vector is not None:
+            return search_vector
+
+    if isinstance(model, EncodingBatcher):
+        search_vector = await model.encode(query)
+    else:
+        search_vector = model.encode(query, convert_to_numpy=True)
+
+    if use_cache:
+        query_embedding_cache.set(query, search_vector)
+
+    return search_vector
 
 
 async def fetch_matches(
     vector_client: AsyncQdrantClient,
     search_vector: np.ndarray,
     limit: int = 50,
+    oversampling: float = 2.0,
 ) -> List[ScoredPoint]:
     """
-    Fetch the closest N matches from the qdrant vector database.
+    Fetch the closest N matches from the qdrant vector database. The
+    search runs over the quantized vectors and the best candidates are
+    rescored with the original vectors to keep recall close to an
+    unquantized search.
 
     Parameters
     ----------
@@ -92,6 +1306,10 @@ async def fetch_matches(
     limit : int, optional
         The maximum number of results to return. Defaults to 50.
 
+    oversampling : float, optional
+        How many times the limit of candidates to fetch from the
+        quantized vectors before rescoring. Defaults to 2.
+
     Returns
     -------
     List[ScoredPoint]
@@ -102,6 +1320,600 @@ async def fetch_matches(
         collection_name="embeddings",
         query_vector=search_vector,
         limit=limit,
+        search_params=SearchParams(
+            quantization=QuantizationSearchParams(
+                rescore=True,
+                oversampling=oversampling,
+            )
+        ),
     )
 
     return hits
+
+
+async def fetch_grouped_matches(
+    vector_client: AsyncQdrantClient,
+    search_vector: np.ndarray | RecommendQuery,
+    limit: int = 30,
+    group_size: int = 3,
+    oversampling: float = 2.0,
+    query_filter: Optional[Filter] = None,
+    with_vectors: bool = False,
+    group_by: str = "resource_id",
+) -> List[PointGroup]:
+    """
+    Fetch the closest matches from the qdrant vector database grouped by
+    resource, so each resource takes up one result no matter how many
+    of its chunks match.
+
+    Parameters
+    ----------
+    vector_client : QdrantClient
+        The Qdrant client to use for searching.
+
+    search_vector : np.ndarray | RecommendQuery
+        The vector to search for, or a recommend query for chunks like
+        stored ones.
+
+    limit : int, optional
+        The maximum number of resources to return. Defaults to 30.
+
+    group_size : int, optional
+        The maximum number of chunks returned for each resource.
+        Defaults to 3.
+
+    oversampling : float, optional
+        How many times the limit of candidates to fetch from the
+        quantized vectors before rescoring. Defaults to 2.
+
+    query_filter : Filter, optional
+        A filter on the chunks' payloads, applied during the search
+        using the payload indexes, see build_filter. Defaults to None.
+
+    with_vectors : bool, optional
+        Return the vectors of the chunks with them. Defaults to False.
+
+    group_by : str, optional
+        The payload field the chunks are grouped by. Defaults to
+        "resource_id".
+
+    Returns
+    -------
+    List[PointGroup]
+        The groups of best chunks, keyed by the group by field.
+    """
+    result = await vector_client.query_points_groups(
+        collection_name="embeddings",
+        query=search_vector,
+        group_by=group_by,
+        query_filter=query_filter,
+        limit=limit,
+        group_size=group_size,
+        with_vectors=with_vectors,
+        search_params=SearchParams(
+            quantization=QuantizationSearchParams(
+                rescore=True,
+                oversampling=oversampling,
+            )
+        ),
+    )
+
+    return result.groups
+
+
+def aggregate_scores(
+    scores: List[float],
+    aggregation: str = "sum",
+    temperature: float = 0.1,
+) -> float:
+    """
+    Combines the chunk scores of a resource into a single score.
+
+    Parameters
+    ----------
+    scores : List[float]
+        The scores of the resource's chunks.
+
+    aggregation : str, optional
+        Either "sum", which favours resources with many matching
+        chunks, "max", which only counts the best chunk, or "softmax",
+        a softmax weighted mean that sits between the two. Defaults to
+        "sum".
+
+    temperature : float, optional
+        The softmax temperature, lower values weight the best chunk
+        more heavily. Defaults to 0.1.
+
+    Returns
+    -------
+    float
+        The resource's score.
+
+    Raises
+    ------
+    ValueError
+        If the aggregation isn't recognised.
+    """
+    if aggregation == "sum":
+        return float(np.sum(scores))
+
+    if aggregation == "max":
+        return float(np.max(scores))
+
+    if aggregation == "softmax":
+        scores = np.asarray(scores)
+        weights = np.exp((scores - scores.max()) / temperature)
+        return float(np.sum(weights * scores) / np.sum(weights))
+
+    raise ValueError(f"Unknown score aggregation: {aggregation}")
+
+
+async def parse_lexical_query(
+    query: str,
+    postgres_client: asyncpg.Pool | asyncpg.Connection,
+    use_cache: bool = True,
+) -> str:
+    """
+    Parses a query into the tsquery lexical search matches it with, the
+    stemmed lexemes of its words less the stop words. Queries only made
+    of plain words parse to their lexemes in sorted order, so queries
+    that differ in word order, stop words or word endings parse the same.
+
+    Parameters
+    ----------
+    query : str
+        The query text, in web search syntax.
+
+    postgres_client : asyncpg.Pool | asyncpg.Connection
+        The PostgreSQL client to parse the query with.
+
+    use_cache : bool, optional
+        Look the parsed query up in, and add it to, the lexical query
+        cache. Defaults to True.
+
+    Returns
+    -------
+    str
+        The parsed query, in tsquery syntax.
+    """
+    query = normalise_query(query)
+
+    if use_cache:
+        lexical_query = lexical_query_cache.get(query)
+        if lexical_query is not None:
+            return lexical_query
+
+    lexical_query = await postgres_client.fetchval(LEXICAL_QUERY_QUERY, query)
+
+    # Lexemes that must all match can match in any order, while phrases,
+    # exclusions and alternatives keep their structure
+    lexemes = lexical_query.split(" & ")
+    if not any(re.search(r"[|!<()]", lexeme) for lexeme in lexemes):
+        lexical_query = " & ".join(sorted(set(lexemes)))
+
+    if use_cache:
+        lexical_query_cache.set(query, lexical_query)
+
+    return lexical_query
+
+
+async def fetch_lexical_matches(
+    query: str,
+    postgres_client: asyncpg.Pool | asyncpg.Connection,
+    limit: int = 30,
+    filters: Optional[SearchFilters] = None,
+) -> List[Tuple[int, int, float]]:
+    """
+    Full text search over the chunks stored in postgres, for finding
+    exact tokens the embeddings miss. Resources are ranked by their
+    best matching chunk, which is returned with them.
+
+    Parameters
+    ----------
+    query : str
+        The text to search for, in web search syntax, so quoted phrases
+        and -excluded words work.
+
+    postgres_client : asyncpg.Pool | asyncpg.Connection
+        The PostgreSQL client to search with.
+
+    limit : int, optional
+        The maximum number of resources to return. Defaults to 30.
+
+    filters : SearchFilters, optional
+        The sites, visit dates and content types to search within, see
+        parse_query. Defaults to None, no filters.
+
+    Returns
+    -------
+    List[Tuple[int, int, float]]
+        The resource ids, their best chunk and their ranks, best first.
+    """
+    filters = filters or SearchFilters()
+
+    # Only webpages have chunks to search
+    if filters.types and "webpage" not in filters.types:
+        return []
+
+    rows = await postgres_client.fetch(
+        LEXICAL_SEARCH_QUERY,
+        query,
+        limit,
+        list(filters.sites) or None,
+        filters.after,
+        filters.before,
+    )
+
+    return [(row["resource_id"], row["chunk"], row["rank"]) for row in rows]
+
+
+def reciprocal_rank_fusion(
+    rankings: List[List[int]],
+    k: int = RRF_K,
+) -> List[Tuple[int, float]]:
+    """
+    Merges several rankings of resources into one. Each resource scores
+    1 / (k + rank) for every ranking it appears in, so resources ranked
+    highly by more than one search rise to the top.
+
+    Parameters
+    ----------
+    rankings : List[List[int]]
+        The rankings to merge, each a list of resource ids best first.
+
+    k : int, optional
+        Damps the advantage of the very top ranks. Defaults to 60.
+
+    Returns
+    -------
+    List[Tuple[int, float]]
+        The resource ids and their fused scores, best first.
+    """
+    scores = {}
+    for ranking in rankings:
+        for rank, resource_id in enumerate(ranking, start=1):
+            scores[resource_id] = scores.get(resource_id, 0.0) + 1 / (k + rank)
+
+    return sorted(scores.items(), key=lambda x: x[1], reverse=True)
+
+
+def maximal_marginal_relevance(
+    scores: np.ndarray,
+    vectors: Optional[np.ndarray],
+    sites: List[str],
+    limit: int = 30,
+    diversity: float = 0.5,
+    site_limit: int = 0,
+) -> List[int]:
+    """
+    Picks a diverse set of results with maximal marginal relevance. The
+    results are picked one at a time, each being the one whose relevance
+    minus its similarity to the results already picked is highest. The
+    similarities are computed all at once as a cosine similarity matrix.
+
+    Parameters
+    ----------
+    scores : np.ndarray
+        The relevance score of each candidate, on any scale.
+
+    vectors : np.ndarray, optional
+        The vector of each candidate. Zero vectors count as unlike every
+        other candidate. Only needed if diversity is above 0.
+
+    sites : List[str]
+        The site of each candidate.
+
+    limit : int, optional
+        The number of results to pick. Defaults to 30.
+
+    diversity : float, optional
+        The weight of the similarity penalty against the relevance, from
+        0, ranking by relevance alone, to 1. Defaults to 0.5.
+
+    site_limit : int, optional
+        The maximum number of results picked from one site. Defaults to
+        0, no limit.
+
+    Returns
+    -------
+    List[int]
+        The positions of the picked candidates, in the order picked.
+    """
+    if len(scores) == 0:
+        return []
+
+    # Scale the relevance to the range of the cosine similarities
+    relevance = np.ones(len(scores))
+    spread = scores.max() - scores.min()
+    if spread > 0:
+        relevance = (scores - scores.min()) / spread
+
+    if diversity > 0:
+        norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+        unit_vectors = np.divide(
+            vectors, norms, out=np.zeros_like(vectors), where=norms > 0
+        )
+        similarity = unit_vectors @ unit_vectors.T
+    else:
+        similarity = np.zeros((len(scores), len(scores)))
+
+    max_similarity = np.zeros(len(scores))
+    available = np.ones(len(scores), dtype=bool)
+    sites = np.array(sites)
+    site_counts = {}
+
+    picked = []
+    while len(picked) < limit and available.any():
+        mmr = (1 - diversity) * relevance - diversity * max_similarity
+        choice = int(np.argmax(np.where(available, mmr, -np.inf)))
+
+        picked.append(choice)
+        available[choice] = False
+        max_similarity = np.maximum(max_similarity, similarity[choice])
+
+        # Drop the site's other candidates once it's full
+        site = sites[choice]
+        site_counts[site] = site_counts.get(site, 0) + 1
+        if site_limit > 0 and site_counts[site] >= site_limit:
+            available &= sites != site
+
+    return picked
+
+
+async def get_similar_pages(
+    vector_client: AsyncQdrantClient,
+    postgres_client: asyncpg.Pool | asyncpg.Connection,
+    url: Optional[str] = None,
+    point_id: Optional[str] = None,
+    limit: int = 10,
+    group_size: int = 3,
+    aggregation: str = "sum",
+    use_cache: bool = True,
+) -> List[Result]:
+    """
+    Finds the pages most like a stored page or chunk, using qdrant's
+    recommend API on the stored vectors so no query is encoded. A page
+    is represented by the average of its chunks' vectors. The matching
+    chunks are grouped by resource and scored like a search.
+
+    Parameters
+    ----------
+    vector_client : AsyncQdrantClient
+        The Qdrant client to search.
+
+    postgres_client : asyncpg.Pool | asyncpg.Connection
+        The PostgreSQL client the resources are looked up with.
+
+    url : str, optional
+        The url of the page to find pages like.
+
+    point_id : str, optional
+        The id of the chunk to find pages like, used if no url is given.
+
+    limit : int, optional
+        The maximum number of pages to return. Defaults to 10.
+
+    group_size : int, optional
+        The number of best chunks scored for each page. Defaults to 3.
+
+    aggregation : str, optional
+        How the chunk scores of a page are combined, see
+        aggregate_scores. Defaults to "sum".
+
+    use_cache : bool, optional
+        Reuse the results of the same request against the same index.
+        Defaults to True.
+
+    Returns
+    -------
+    List[Result]
+        The similar pages ordered from most to least similar, without
+        the page itself. Empty if the page has no stored chunks.
+
+    Raises
+    ------
+    ValueError
+        If neither a url nor a point id is given, or the point id isn't
+        a uuid.
+
+    LookupError
+        If the page, or the chunk and its page, isn't stored.
+    """
+    if url is None and point_id is None:
+        raise ValueError("A url or point id is needed")
+
+    # Qdrant rejects malformed ids, so they're caught before asking it
+    if url is None:
+        try:
+            uuid.UUID(point_id)
+        except ValueError as e:
+            raise ValueError("Malformed point id") from e
+
+    cache_key = (
+        "similar",
+        url,
+        point_id,
+        limit,
+        group_size,
+        aggregation,
+        get_index_generation(),
+    )
+
+    if use_cache:
+        results = search_result_cache.get(cache_key)
+        if results is not None:
+            return list(results)
+
+    # Find the chunks to recommend from, and the resource they're from
+    if url is not None:
+        resource_id = await postgres_client.fetchval(
+            "SELECT id FROM resources WHERE url = $1", url
+        )
+        if resource_id is None:
+            raise LookupError("Page not found")
+
+        points, _ = await vector_client.scroll(
+            collection_name="embeddings",
+            scroll_filter=Filter(
+                must=[
+                    FieldCondition(
+                        key="resource_id", match=MatchValue(value=resource_id)
+                    )
+                ]
+            ),
+            limit=MAX_RECOMMEND_POINTS,
+            with_payload=False,
+            with_vectors=False,
+        )
+        positive = [point.id for point in points]
+
+    else:
+        points = await vector_client.retrieve(
+            collection_name="embeddings", ids=[point_id], with_payload=True
+        )
+        if not points or points[0].payload.get("resource_id") is None:
+            raise LookupError("Chunk not found")
+
+        resource_id = points[0].payload["resource_id"]
+        positive = [point_id]
+
+    if not positive:
+        return []
+
+    groups = await fetch_grouped_matches(
+        vector_client,
+        RecommendQuery(
+            recommend=RecommendInput(
+                positive=positive, strategy=RecommendStrategy.AVERAGE_VECTOR
+            )
+        ),
+        limit=limit,
+        group_size=group_size,
+        query_filter=Filter(
+            must_not=[
+                FieldCondition(key="resource_id", match=MatchValue(value=resource_id))
+            ]
+        ),
+    )
+
+    top_resources = sorted(
+        (
+            (group.id, aggregate_scores([hit.score for hit in group.hits], aggregation))
+            for group in groups
+        ),
+        key=lambda x: x[1],
+        reverse=True,
+    )
+    best_chunks = {group.id: group.hits[0].payload.get("chunk", -1) for group in groups}
+
+    rows = await postgres_client.fetch(
+        RESULTS_QUERY,
+        [resource_id for resource_id, _ in top_resources],
+        [best_chunks[resource_id] for resource_id, _ in top_resources],
+    )
+    rows = {row["id"]: row for row in rows}
+
+    results = [
+        build_result(rows[resource_id], score, "")
+        for resource_id, score in top_resources
+        if resource_id in rows
+    ]
+
+    if use_cache:
+        search_result_cache.set(cache_key, results)
+
+    return list(results)
+
+
+async def get_similar_sites(
+    site: str,
+    vector_client: AsyncQdrantClient,
+    limit: int = 10,
+) -> List[Tuple[str, float]]:
+    """
+    Finds the sites most like a site, by searching for the chunks of
+    other sites closest to the site's centroid. No query is encoded.
+
+    Parameters
+    ----------
+    site : str
+        The domain of the site, or any url on it.
+
+    vector_client : AsyncQdrantClient
+        The Qdrant client to search.
+
+    limit : int, optional
+        The maximum number of sites to return. Defaults to 10.
+
+    Returns
+    -------
+    List[Tuple[str, float]]
+        The similar sites and the similarity of their closest chunk to
+        the site's centroid, most similar first. Empty if the site has
+        no stored chunks.
+    """
+    site = (urlparse(site).netloc or site).lower()
+
+    centroid = await get_site_centroid(site, vector_client)
+    if centroid is None:
+        return []
+
+    groups = await fetch_grouped_matches(
+        vector_client,
+        centroid,
+        limit=limit,
+        group_size=1,
+        query_filter=Filter(
+            must_not=[FieldCondition(key="site", match=MatchValue(value=site))]
+        ),
+        group_by="site",
+    )
+
+    return [(group.id, group.hits[0].score) for group in groups]
+
+
+async def get_site_centroid(
+    site: str,
+    vector_client: AsyncQdrantClient,
+) -> Optional[np.ndarray]:
+    """
+    Gets the mean vector of a site's chunks. Centroids are computed from
+    up to MAX_RECOMMEND_POINTS chunks the first time they're needed and
+    kept until the index changes.
+
+    Parameters
+    ----------
+    site : str
+        The domain of the site.
+
+    vector_client : AsyncQdrantClient
+        The Qdrant client the chunks are read from.
+
+    Returns
+    -------
+    Optional[np.ndarray]
+        The site's centroid, or None if it has no stored chunks.
+    """
+    cache_key = (site, get_index_generation())
+
+    centroid = site_centroid_cache.get(cache_key)
+    if centroid is not None:
+        return centroid
+
+    points, _ = await vector_client.scroll(
+        collection_name="embeddings",
+        scroll_filter=Filter(
+            must=[FieldCondition(key="site", match=MatchValue(value=site))]
+        ),
+        limit=MAX_RECOMMEND_POINTS,
+        with_payload=False,
+        with_vectors=True,
+    )
+
+    if not points:
+        return None
+
+    centroid = np.mean([point.vector for point in points], axis=0, dtype=np.float32)
+    site_centroid_cache.set(cache_key, centroid)
+
+    return centroid
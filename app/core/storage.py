@@ -6,18 +6,245 @@ Created:
     2024-09-19
 """
 
-from typing import List, Dict, Any
+from typing import List, Dict, Any, AsyncIterator, Optional, Tuple
 from qdrant_client import AsyncQdrantClient
-from qdrant_client.models import VectorParams, Distance, PointStruct
+from qdrant_client.models import (
+    VectorParams,
+    Distance,
+    Filter,
+    FieldCondition,
+    MatchValue,
+    HasIdCondition,
+    IsEmptyCondition,
+    PayloadField,
+    FilterSelector,
+    Batch,
+    PointsBatch,
+    UpsertOperation,
+    DeleteOperation,
+    UpdateOperation,
+    VectorParamsDiff,
+    HnswConfigDiff,
+    ScalarQuantization,
+    ScalarQuantizationConfig,
+    ScalarType,
+    BinaryQuantization,
+    BinaryQuantizationConfig,
+    QuantizationConfig,
+    PayloadSchemaType,
+    OptimizersConfigDiff,
+)
+from qdrant_client.http.exceptions import UnexpectedResponse
+import grpc
 import numpy as np
-from dataclasses import dataclass
+from dataclasses import dataclass, field
 from datetime import datetime
+from contextlib import asynccontextmanager
+import asyncio
 import asyncpg
-from uuid import uuid4
+from uuid import uuid4, uuid5, NAMESPACE_URL
 from urllib.parse import urlparse
+import joblib
+import os
 from app.models.data_types import CrawledUrl, PotentialUrl, SeedUrl
 from app.core.utility import check_url
 
+# Query used to write a single resource row, a revisit of a url that's
+# already stored updates its visit counters and links in place
+LOG_RESOURCE_QUERY = """INSERT INTO resources
+    (url, firstVisited, lastVisited, allVisits, externalLinks,
+        title, siteName, description, published, favicon)
+    VALUES ($1, $2, $3, $4, $5, $6, $7, $8, $9, $10)
+    ON CONFLICT (url) DO UPDATE SET
+        lastVisited = EXCLUDED.lastVisited,
+        allVisits = resources.allVisits + EXCLUDED.allVisits,
+        externalLinks = EXCLUDED.externalLinks,
+        title = EXCLUDED.title,
+        siteName = EXCLUDED.siteName,
+        description = EXCLUDED.description,
+        published = EXCLUDED.published,
+        favicon = EXCLUDED.favicon"""
+
+# Query used to write the text chunks of pages, matched to their
+# resources by url. A revisit overwrites the page's chunks in place
+WRITE_CHUNKS_QUERY = """INSERT INTO chunks (resource_id, chunk, content)
+    SELECT resources.id, page.chunk, page.content
+    FROM unnest($1::text[], $2::int[], $3::text[]) AS page (url, chunk, content)
+    JOIN resources ON resources.url = page.url
+    ON CONFLICT (resource_id, chunk) DO UPDATE SET content = EXCLUDED.content"""
+
+# Query used to delete the chunks a shorter version of a page no longer
+# has, given each page's url and number of chunks
+DELETE_STALE_CHUNKS_QUERY = """DELETE FROM chunks
+    USING resources, unnest($1::text[], $2::int[]) AS page (url, chunks)
+    WHERE resources.url = page.url
+        AND chunks.resource_id = resources.id
+        AND chunks.chunk >= page.chunks"""
+
+# Table holding the text of each page's chunks, the tsv column is kept up
+# to date by postgres for lexical search
+CHUNKS_TABLE = """CREATE TABLE IF NOT EXISTS chunks (
+    resource_id INT NOT NULL REFERENCES resources (id) ON DELETE CASCADE,
+    chunk INT NOT NULL,
+    content TEXT NOT NULL,
+    tsv TSVECTOR GENERATED ALWAYS AS (to_tsvector('english', content)) STORED,
+    PRIMARY KEY (resource_id, chunk)
+)"""
+
+CHUNKS_INDEX = "CREATE INDEX IF NOT EXISTS chunks_tsv_idx ON chunks USING GIN (tsv)"
+
+# Query used to record sightings of potential urls, given the urls, the
+# times they were first seen and how many times they've been seen since
+# the last write
+LOG_POTENTIAL_URLS_QUERY = """INSERT INTO potential_urls (url, firstSeen, timesSeen)
+    SELECT * FROM unnest($1::text[], $2::timestamp[], $3::int[])
+    ON CONFLICT (url) DO UPDATE SET
+        timesSeen = potential_urls.timesSeen + EXCLUDED.timesSeen"""
+
+# Longest potential url the potential_urls table can store
+MAX_POTENTIAL_URL_LENGTH = 2048
+
+# Table of the links between crawled pages, by their resource ids
+LINKS_TABLE = """CREATE TABLE IF NOT EXISTS links (
+    source_id INT NOT NULL REFERENCES resources (id) ON DELETE CASCADE,
+    target_id INT NOT NULL REFERENCES resources (id) ON DELETE CASCADE,
+    PRIMARY KEY (source_id, target_id)
+)"""
+
+# Query used to fill the links table from each page's external links,
+# keeping the links that point at other crawled pages
+REBUILD_LINKS_QUERY = """INSERT INTO links (source_id, target_id)
+    SELECT DISTINCT resources.id, targets.id
+    FROM resources
+    CROSS JOIN LATERAL unnest(resources.externalLinks) AS link (url)
+    JOIN resources AS targets ON targets.url = link.url
+    WHERE targets.id <> resources.id"""
+
+# Idempotent schema changes applied to existing databases on startup
+POSTGRES_MIGRATIONS = [
+    # Keep one row per url, the first one logged, with the visits of
+    # all of them before indexing. Only needed until the index exists
+    """DO $$ BEGIN
+        IF to_regclass('resources_url_key') IS NULL THEN
+            UPDATE resources SET
+                firstVisited = totals.firstVisited,
+                lastVisited = totals.lastVisited,
+                allVisits = totals.allVisits
+            FROM (
+                SELECT min(id) AS id,
+                    min(firstVisited) AS firstVisited,
+                    max(lastVisited) AS lastVisited,
+                    sum(allVisits) AS allVisits
+                FROM resources GROUP BY url HAVING count(*) > 1
+            ) AS totals
+            WHERE resources.id = totals.id;
+
+            DELETE FROM resources a USING resources b
+                WHERE a.url = b.url AND a.id > b.id;
+        END IF;
+    END $$""",
+    "CREATE UNIQUE INDEX IF NOT EXISTS resources_url_key ON resources (url)",
+    # Text of each page's chunks with a full text search index
+    CHUNKS_TABLE,
+    CHUNKS_INDEX,
+    # Chunk offsets were stored but never read
+    "ALTER TABLE chunks DROP COLUMN IF EXISTS start_offset",
+    # Compress chunk text with lz4, which is much faster than the default
+    # pglz. Servers built without lz4 keep pglz
+    """DO $$ BEGIN
+        ALTER TABLE chunks ALTER COLUMN content SET COMPRESSION lz4;
+    EXCEPTION WHEN OTHERS THEN
+        RAISE NOTICE 'Keeping pglz compression for chunks: %', SQLERRM;
+    END $$""",
+    # Page metadata shown with search results
+    """ALTER TABLE resources
+        ADD COLUMN IF NOT EXISTS title TEXT,
+        ADD COLUMN IF NOT EXISTS siteName TEXT,
+        ADD COLUMN IF NOT EXISTS description TEXT,
+        ADD COLUMN IF NOT EXISTS published TIMESTAMP,
+        ADD COLUMN IF NOT EXISTS favicon TEXT""",
+    # Link graph between pages and the authority ranked from it
+    LINKS_TABLE,
+    """ALTER TABLE resources
+        ADD COLUMN IF NOT EXISTS authority DOUBLE PRECISION NOT NULL DEFAULT 0""",
+    # Keep one row per potential url, with the first sighting and all
+    # the sightings counted, before indexing. Only needed until the
+    # index exists
+    """CREATE TABLE IF NOT EXISTS potential_urls (
+        id SERIAL PRIMARY KEY,
+        url VARCHAR(2048) NOT NULL,
+        firstSeen TIMESTAMP NOT NULL,
+        timesSeen INT DEFAULT 1
+    )""",
+    """DO $$ BEGIN
+        IF to_regclass('potential_urls_url_key') IS NULL THEN
+            UPDATE potential_urls SET
+                firstSeen = totals.firstSeen,
+                timesSeen = totals.timesSeen
+            FROM (
+                SELECT min(id) AS id,
+                    min(firstSeen) AS firstSeen,
+                    sum(timesSeen) AS timesSeen
+                FROM potential_urls GROUP BY url HAVING count(*) > 1
+            ) AS totals
+            WHERE potential_urls.id = totals.id;
+
+            DELETE FROM potential_urls a USING potential_urls b
+                WHERE a.url = b.url AND a.id > b.id;
+        END IF;
+    END $$""",
+    """CREATE UNIQUE INDEX IF NOT EXISTS potential_urls_url_key
+        ON potential_urls (url)""",
+]
+
+# Payload fields indexed in the embeddings collection and their types
+PAYLOAD_INDEXES = {
+    "resource_id": PayloadSchemaType.INTEGER,
+    "site": PayloadSchemaType.KEYWORD,
+    "type": PayloadSchemaType.KEYWORD,
+    "visited": PayloadSchemaType.DATETIME,
+}
+
+# Selects points stored with the payload schema used before resource ids,
+# which kept the page's url under "text". Search can't group them by page
+# and revisits can't replace them, so they're dropped on start up and
+# the pages are embedded again when they're next crawled
+LEGACY_POINTS_SELECTOR = FilterSelector(
+    filter=Filter(
+        must_not=[IsEmptyCondition(is_empty=PayloadField(key="text.url"))]
+    )
+)
+
+# Qdrant's default indexing threshold, restored after bulk ingest if the
+# collection doesn't report its own, and on start up in case a crash
+# during bulk ingest left indexing turned off
+BULK_INGEST_DEFAULT_THRESHOLD = 20000
+
+# Postgres errors caused by a row's own values, which fail however many
+# times the row is retried
+REJECTED_ROW_ERRORS = (
+    asyncpg.exceptions.DataError,
+    asyncpg.exceptions.IntegrityConstraintViolationError,
+    asyncpg.exceptions.ProgramLimitExceededError,
+)
+
+# Client error statuses that could succeed on a retry, any other client
+# error means qdrant will never accept the batch
+RETRYABLE_CLIENT_ERRORS = {404, 408, 409, 429}
+
+# gRPC statuses qdrant rejects invalid requests with, used instead of the
+# client error statuses when the client prefers gRPC
+REJECTED_GRPC_STATUSES = {
+    grpc.StatusCode.INVALID_ARGUMENT,
+    grpc.StatusCode.FAILED_PRECONDITION,
+    grpc.StatusCode.OUT_OF_RANGE,
+    grpc.StatusCode.UNIMPLEMENTED,
+}
+
+# Counts the changes made to the embeddings collection, so anything
+# cached from an older version of the index can be told apart
+_index_generation = 0
+
 
 @dataclass
 class Resource:
@@ -26,15 +253,591 @@ class Resource:
     lastVisited: datetime
     allVisits: int
     externalLinks: List[str]
+    chunks: List[str] = field(default_factory=list)
+    title: str = ""
+    siteName: str = ""
+    description: str = ""
+    published: Optional[datetime] = None
+    favicon: str = ""
+
+
+async def create_postgres_pool(
+    min_size: int = 2,
+    max_size: int = 10,
+    **connect_kwargs,
+) -> asyncpg.Pool:
+    """
+    Creates a pool of PostgreSQL connections. Each query run against
+    the pool borrows its own connection, so searches, admin requests
+    and a running crawl can all use the database at the same time.
+
+    Parameters
+    ----------
+    min_size : int, optional
+        The number of connections the pool opens on creation and
+        keeps open. Defaults to 2.
+
+    max_size : int, optional
+        The maximum number of connections the pool will open.
+        Defaults to 10.
+
+    connect_kwargs : dict
+        The connection details passed through to asyncpg, e.g.
+        database, user, password, host and port.
+
+    Returns
+    -------
+    asyncpg.Pool
+        The connection pool.
+    """
+    return await asyncpg.create_pool(
+        min_size=min_size,
+        max_size=max_size,
+        **connect_kwargs,
+    )
+
+
+async def migrate_postgres(
+    db_client: asyncpg.Pool | asyncpg.Connection,
+):
+    """
+    Brings an existing database up to the current schema by running
+    each of the postgres migrations in a single transaction. All the
+    migrations are safe to run more than once.
+
+    Parameters
+    ----------
+    db_client : asyncpg.Pool | asyncpg.Connection
+        The PostgreSQL client to migrate the database with.
+    """
+    async with acquire_connection(db_client) as connection:
+        async with connection.transaction():
+            for migration in POSTGRES_MIGRATIONS:
+                await connection.execute(migration)
+
+
+@asynccontextmanager
+async def acquire_connection(
+    db_client: asyncpg.Pool | asyncpg.Connection,
+) -> AsyncIterator[asyncpg.Connection]:
+    """
+    Provides a single connection for work that needs several queries
+    to run on the same connection. A pool lends out one of its
+    connections for the duration of the block, a plain connection is
+    used as is.
+
+    Parameters
+    ----------
+    db_client : asyncpg.Pool | asyncpg.Connection
+        The PostgreSQL pool or connection to take a connection from.
+
+    Yields
+    ------
+    asyncpg.Connection
+        The connection to run queries with.
+    """
+    if isinstance(db_client, asyncpg.Pool):
+        async with db_client.acquire() as connection:
+            yield connection
+    else:
+        yield db_client
+
+
+def quantization_config(
+    quantization: str = "scalar",
+) -> Optional[QuantizationConfig]:
+    """
+    Creates the quantization config for the embeddings collection. The
+    quantized vectors are kept in RAM for searching while the original
+    float32 vectors live on disk and are only read to rescore the best
+    candidates.
+
+    Parameters
+    ----------
+    quantization : str, optional
+        Either "scalar" for int8 quantization (4x smaller, very close
+        recall), "binary" for 1 bit quantization (32x smaller, needs
+        more rescoring) or "none". Defaults to "scalar".
+
+    Returns
+    -------
+    QuantizationConfig | None
+        The quantization config, or None for no quantization.
+
+    Raises
+    ------
+    ValueError
+        If the quantization type isn't recognised.
+    """
+    if quantization == "scalar":
+        return ScalarQuantization(
+            scalar=ScalarQuantizationConfig(
+                type=ScalarType.INT8,
+                quantile=0.99,
+                always_ram=True,
+            )
+        )
+
+    if quantization == "binary":
+        return BinaryQuantization(
+            binary=BinaryQuantizationConfig(always_ram=True)
+        )
+
+    if quantization == "none":
+        return None
+
+    raise ValueError(f"Unknown quantization type: {quantization}")
+
+
+async def setup_collection(
+    vector_client: AsyncQdrantClient,
+    vector_size: int = 384,
+    quantization: str = "scalar",
+    hnsw_m: int = 16,
+    hnsw_ef_construct: int = 100,
+    indexing_threshold: int = BULK_INGEST_DEFAULT_THRESHOLD,
+) -> bool:
+    """
+    Creates the embeddings collection with the managed schema if it
+    doesn't exist, or migrates an existing collection to it. The schema
+    stores the original vectors and payloads on disk, keeps quantized
+    vectors and the HNSW graph in RAM, and indexes the payload fields
+    in PAYLOAD_INDEXES. Safe to run on every start up, it also turns
+    indexing back on if the last bulk ingest never finished and deletes
+    any points stored with the legacy url payload.
+
+    Parameters
+    ----------
+    vector_client : AsyncQdrantClient
+        The Qdrant client to set the collection up with.
+
+    vector_size : int, optional
+        The size of the embedding vectors. Defaults to 384.
+
+    quantization : str, optional
+        The quantization to use, see quantization_config. Defaults to
+        "scalar".
+
+    hnsw_m : int, optional
+        The number of edges per node in the HNSW graph. Defaults to 16.
+
+    hnsw_ef_construct : int, optional
+        The number of neighbours considered when building the HNSW
+        graph. Defaults to 100.
+
+    indexing_threshold : int, optional
+        The number of unindexed vectors a segment holds before qdrant
+        builds its HNSW graph. Defaults to qdrant's default threshold.
+
+    Returns
+    -------
+    bool
+        True if the collection was created, False if an existing
+        collection was migrated.
+    """
+    hnsw_config = HnswConfigDiff(
+        m=hnsw_m,
+        ef_construct=hnsw_ef_construct,
+        on_disk=False,
+    )
+    optimizers_config = OptimizersConfigDiff(indexing_threshold=indexing_threshold)
+
+    exists = await vector_client.collection_exists("embeddings")
+
+    if not exists:
+        await vector_client.create_collection(
+            collection_name="embeddings",
+            vectors_config=VectorParams(
+                size=vector_size,
+                distance=Distance.COSINE,
+                on_disk=True,
+            ),
+            hnsw_config=hnsw_config,
+            quantization_config=quantization_config(quantization),
+            optimizers_config=optimizers_config,
+            on_disk_payload=True,
+        )
+
+    else:
+        # Qdrant rebuilds the changed parts of the index in the background.
+        # Resetting the threshold undoes a bulk ingest that never ended
+        await vector_client.update_collection(
+            collection_name="embeddings",
+            vectors_config={"": VectorParamsDiff(on_disk=True)},
+            hnsw_config=hnsw_config,
+            quantization_config=quantization_config(quantization),
+            optimizers_config=optimizers_config,
+        )
+
+    # Add any missing payload indexes
+    for field_name, field_schema in PAYLOAD_INDEXES.items():
+        await vector_client.create_payload_index(
+            collection_name="embeddings",
+            field_name=field_name,
+            field_schema=field_schema,
+        )
+
+    # Drop points search and revisits can no longer reach
+    if exists:
+        await vector_client.delete(
+            collection_name="embeddings",
+            points_selector=LEGACY_POINTS_SELECTOR,
+            wait=True,
+        )
+
+    return not exists
+
+
+async def begin_bulk_ingest(vector_client: AsyncQdrantClient) -> int:
+    """
+    Turns off HNSW indexing for the embeddings collection so points are
+    only appended to segments while a large crawl is running, instead
+    of being added to the graph one by one. Searches still work, they
+    just scan the unindexed segments.
+
+    Parameters
+    ----------
+    vector_client : AsyncQdrantClient
+        The Qdrant client the embeddings are stored with.
+
+    Returns
+    -------
+    int
+        The collection's indexing threshold before bulk ingest started,
+        which should be passed to end_bulk_ingest.
+    """
+    collection = await vector_client.get_collection("embeddings")
+    indexing_threshold = collection.config.optimizer_config.indexing_threshold
+
+    # A threshold of 0 disables indexing
+    await vector_client.update_collection(
+        collection_name="embeddings",
+        optimizers_config=OptimizersConfigDiff(indexing_threshold=0),
+    )
+
+    return indexing_threshold or BULK_INGEST_DEFAULT_THRESHOLD
+
+
+async def end_bulk_ingest(
+    vector_client: AsyncQdrantClient,
+    indexing_threshold: int = BULK_INGEST_DEFAULT_THRESHOLD,
+):
+    """
+    Restores indexing for the embeddings collection after bulk ingest.
+    Qdrant then builds the HNSW graph for the ingested segments in a
+    single optimize pass in the background.
+
+    Parameters
+    ----------
+    vector_client : AsyncQdrantClient
+        The Qdrant client the embeddings are stored with.
+
+    indexing_threshold : int, optional
+        The indexing threshold to restore, as returned by
+        begin_bulk_ingest. Defaults to Qdrant's default threshold.
+    """
+    await vector_client.update_collection(
+        collection_name="embeddings",
+        optimizers_config=OptimizersConfigDiff(
+            indexing_threshold=indexing_threshold
+        ),
+    )
+
+
+async def rebuild_links(db_client: asyncpg.Pool | asyncpg.Connection) -> bool:
+    """
+    Rebuilds the links table from the external links of every resource
+    in one set based query. Links to pages that haven't been crawled
+    are left out. Run at the end of a bulk ingest, once the pages being
+    linked to have been logged.
+
+    Parameters
+    ----------
+    db_client : asyncpg.Pool | asyncpg.Connection
+        The PostgreSQL client the resources are stored with.
+
+    Returns
+    -------
+    bool
+        True if the links were rebuilt successfully, False otherwise.
+    """
+    try:
+        async with acquire_connection(db_client) as connection:
+            async with connection.transaction():
+                await connection.execute("DELETE FROM links")
+                await connection.execute(REBUILD_LINKS_QUERY)
+
+        return True
+
+    except Exception as e:
+        print("Failed to rebuild links with error:", e)
+
+        return False
+
+
+def get_index_generation() -> int:
+    """
+    Gets the current generation of the embeddings index. It changes
+    whenever embeddings are written to the index.
+
+    Returns
+    -------
+    int
+        The index generation.
+    """
+    return _index_generation
+
+
+def bump_index_generation():
+    """
+    Moves the embeddings index on to a new generation, call after
+    writing to the index.
+    """
+    global _index_generation
+
+    _index_generation += 1
+
+
+def point_id(url: str, chunk: int) -> str:
+    """
+    Creates the qdrant point id for a chunk of a page. The id is derived
+    from the url and the chunk's position on the page, so storing a
+    page again overwrites its previous points rather than adding more.
+
+    Parameters
+    ----------
+    url : str
+        The url of the page the chunk came from.
+
+    chunk : int
+        The position of the chunk on the page.
+
+    Returns
+    -------
+    str
+        The point id as a uuid string.
+    """
+    return str(uuid5(NAMESPACE_URL, f"{url}#{chunk}"))
+
+
+def point_columns(
+    vector: np.ndarray | List[np.ndarray] | List[float] | List[List[float]],
+    metadata: Dict[str, Any] | List[Dict[str, Any]],
+) -> Tuple[List[str], np.ndarray, List[Dict[str, Any]]]:
+    """
+    Splits vectors and their metadata into the columns of a qdrant
+    batch: point ids, an array of vectors and payloads. Metadata
+    with a url gets point ids derived from the url and chunk position,
+    and the chunk position is added to its payload.
+
+    Parameters
+    ----------
+    vector : np.ndarray | List[np.ndarray]
+        A single vector, or a 2D array or list of vectors. Length must
+        be equal to the number of metadata items.
+
+    metadata : Dict[str, Any] | List[Dict[str, Any]]
+        The metadata to store with the vector. Length must be equal
+        to the number of vectors.
+
+    Returns
+    -------
+    Tuple[List[str], np.ndarray, List[Dict[str, Any]]]
+        The point ids, vectors and payloads. Payloads still hold their
+        url, see compact_payload.
+
+    Raises
+    ------
+    ValueError
+        If the length of the vector and metadata are not equal.
+    """
+    vectors = np.asarray(vector)
+
+    # A single vector is a batch of one
+    if vectors.ndim == 1 and vectors.size:
+        vectors = vectors[np.newaxis]
+
+    if not isinstance(metadata, list):
+        metadata = [metadata]
+
+    if len(vectors) != len(metadata):
+        raise ValueError("Vector and metadata must be the same length.")
+
+    ids = []
+    payloads = []
+    for idx, meta in enumerate(metadata):
+
+        # Pages get stable ids so revisits replace their old points
+        if meta.get("url") is None:
+            ids.append(uuid4().hex)
+            payloads.append(meta)
+
+        else:
+            ids.append(point_id(meta["url"], idx))
+            payloads.append({**meta, "chunk": idx})
+
+    return ids, vectors, payloads
+
+
+def compact_payload(
+    payload: Dict[str, Any],
+    resource_ids: Dict[str, int],
+) -> Dict[str, Any]:
+    """
+    Swaps the url in a point's payload for the id of its row in the
+    resources table, so the url isn't repeated on every chunk of a
+    page. Payloads without a url are returned unchanged.
+
+    Parameters
+    ----------
+    payload : Dict[str, Any]
+        The payload of the point.
+
+    resource_ids : Dict[str, int]
+        The resource ids of the stored urls, see get_resource_ids.
+
+    Returns
+    -------
+    Dict[str, Any]
+        The compact payload.
+
+    Raises
+    ------
+    ValueError
+        If the payload's url has no stored resource.
+    """
+    if "url" not in payload:
+        return payload
+
+    payload = dict(payload)
+    url = payload.pop("url")
+
+    if url not in resource_ids:
+        raise ValueError(f"No resource is stored for url: {url}")
+
+    payload["resource_id"] = resource_ids[url]
+
+    return payload
+
+
+def build_batch(
+    vector: np.ndarray | List[np.ndarray] | List[float] | List[List[float]],
+    metadata: Dict[str, Any] | List[Dict[str, Any]],
+    resource_ids: Optional[Dict[str, int]] = None,
+) -> Batch:
+    """
+    Turns vectors and their metadata into a columnar batch of qdrant
+    points. The vectors are converted from numpy in a single call
+    rather than a list being built for every point.
+
+    Parameters
+    ----------
+    vector : np.ndarray | List[np.ndarray]
+        A single vector, or a 2D array or list of vectors. Length must
+        be equal to the number of metadata items.
+
+    metadata : Dict[str, Any] | List[Dict[str, Any]]
+        The metadata to store with the vector. Length must be equal
+        to the number of vectors.
+
+    resource_ids : Dict[str, int], optional
+        The resource ids of the urls in the metadata. Only needed if
+        the metadata has urls.
+
+    Returns
+    -------
+    Batch
+        The points ready to be upserted.
+
+    Raises
+    ------
+    ValueError
+        If the length of the vector and metadata are not equal, or a
+        url in the metadata has no resource id.
+    """
+    ids, vectors, payloads = point_columns(vector, metadata)
+
+    payloads = [
+        compact_payload(payload, resource_ids or {}) for payload in payloads
+    ]
+
+    return Batch(ids=ids, vectors=vectors.tolist(), payloads=payloads)
+
+
+def stale_points_selector(
+    resource_id: int,
+    point_ids: List[str],
+) -> FilterSelector:
+    """
+    Selects the points stored for a resource that aren't in the given
+    list of point ids, i.e. those left over from an older version of
+    the page.
+
+    Parameters
+    ----------
+    resource_id : int
+        The id of the page in the resources table.
+
+    point_ids : List[str]
+        The ids of the page's current points.
+
+    Returns
+    -------
+    FilterSelector
+        The selector to delete the stale points with.
+    """
+    return FilterSelector(
+        filter=Filter(
+            must=[
+                FieldCondition(
+                    key="resource_id", match=MatchValue(value=resource_id)
+                )
+            ],
+            must_not=[HasIdCondition(has_id=point_ids)],
+        )
+    )
+
+
+async def get_resource_ids(
+    urls: List[str],
+    db_client: asyncpg.Pool | asyncpg.Connection,
+) -> Dict[str, int]:
+    """
+    Looks up the ids of the resources stored for a list of urls.
+
+    Parameters
+    ----------
+    urls : List[str]
+        The urls to look up.
+
+    db_client : asyncpg.Pool | asyncpg.Connection
+        The PostgreSQL client.
+
+    Returns
+    -------
+    Dict[str, int]
+        The resource id of each url, urls with no resource are left
+        out.
+    """
+    rows = await db_client.fetch(
+        "SELECT id, url FROM resources WHERE url = ANY($1::text[])", urls
+    )
+
+    return {row["url"]: row["id"] for row in rows}
 
 
 async def store_embedding(
     vector: np.ndarray | List[np.ndarray] | List[float] | List[List[float]],
     metadata: Dict[str, Any] | List[Dict[str, Any]],
     vector_client: AsyncQdrantClient,
+    db_client: Optional[asyncpg.Pool | asyncpg.Connection] = None,
 ) -> bool:
     """
-    Stores data in the qdrant database.
+    Stores data in the qdrant database. Metadata with a url is stored
+    under point ids derived from the url and chunk position, with the
+    url replaced by the id of its resource, and any older points for
+    that resource left over from a longer version of the page are
+    deleted.
 
     Parameters
     ----------
@@ -49,6 +852,11 @@ async def store_embedding(
     vector_client : QdrantClient
         The Qdrant client to use for storing the data.
 
+    db_client : asyncpg.Pool | asyncpg.Connection, optional
+        The PostgreSQL client used to look up the resource ids of the
+        urls in the metadata. The resources must already be logged.
+        Only needed if the metadata has urls.
+
     Returns
     -------
     bool
@@ -59,41 +867,39 @@ async def store_embedding(
     ValueError
         If the length of the vector and metadata are not equal.
     """
-    # Vector and metadata must be lists for for loop
-    if not isinstance(vector, list):
-        vector = [vector]
-
-    if not isinstance(metadata, list):
-        metadata = [metadata]
-
-    if len(vector) != len(metadata):
-        raise ValueError("Vector and metadata must be the same length.")
-
-    # Store embedded vectors and metadata in qdrant
-    points = []
-    for idx, vector in enumerate(vector):
-
-        # Create a qdrant point struct
-        points.append(
-            PointStruct(
-                id=uuid4().hex,
-                vector=(
-                    vector.tolist()
-                    if isinstance(vector, np.ndarray)
-                    else vector
-                ),
-                payload={"text": metadata[idx]},
-            )
-        )
+    ids, vectors, payloads = point_columns(vector, metadata)
 
     # Store points in qdrant
     try:
+        urls = list({payload["url"] for payload in payloads if "url" in payload})
+        resource_ids = await get_resource_ids(urls, db_client) if urls else {}
+
         await vector_client.upsert(
             collection_name="embeddings",
-            points=points,
+            points=Batch(
+                ids=ids,
+                vectors=vectors.tolist(),
+                payloads=[
+                    compact_payload(payload, resource_ids)
+                    for payload in payloads
+                ],
+            ),
             wait=True,
         )
 
+        # Only changes to the index make cached results out of date
+        bump_index_generation()
+
+        # Delete the stale points of each page that aren't overwritten
+        for url in urls:
+            await vector_client.delete(
+                collection_name="embeddings",
+                points_selector=stale_points_selector(resource_ids[url], ids),
+                wait=True,
+            )
+
+            bump_index_generation()
+
     except Exception as e:
         print(e)
 
@@ -102,20 +908,429 @@ async def store_embedding(
     return True
 
 
+class EmbeddingWriter:
+    """
+    Write-behind queue for embeddings. Pages added to the writer are
+    batched together and sent to qdrant without waiting for indexing
+    to finish, with a limit on how many batches are in flight at once.
+    Batches that fail to send are saved to a local outbox directory
+    and retried until qdrant accepts them, so a qdrant restart doesn't
+    lose any vectors. A page's points are sent once its resource has
+    been written to postgres, so they can carry its resource id.
+
+    Parameters
+    ----------
+    vector_client : AsyncQdrantClient
+        The Qdrant client to send the embeddings to.
+
+    db_client : asyncpg.Pool | asyncpg.Connection, optional
+        The PostgreSQL client used to look up the pages' resource ids.
+        Only needed if the pages' metadata has urls.
+
+    resource_writer : ResourceWriter, optional
+        The buffer the pages' resources are written with. It's flushed
+        before the resource ids are looked up.
+
+    batch_size : int, optional
+        The number of buffered points that triggers a flush. Defaults
+        to 256.
+
+    flush_interval : float, optional
+        The maximum number of seconds a page waits in the buffer before
+        it's flushed. Failed batches in the outbox are retried on the
+        same interval. Defaults to 2 seconds.
+
+    max_concurrency : int, optional
+        The maximum number of batches sent to qdrant at the same time.
+        Defaults to 4.
+
+    outbox_dir : str, optional
+        The directory failed batches are saved to. Defaults to
+        "qdrant_outbox" in the working directory. Batches that can't be
+        read or that qdrant rejects outright are moved to its
+        "dead_letter" folder so they don't hold up the rest.
+    """
+
+    def __init__(
+        self,
+        vector_client: AsyncQdrantClient,
+        db_client: Optional[asyncpg.Pool | asyncpg.Connection] = None,
+        resource_writer: Optional["ResourceWriter"] = None,
+        batch_size: int = 256,
+        flush_interval: float = 2.0,
+        max_concurrency: int = 4,
+        outbox_dir: str = "qdrant_outbox",
+    ):
+        self._vector_client = vector_client
+        self._db_client = db_client
+        self._resource_writer = resource_writer
+        self._batch_size = batch_size
+        self._flush_interval = flush_interval
+        self._semaphore = asyncio.Semaphore(max_concurrency)
+        self._outbox_dir = outbox_dir
+        self._ids: List[str] = []
+        self._vectors: List[np.ndarray] = []
+        self._payloads: List[Dict[str, Any]] = []
+        self._pages: Dict[str, List[str]] = {}
+        self._lock = asyncio.Lock()
+        self._outbox_lock = asyncio.Lock()
+        self._send_tasks: set[asyncio.Task] = set()
+        self._flush_task: Optional[asyncio.Task] = None
+        self._closed = False
+
+        os.makedirs(outbox_dir, exist_ok=True)
+
+    def start(self):
+        """
+        Starts the background task that flushes the buffer and retries
+        the outbox on the flush interval.
+        """
+        if self._flush_task is None:
+            self._closed = False
+            self._flush_task = asyncio.create_task(self._flush_periodically())
+
+    async def add(
+        self,
+        vector: np.ndarray | List[np.ndarray] | List[float] | List[List[float]],
+        metadata: Dict[str, Any] | List[Dict[str, Any]],
+    ):
+        """
+        Adds the vectors and metadata of a page to the buffer, flushing
+        it if it's full. Takes the same arguments as store_embedding.
+        """
+        ids, vectors, payloads = point_columns(vector, metadata)
+
+        if not ids:
+            return
+
+        # Vectors stay as numpy arrays until the batch is sent
+        self._ids += ids
+        self._vectors.append(vectors)
+        self._payloads += payloads
+
+        # Remember each page's point ids to delete its stale points
+        for idx, payload in zip(ids, payloads):
+            url = payload.get("url")
+            if url is not None:
+                self._pages.setdefault(url, []).append(idx)
+
+        if self._closed or len(self._ids) >= self._batch_size:
+            await self.flush()
+
+    async def flush(self):
+        """
+        Sends all the buffered points to qdrant as one batch. Waits if
+        the maximum number of batches are already in flight. If the
+        outbox can't be emptied first the batch joins the end of it. Points of
+        pages whose resource isn't in postgres yet are kept in the
+        buffer for the next flush, and dropped if the resource writer
+        drops their resource.
+        """
+        async with self._lock:
+            if not self._ids:
+                return
+
+            # The pages' resources must be written to look up their ids
+            if self._resource_writer is not None:
+                await self._resource_writer.flush()
+
+            try:
+                resource_ids = (
+                    await get_resource_ids(list(self._pages), self._db_client)
+                    if self._pages
+                    else {}
+                )
+
+            except Exception as e:
+                print("Failed to look up resource ids with error:", e)
+
+                return
+
+            vectors = np.concatenate(self._vectors)
+            ready = np.array(
+                [
+                    payload.get("url") is None or payload["url"] in resource_ids
+                    for payload in self._payloads
+                ]
+            )
+
+            batch = Batch(
+                ids=[idx for idx, r in zip(self._ids, ready) if r],
+                vectors=vectors[ready].tolist(),
+                payloads=[
+                    compact_payload(payload, resource_ids)
+                    for payload, r in zip(self._payloads, ready)
+                    if r
+                ],
+            )
+            pages = {
+                url: point_ids
+                for url, point_ids in self._pages.items()
+                if url in resource_ids
+            }
+
+            # Keep the points that are still waiting on their resource,
+            # unless the resource writer gave up on it
+            dropped = (
+                self._resource_writer.dropped_urls
+                if self._resource_writer is not None
+                else set()
+            )
+            waiting = ~ready & np.array(
+                [payload.get("url") not in dropped for payload in self._payloads]
+            )
+
+            self._ids = [idx for idx, w in zip(self._ids, waiting) if w]
+            self._vectors = [vectors[waiting]]
+            self._payloads = [
+                payload for payload, w in zip(self._payloads, waiting) if w
+            ]
+            self._pages = {
+                url: point_ids
+                for url, point_ids in self._pages.items()
+                if url not in resource_ids and url not in dropped
+            }
+
+            if not batch.ids:
+                return
+
+            # Upsert the points then delete the pages' stale points
+            operations = [UpsertOperation(upsert=PointsBatch(batch=batch))]
+            operations += [
+                DeleteOperation(
+                    delete=stale_points_selector(
+                        resource_ids[url], point_ids
+                    )
+                )
+                for url, point_ids in pages.items()
+            ]
+
+            # Older batches still in the outbox go first, otherwise they'd
+            # overwrite the newer versions of their pages when resent
+            if not await self.retry_outbox():
+                self._save_to_outbox(operations)
+
+                return
+
+            # Wait for a free slot before sending
+            await self._semaphore.acquire()
+
+            task = asyncio.create_task(self._send(operations))
+            self._send_tasks.add(task)
+            task.add_done_callback(self._send_tasks.discard)
+
+    async def retry_outbox(self) -> bool:
+        """
+        Resends the batches saved in the outbox, oldest first, removing
+        each one once qdrant has accepted it. Batches that can't be read
+        or that qdrant rejects as invalid are moved to the dead letter
+        folder, otherwise retrying stops at the first failure so the
+        batches keep their order.
+
+        Returns
+        -------
+        bool
+            True if the outbox is now empty, False otherwise.
+        """
+        async with self._outbox_lock:
+            # Half written batches are still in their temporary files
+            files = sorted(
+                (
+                    os.path.join(self._outbox_dir, file)
+                    for file in os.listdir(self._outbox_dir)
+                    if file.endswith(".joblib")
+                ),
+                key=os.path.getmtime,
+            )
+
+            for file in files:
+                try:
+                    operations = joblib.load(file)
+
+                except Exception as e:
+                    print("Failed to read outbox batch with error:", e)
+                    self._dead_letter(file)
+
+                    continue
+
+                try:
+                    await self._vector_client.batch_update_points(
+                        collection_name="embeddings",
+                        update_operations=operations,
+                        wait=False,
+                    )
+
+                except Exception as e:
+                    print("Failed to resend outbox batch with error:", e)
+
+                    if not is_rejected(e):
+                        return False
+
+                    self._dead_letter(file)
+
+                    continue
+
+                os.remove(file)
+                bump_index_generation()
+
+            return True
+
+    def _dead_letter(self, file: str):
+        """
+        Moves an outbox batch that can never be sent to the dead letter
+        folder, where it's kept for inspection.
+        """
+        dead_letter_dir = os.path.join(self._outbox_dir, "dead_letter")
+        os.makedirs(dead_letter_dir, exist_ok=True)
+        os.replace(file, os.path.join(dead_letter_dir, os.path.basename(file)))
+
+    async def close(self) -> bool:
+        """
+        Stops the background flush task, sends anything left in the
+        buffer, waits for all batches to finish sending and retries the
+        outbox one last time.
+
+        Returns
+        -------
+        bool
+            True if everything reached qdrant, False if batches are
+            still waiting in the outbox or points are still waiting on
+            their resources.
+        """
+        self._closed = True
+
+        if self._flush_task is not None:
+            self._flush_task.cancel()
+            self._flush_task = None
+
+        await self.flush()
+        await asyncio.gather(*self._send_tasks)
+
+        if self._ids:
+            print(f"{len(self._ids)} embeddings have no stored resource")
+
+        return await self.retry_outbox() and not self._ids
+
+    async def _send(self, operations: List[UpdateOperation]):
+        """
+        Sends a batch of operations to qdrant, saving it to the outbox
+        if it fails.
+        """
+        try:
+            await self._vector_client.batch_update_points(
+                collection_name="embeddings",
+                update_operations=operations,
+                wait=False,
+            )
+
+            bump_index_generation()
+
+        except Exception as e:
+            print("Failed to send embeddings, saving to outbox:", e)
+
+            self._save_to_outbox(operations)
+
+        finally:
+            self._semaphore.release()
+
+    def _save_to_outbox(self, operations: List[UpdateOperation]):
+        """
+        Saves a batch of operations to the outbox to be sent later. It's
+        written to a temporary file first so a crash mid write never
+        leaves a truncated batch in the outbox.
+        """
+        file = os.path.join(self._outbox_dir, f"{uuid4().hex}.joblib")
+        joblib.dump(operations, f"{file}.tmp")
+        os.replace(f"{file}.tmp", file)
+
+    async def _flush_periodically(self):
+        """
+        Retries the outbox, then flushes the buffer every flush interval
+        until cancelled. The outbox is retried as soon as the writer
+        starts, so batches left over from an earlier crawl are sent
+        before the pages are sent again.
+        """
+        while True:
+            await asyncio.shield(self.retry_outbox())
+            await asyncio.sleep(self._flush_interval)
+            await asyncio.shield(self.flush())
+
+
+def is_rejected(error: Exception) -> bool:
+    """
+    Checks if an error from qdrant means the request is invalid, so
+    sending it again would fail the same way. Both REST and gRPC errors
+    are recognised.
+
+    Parameters
+    ----------
+    error : Exception
+        The error raised sending the request.
+
+    Returns
+    -------
+    bool
+        True if the request should be dropped, False if it's worth
+        retrying.
+    """
+    if isinstance(error, UnexpectedResponse):
+        return (
+            error.status_code is not None
+            and 400 <= error.status_code < 500
+            and error.status_code not in RETRYABLE_CLIENT_ERRORS
+        )
+
+    if isinstance(error, grpc.RpcError) and callable(getattr(error, "code", None)):
+        return error.code() in REJECTED_GRPC_STATUSES
+
+    return False
+
+
+def resource_record(resource: Resource) -> Tuple:
+    """
+    Turns a resource into the row of arguments the log resource query
+    takes.
+
+    Parameters
+    ----------
+    resource : Resource
+        The resource to turn into a row.
+
+    Returns
+    -------
+    Tuple
+        The resource's attributes in the order of the query's columns.
+    """
+    return (
+        resource.url,
+        resource.firstVisited,
+        resource.lastVisited,
+        resource.allVisits,
+        resource.externalLinks,
+        resource.title,
+        resource.siteName,
+        resource.description,
+        resource.published,
+        resource.favicon,
+    )
+
+
 async def log_resource(
     resource: Resource,
-    db_client: asyncpg.Connection,
+    db_client: asyncpg.Pool | asyncpg.Connection,
 ) -> bool:
     """
-    Logs information about a resource to the postgres database, if it isn't already
-    present.
+    Logs information about a resource to the postgres database. If the
+    resource's url is already present its last visit time, visit count,
+    links and page metadata are updated instead. The text of the
+    resource's chunks is written along with it.
 
     Parameters
     ----------
     resource : Resource
         The resource to log.
 
-    db_client : psycopg2.extensions.connection
+    db_client : asyncpg.Pool | asyncpg.Connection
         The PostgreSQL client to use for logging.
 
     Returns
@@ -124,21 +1339,14 @@ async def log_resource(
         True if the resource was logged successfully, False otherwise.
     """
     # Create a tuple of the resource's attributes
-    attributes = (
-        resource.url,
-        resource.firstVisited,
-        resource.lastVisited,
-        resource.allVisits,
-        resource.externalLinks,
-    )
+    attributes = resource_record(resource)
 
     # Log the resource to the database
     try:
-
-        await db_client.execute(
-            "INSERT INTO resources (url, firstVisited, lastVisited, allVisits, externalLinks) VALUES ($1, $2, $3, $4, $5)",
-            *attributes,
-        )
+        async with acquire_connection(db_client) as connection:
+            async with connection.transaction():
+                await connection.execute(LOG_RESOURCE_QUERY, *attributes)
+                await write_chunks([resource], connection)
 
         return True
     except Exception as e:
@@ -147,14 +1355,383 @@ async def log_resource(
         return False
 
 
+async def write_chunks(
+    resources: List[Resource],
+    connection: asyncpg.Connection,
+):
+    """
+    Writes the text chunks of resources to the chunks table and deletes
+    any chunks left over from longer versions of the pages. Resources
+    without chunks are skipped. The resources must already be logged.
+
+    Parameters
+    ----------
+    resources : List[Resource]
+        The resources whose chunks are written.
+
+    connection : asyncpg.Connection
+        The connection to write the chunks with.
+    """
+    # Only the latest version of a page revisited within the batch is kept
+    resources = list(
+        {resource.url: resource for resource in resources if resource.chunks}.values()
+    )
+
+    if not resources:
+        return
+
+    # Pass the chunks as columns so they're written in one statement
+    urls, chunks, contents = [], [], []
+    for resource in resources:
+        urls += [resource.url] * len(resource.chunks)
+        chunks += range(len(resource.chunks))
+        contents += resource.chunks
+
+    await connection.execute(WRITE_CHUNKS_QUERY, urls, chunks, contents)
+    await connection.execute(
+        DELETE_STALE_CHUNKS_QUERY,
+        [resource.url for resource in resources],
+        [len(resource.chunks) for resource in resources],
+    )
+
+
+class ResourceWriter:
+    """
+    Write-behind buffer for resources. Resources added to the writer
+    are grouped together and written to postgres with a single
+    executemany call, either when the buffer is full or when the flush
+    interval passes, rather than making one round trip per resource.
+    The resources' chunks are written in the same transaction. If a
+    batch fails its resources are written one at a time, so a bad
+    resource is dropped rather than holding up the rest.
+
+    Parameters
+    ----------
+    db_client : asyncpg.Pool | asyncpg.Connection
+        The PostgreSQL client to write the resources with.
+
+    max_size : int, optional
+        The number of buffered resources that triggers a flush.
+        Defaults to 100.
+
+    flush_interval : float, optional
+        The maximum number of seconds a resource waits in the buffer
+        before it's flushed. Defaults to 2 seconds.
+
+    max_attempts : int, optional
+        The number of flushes a resource can fail before it's dropped.
+        Resources postgres rejects outright are dropped straight away.
+        Defaults to 5.
+    """
+
+    def __init__(
+        self,
+        db_client: asyncpg.Pool | asyncpg.Connection,
+        max_size: int = 100,
+        flush_interval: float = 2.0,
+        max_attempts: int = 5,
+    ):
+        self._db_client = db_client
+        self._max_size = max_size
+        self._flush_interval = flush_interval
+        self._max_attempts = max_attempts
+        self._buffer: List[Resource] = []
+        self._attempts: Dict[int, int] = {}
+        self.dropped_urls: set[str] = set()
+        self._lock = asyncio.Lock()
+        self._flush_task: Optional[asyncio.Task] = None
+        self._closed = False
+
+    def start(self):
+        """
+        Starts the background task that flushes the buffer on the
+        flush interval.
+        """
+        if self._flush_task is None:
+            self._closed = False
+            self._flush_task = asyncio.create_task(self._flush_periodically())
+
+    async def add(self, resource: Resource):
+        """
+        Adds a resource to the buffer, flushing it if it's full. Once
+        the writer is closed resources are written straight away.
+        """
+        self._buffer.append(resource)
+
+        if self._closed or len(self._buffer) >= self._max_size:
+            await self.flush()
+
+    async def flush(self) -> bool:
+        """
+        Writes all the buffered resources to postgres in one batch.
+
+        Returns
+        -------
+        bool
+            True if the resources were written successfully, False
+            otherwise. Resources that fail to write are kept in the
+            buffer and retried on the next flush, until they've failed
+            max_attempts times or postgres rejects their values. Their
+            urls are then added to dropped_urls.
+        """
+        async with self._lock:
+            if not self._buffer:
+                return True
+
+            # Swap the buffer out so resources added mid-flush are kept
+            resources, self._buffer = self._buffer, []
+
+            try:
+                await self._write(resources)
+
+                for resource in resources:
+                    self._attempts.pop(id(resource), None)
+
+                return True
+
+            except Exception as e:
+                print("Failed to flush resources with error:", e)
+
+            # Write the resources one at a time to find the ones failing
+            failed = []
+            for resource in resources:
+                attempts = self._attempts.pop(id(resource), 0) + 1
+
+                try:
+                    await self._write([resource])
+
+                except Exception as e:
+                    if (
+                        not isinstance(e, REJECTED_ROW_ERRORS)
+                        and attempts < self._max_attempts
+                    ):
+                        self._attempts[id(resource)] = attempts
+                        failed.append(resource)
+
+                        continue
+
+                    print(f"Dropping resource {resource.url[:200]} with error:", e)
+                    self.dropped_urls.add(resource.url)
+
+            # Put the resources that could still be written back
+            self._buffer = failed + self._buffer
+
+            return False
+
+    async def _write(self, resources: List[Resource]):
+        """
+        Writes resources and their chunks to postgres in one transaction.
+        """
+        records = [resource_record(resource) for resource in resources]
+
+        async with acquire_connection(self._db_client) as connection:
+            async with connection.transaction():
+                await connection.executemany(LOG_RESOURCE_QUERY, records)
+                await write_chunks(resources, connection)
+
+    async def close(self) -> bool:
+        """
+        Stops the background flush task and flushes anything left in
+        the buffer.
+        """
+        self._closed = True
+
+        if self._flush_task is not None:
+            self._flush_task.cancel()
+            self._flush_task = None
+
+        return await self.flush()
+
+    async def _flush_periodically(self):
+        """
+        Flushes the buffer every flush interval until cancelled. The
+        flush is shielded so cancelling mid-write doesn't drop a batch.
+        """
+        while True:
+            await asyncio.sleep(self._flush_interval)
+            await asyncio.shield(self.flush())
+
+
+class PotentialUrlCounter:
+    """
+    Counts sightings of potential urls in memory, and writes the counts
+    to postgres in one batched upsert, either when the number of urls
+    counted is large enough or when the flush interval passes. A url
+    seen many times between flushes costs a single row in the batch.
+
+    Parameters
+    ----------
+    db_client : asyncpg.Pool | asyncpg.Connection
+        The PostgreSQL client to write the counts with.
+
+    max_size : int, optional
+        The number of counted urls that triggers a flush. Defaults to
+        1000.
+
+    flush_interval : float, optional
+        The maximum number of seconds a count waits before it's
+        flushed. Defaults to 10 seconds.
+
+    max_attempts : int, optional
+        The number of flushes a url's count can fail before it's
+        dropped. Counts postgres rejects outright are dropped straight
+        away. Defaults to 5.
+    """
+
+    def __init__(
+        self,
+        db_client: asyncpg.Pool | asyncpg.Connection,
+        max_size: int = 1000,
+        flush_interval: float = 10.0,
+        max_attempts: int = 5,
+    ):
+        self._db_client = db_client
+        self._max_size = max_size
+        self._flush_interval = flush_interval
+        self._max_attempts = max_attempts
+        self._first_seen: Dict[str, datetime] = {}
+        self._counts: Dict[str, int] = {}
+        self._attempts: Dict[str, int] = {}
+        self._lock = asyncio.Lock()
+        self._flush_task: Optional[asyncio.Task] = None
+        self._closed = False
+
+    def start(self):
+        """
+        Starts the background task that flushes the counts on the flush
+        interval.
+        """
+        if self._flush_task is None:
+            self._closed = False
+            self._flush_task = asyncio.create_task(self._flush_periodically())
+
+    async def add(self, urls: List[str], time_seen: Optional[datetime] = None):
+        """
+        Counts a sighting of each of the urls, flushing the counts if
+        enough urls have been counted. Invalid urls, and urls too long
+        to store, are skipped. Once the counter is closed sightings are
+        written straight away.
+        """
+        time_seen = time_seen or datetime.now()
+
+        for url in urls:
+            if len(url) > MAX_POTENTIAL_URL_LENGTH or not check_url(url):
+                continue
+
+            self._first_seen.setdefault(url, time_seen)
+            self._counts[url] = self._counts.get(url, 0) + 1
+
+        if self._closed or len(self._counts) >= self._max_size:
+            await self.flush()
+
+    async def flush(self) -> bool:
+        """
+        Writes all the counts to postgres in one batch.
+
+        Returns
+        -------
+        bool
+            True if the counts were written successfully, False
+            otherwise. Counts that fail to write are kept and retried
+            on the next flush, until they've failed max_attempts times
+            or postgres rejects their values.
+        """
+        async with self._lock:
+            if not self._counts:
+                return True
+
+            # Swap the counts out so sightings made mid-flush are kept
+            first_seen, self._first_seen = self._first_seen, {}
+            counts, self._counts = self._counts, {}
+
+            urls = list(counts)
+
+            try:
+                await self._write(urls, first_seen, counts)
+
+                for url in urls:
+                    self._attempts.pop(url, None)
+
+                return True
+
+            except Exception as e:
+                print("Failed to flush potential urls with error:", e)
+
+            # Write the counts one at a time to find the ones failing
+            for url in urls:
+                attempts = self._attempts.pop(url, 0) + 1
+
+                try:
+                    await self._write([url], first_seen, counts)
+
+                except Exception as e:
+                    if (
+                        not isinstance(e, REJECTED_ROW_ERRORS)
+                        and attempts < self._max_attempts
+                    ):
+                        self._attempts[url] = attempts
+
+                        # Put the count back to be retried
+                        self._first_seen[url] = min(
+                            first_seen[url], self._first_seen.get(url, first_seen[url])
+                        )
+                        self._counts[url] = self._counts.get(url, 0) + counts[url]
+
+                        continue
+
+                    print(f"Dropping potential url {url[:200]} with error:", e)
+
+            return False
+
+    async def _write(
+        self,
+        urls: List[str],
+        first_seen: Dict[str, datetime],
+        counts: Dict[str, int],
+    ):
+        """
+        Adds the counts of the urls to postgres in one upsert.
+        """
+        await self._db_client.execute(
+            LOG_POTENTIAL_URLS_QUERY,
+            urls,
+            [first_seen[url] for url in urls],
+            [counts[url] for url in urls],
+        )
+
+    async def close(self) -> bool:
+        """
+        Stops the background flush task and flushes the remaining
+        counts.
+        """
+        self._closed = True
+
+        if self._flush_task is not None:
+            self._flush_task.cancel()
+            self._flush_task = None
+
+        return await self.flush()
+
+    async def _flush_periodically(self):
+        """
+        Flushes the counts every flush interval until cancelled. The
+        flush is shielded so cancelling mid-write doesn't drop a batch.
+        """
+        while True:
+            await asyncio.sleep(self._flush_interval)
+            await asyncio.shield(self.flush())
+
+
 async def add_potential_url(
     url: str,
     time_seen: datetime,
-    db_client: asyncpg.Connection,
+    db_client: asyncpg.Pool | asyncpg.Connection,
 ) -> bool:
     """
     Adds a new potential url to the database, that isn't crawled
     but could be added to the crawlable set of urls in the future.
+    If the url has already been added its timesSeen is incremented.
+    Crawls count sightings with a PotentialUrlCounter instead.
 
     Parameters
     ----------
@@ -165,7 +1742,7 @@ async def add_potential_url(
         The time the url was seen. Will only be stored if this is
         the first time the url has been seen.
 
-    db_client : asyncpg.Connection
+    db_client : asyncpg.Pool | asyncpg.Connection
         The PostgreSQL client to use.
 
     Returns
@@ -179,31 +1756,10 @@ async def add_potential_url(
 
         return False
 
-    # Check the url hasn't already been added
-    query = "SELECT * FROM potential_urls WHERE url = $1"
-    result = await db_client.fetchrow(query, url)
-
-    # If the url has already been added, update the timesSeen
-    if result is not None:
-        print("Url already added:", url)
-
-        query = (
-            "UPDATE potential_urls SET timesSeen = timesSeen + 1 WHERE url = $1"
-        )
-
-        await db_client.execute(query, url)
-
-        return True
-
-    # Create a tuple of the resource's attributes
-    attributes = (url, time_seen, 1)
-
-    # Log the potential url in the database
+    # Log the potential url, or count another sighting of it
     try:
-
         await db_client.execute(
-            "INSERT INTO potential_urls (url, firstSeen, timesSeen) VALUES ($1, $2, $3)",
-            *attributes,
+            LOG_POTENTIAL_URLS_QUERY, [url], [time_seen], [1]
         )
 
         return True
@@ -217,7 +1773,7 @@ async def add_potential_url(
 async def add_seed_url(
     url: str,
     seeds: List[str],
-    db_client: asyncpg.Connection,
+    db_client: asyncpg.Pool | asyncpg.Connection,
 ) -> bool:
     """
     Adds a new seed url to the database.
@@ -227,7 +1783,7 @@ async def add_seed_url(
     url : str
         The url to add.
 
-    db_client : asyncpg.Connection
+    db_client : asyncpg.Pool | asyncpg.Connection
         The PostgreSQL client to use.
 
     Returns
@@ -261,7 +1817,7 @@ async def add_seed_url(
 
 async def delete_seed_url(
     url: str,
-    db_client: asyncpg.Connection,
+    db_client: asyncpg.Pool | asyncpg.Connection,
 ) -> bool:
     """
     Deletes a seed url from the database.
@@ -271,7 +1827,7 @@ async def delete_seed_url(
     url : str
         The url to delete.
 
-    db_client : asyncpg.Connection
+    db_client : asyncpg.Pool | asyncpg.Connection
         The PostgreSQL client to use.
 
     Returns
@@ -301,7 +1857,7 @@ async def delete_seed_url(
 async def update_seed_url(
     old_url: str,
     new_url: str,
-    postgres_client: asyncpg.Connection,
+    postgres_client: asyncpg.Pool | asyncpg.Connection,
 ) -> bool:
     """
     Updates a seed url in the database.
@@ -314,7 +1870,7 @@ async def update_seed_url(
     new_url : str
         The new url to update to.
 
-    postgres_client : asyncpg.Connection
+    postgres_client : asyncpg.Pool | asyncpg.Connection
         The PostgreSQL client to use.
 
     Returns
@@ -344,137 +1900,155 @@ async def update_seed_url(
 async def add_seed_to_url(
     seed: str,
     url: str,
-    postgres_client: asyncpg.Connection,
+    postgres_client: asyncpg.Pool | asyncpg.Connection,
 ):
     """
     Adds a seed to an url in the database.
     """
-    # Get the current array of seeds for the url
-    current_seeds = await postgres_client.fetchrow(
-        "SELECT seeds FROM seed_urls WHERE url = $1", url
-    )
+    # Read and write the seeds on one connection, locking the row so
+    # concurrent edits from a pool can't overwrite each other
+    async with acquire_connection(postgres_client) as connection:
+        async with connection.transaction():
+            # Get the current array of seeds for the url
+            current_seeds = await connection.fetchrow(
+                "SELECT seeds FROM seed_urls WHERE url = $1 FOR UPDATE", url
+            )
 
-    # Get the current seeds list
-    current_seeds = current_seeds[0]
+            # Get the current seeds list
+            current_seeds = current_seeds[0]
 
-    # Replace a None value with an empty list
-    if current_seeds is None:
-        current_seeds = []
+            # Replace a None value with an empty list
+            if current_seeds is None:
+                current_seeds = []
 
-    # Check if the seed is already in the array
-    if seed in current_seeds:
-        print("Seed already in array:", seed)
-        return False
+            # Check if the seed is already in the array
+            if seed in current_seeds:
+                print("Seed already in array:", seed)
+                return False
 
-    # Else add the seed to the array
-    current_seeds.append(seed)
+            # Else add the seed to the array
+            current_seeds.append(seed)
 
-    try:
-        # Update the array in the database
-        await postgres_client.execute(
-            "UPDATE seed_urls SET seeds = $1 WHERE url = $2", current_seeds, url
-        )
+            try:
+                # Update the array in the database
+                await connection.execute(
+                    "UPDATE seed_urls SET seeds = $1 WHERE url = $2",
+                    current_seeds,
+                    url,
+                )
 
-        return True
+                return True
 
-    # If this fails for some reason, print the exception
-    except Exception as e:
-        print("Failed to update url with error:", e)
+            # If this fails for some reason, print the exception
+            except Exception as e:
+                print("Failed to update url with error:", e)
 
-        return False
+                return False
 
 
 async def delete_seed_from_url(
     seed: str,
     url: str,
-    postgres_client: asyncpg.Connection,
+    postgres_client: asyncpg.Pool | asyncpg.Connection,
 ):
     """
     Deletes a seed from an url in the database.
     """
-    # Get the current array of seeds for the url
-    current_seeds = await postgres_client.fetchrow(
-        "SELECT seeds FROM seed_urls WHERE url = $1", url
-    )
+    # Read and write the seeds on one connection, locking the row so
+    # concurrent edits from a pool can't overwrite each other
+    async with acquire_connection(postgres_client) as connection:
+        async with connection.transaction():
+            # Get the current array of seeds for the url
+            current_seeds = await connection.fetchrow(
+                "SELECT seeds FROM seed_urls WHERE url = $1 FOR UPDATE", url
+            )
 
-    current_seeds = current_seeds[0]
+            current_seeds = current_seeds[0]
 
-    # Handle the case where the seed array is None
-    if current_seeds is None:
-        return (False, "Seed not in array")
+            # Handle the case where the seed array is None
+            if current_seeds is None:
+                return (False, "Seed not in array")
 
-    # Check if the seed is already in the array
-    if seed not in current_seeds:
-        return (False, "Seed not in array")
+            # Check if the seed is already in the array
+            if seed not in current_seeds:
+                return (False, "Seed not in array")
 
-    # Else remove the seed from the array
-    current_seeds.remove(seed)
+            # Else remove the seed from the array
+            current_seeds.remove(seed)
 
-    try:
-        # Update the array in the database
-        await postgres_client.execute(
-            "UPDATE seed_urls SET seeds = $1 WHERE url = $2", current_seeds, url
-        )
+            try:
+                # Update the array in the database
+                await connection.execute(
+                    "UPDATE seed_urls SET seeds = $1 WHERE url = $2",
+                    current_seeds,
+                    url,
+                )
 
-        return (True, "Seed deleted successfully")
+                return (True, "Seed deleted successfully")
 
-    except Exception as e:
-        print("Failed to update url with error:", e)
+            except Exception as e:
+                print("Failed to update url with error:", e)
 
-        return (False, "Failed to delete seed from url")
+                return (False, "Failed to delete seed from url")
 
 
 async def update_seed_url_seed(
     old_seed: str,
     new_seed: str,
     url: str,
-    postgres_client: asyncpg.Connection,
+    postgres_client: asyncpg.Pool | asyncpg.Connection,
 ):
     """
     Updates a seed that's stored against an url in the database. The seeds are basically
     the initial pages to crawl associated with that url.
     """
-    # Get the current array of seeds for the url
-    current_seeds = await postgres_client.fetchrow(
-        "SELECT seeds FROM seed_urls WHERE url = $1", url
-    )
+    # Read and write the seeds on one connection, locking the row so
+    # concurrent edits from a pool can't overwrite each other
+    async with acquire_connection(postgres_client) as connection:
+        async with connection.transaction():
+            # Get the current array of seeds for the url
+            current_seeds = await connection.fetchrow(
+                "SELECT seeds FROM seed_urls WHERE url = $1 FOR UPDATE", url
+            )
 
-    # Get the current seeds list
-    current_seeds = current_seeds[0]
+            # Get the current seeds list
+            current_seeds = current_seeds[0]
 
-    # Check if the seed is already in the array
-    if old_seed not in current_seeds:
-        return (False, "Seed not in array")
+            # Check if the seed is already in the array
+            if old_seed not in current_seeds:
+                return (False, "Seed not in array")
 
-    # Else get the current index of the old seed
-    old_index = current_seeds.index(old_seed)
+            # Else get the current index of the old seed
+            old_index = current_seeds.index(old_seed)
 
-    # And replace it with the new one
-    current_seeds[old_index] = new_seed
+            # And replace it with the new one
+            current_seeds[old_index] = new_seed
 
-    try:
-        # Update the array in the database
-        await postgres_client.execute(
-            "UPDATE seed_urls SET seeds = $1 WHERE url = $2", current_seeds, url
-        )
+            try:
+                # Update the array in the database
+                await connection.execute(
+                    "UPDATE seed_urls SET seeds = $1 WHERE url = $2",
+                    current_seeds,
+                    url,
+                )
 
-        return (True, "Seed updated successfully")
+                return (True, "Seed updated successfully")
 
-    except Exception as e:
-        print("Failed to update url with error:", e)
+            except Exception as e:
+                print("Failed to update url with error:", e)
 
-        return (False, f"Failed to update seed url with error: {e}")
+                return (False, f"Failed to update seed url with error: {e}")
 
 
 async def get_seed_urls(
-    postgres_client: asyncpg.Connection,
+    postgres_client: asyncpg.Pool | asyncpg.Connection,
 ) -> list[SeedUrl]:
     """
     Gets a list of seed urls from the database.
 
     Parameters
     ----------
-    postgres_client : asyncpg.Connection
+    postgres_client : asyncpg.Pool | asyncpg.Connection
         The PostgreSQL client to use.
 
     Returns
@@ -492,14 +2066,14 @@ async def get_seed_urls(
 
 
 async def get_crawled_urls(
-    postgres_client: asyncpg.Connection,
+    postgres_client: asyncpg.Pool | asyncpg.Connection,
 ) -> list[CrawledUrl]:
     """
     Gets a list of all the crawled urls from the database.
 
     Parameters
     ----------
-    postgres_client : asyncpg.Connection
+    postgres_client : asyncpg.Pool | asyncpg.Connection
         The PostgreSQL client to use.
 
     Returns
@@ -527,14 +2101,14 @@ async def get_crawled_urls(
 
 
 async def get_potential_urls(
-    postgres_client: asyncpg.Connection,
+    postgres_client: asyncpg.Pool | asyncpg.Connection,
 ) -> list[PotentialUrl]:
     """
     Gets a list of all the potential urls from the database.
 
     Parameters
     ----------
-    postgres_client : asyncpg.Connection
+    postgres_client : asyncpg.Pool | asyncpg.Connection
         The PostgreSQL client to access the database with the urls
         in.
 
@@ -7,12 +7,12 @@ Created:
 """
 
 from contextlib import asynccontextmanager
-from fastapi import FastAPI, Depends, HTTPException, status, Request
+from fastapi import FastAPI, Depends, HTTPException, status, Request, Response, Query
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.security import OAuth2PasswordBearer
 from fastapi.responses import StreamingResponse
 import jwt
-from typing import Optional
+from typing import Optional, Literal
 import app.auth.auth as auth
 from app.models.data_types import (
     LoginData,
@@ -27,8 +27,17 @@ from app.models.data_types import (
     SeedAddDeleteData,
     UrlDeleteData,
     Result,
+    SearchEvent,
+    SimilarSite,
+)
+from app.core.search import (
+    get_result_page,
+    stream_top_matches,
+    get_similar_pages,
+    get_similar_sites,
+    semantic_result_cache,
+    EncodingBatcher,
 )
-from app.core.search import get_top_matches
 from dotenv import load_dotenv
 import asyncpg
 from qdrant_client import AsyncQdrantClient
@@ -37,6 +46,7 @@ import app.core.storage as storage
 from fastapi.responses import HTMLResponse
 import asyncio
 import app.core.gather as gather
+import app.core.rank as rank
 import sentence_transformers
 import uuid
 
@@ -58,10 +68,19 @@ load_dotenv(dotenv_path=env_file)
 # OAuth2 scheme setup (even though we're just using JWT, it's needed here)
 oauth2_scheme = OAuth2PasswordBearer(tokenUrl="token")
 
-# Global database clients
-postgres_client = None
+# Global database clients, the postgres client is a connection pool
+postgres_client: asyncpg.Pool = None
 qdrant_client = None
 
+# Global embedding model, loaded on first use
+embedding_model: sentence_transformers.SentenceTransformer = None
+
+# Global batcher for encoding the queries of concurrent searches
+query_encoder: EncodingBatcher = None
+
+# Global cross encoder for reranking search results, loaded on first use
+reranker: sentence_transformers.CrossEncoder = None
+
 # Global crawl events
 crawl_pause: asyncio.Event = None
 crawl_end: asyncio.Event = None
@@ -72,6 +91,13 @@ crawl_message_queue: asyncio.Queue = None
 # Global stream token
 stream_token: str = None
 
+# Global buffers for the running crawl's resource and embedding writes
+resource_writer: storage.ResourceWriter = None
+embedding_writer: storage.EmbeddingWriter = None
+
+# Global counter for the running crawl's potential url sightings
+potential_url_counter: storage.PotentialUrlCounter = None
+
 
 @asynccontextmanager
 async def lifespan(app: FastAPI):
@@ -85,8 +111,11 @@ async def lifespan(app: FastAPI):
 
     print(os.getenv("POSTGRES_USER"))
 
-    # Set up the database clients
-    postgres_client = await asyncpg.connect(
+    # Set up the database clients, postgres is a pool so requests and
+    # the crawler each get their own connection
+    postgres_client = await storage.create_postgres_pool(
+        min_size=int(os.getenv("POSTGRES_POOL_MIN_SIZE", 2)),
+        max_size=int(os.getenv("POSTGRES_POOL_MAX_SIZE", 10)),
         database=os.getenv("POSTGRES_DB"),
         user=os.getenv("POSTGRES_USER"),
         password=os.getenv("POSTGRES_PASSWORD"),
@@ -94,10 +123,31 @@ async def lifespan(app: FastAPI):
         port=os.getenv("POSTGRES_PORT"),
     )
 
-    # set up the qdrant client
+    # Bring the database up to the current schema
+    await storage.migrate_postgres(postgres_client)
+
+    # set up the qdrant client, gRPC avoids JSON encoding the vectors
     qdrant_client = AsyncQdrantClient(
         host=os.getenv("QDRANT_URL"),
         port=os.getenv("QDRANT_PORT"),
+        grpc_port=int(os.getenv("QDRANT_GRPC_PORT", 6334)),
+        prefer_grpc=os.getenv("QDRANT_PREFER_GRPC", "false") == "true",
+    )
+
+    # How similar queries must be to share cached search results
+    semantic_result_cache.threshold = float(
+        os.getenv("SEMANTIC_CACHE_THRESHOLD", 0.95)
+    )
+
+    # Create or migrate the embeddings collection to the managed schema
+    await storage.setup_collection(
+        qdrant_client,
+        quantization=os.getenv("QDRANT_QUANTIZATION", "scalar"),
+        indexing_threshold=int(
+            os.getenv(
+                "QDRANT_INDEXING_THRESHOLD", storage.BULK_INGEST_DEFAULT_THRESHOLD
+            )
+        ),
     )
 
     yield
@@ -106,6 +156,9 @@ async def lifespan(app: FastAPI):
     if crawl_message_queue is not None:
         del crawl_message_queue
 
+    # Close all the connections in the postgres pool
+    await postgres_client.close()
+
 
 # Set up the FastAPI app with lifespan
 app = FastAPI(lifespan=lifespan)
@@ -120,13 +173,14 @@ app.add_middleware(
     allow_credentials=True,
     allow_methods=["*"],  # Allow all HTTP methods
     allow_headers=["*"],  # Allow all headers, including Authorization
+    expose_headers=["X-Next-Page-Token"],  # Lets the frontend page results
 )
 
 
 async def get_postgres_client():
     """
-    Gets the postgres client after the lifespan has set it up. Makes it
-    much simpler to mock the client in tests.
+    Gets the postgres connection pool after the lifespan has set it up.
+    Makes it much simpler to mock the client in tests.
     """
     return postgres_client
 
@@ -169,6 +223,31 @@ async def get_crawler_message_queue():
     return crawl_message_queue
 
 
+async def get_resource_writer():
+    """
+    Gets the resource writer of the running crawl after start_crawl has
+    set it up. Makes it much simpler to mock the writer in tests.
+    """
+    return resource_writer
+
+
+async def get_embedding_writer():
+    """
+    Gets the embedding writer of the running crawl after start_crawl has
+    set it up. Makes it much simpler to mock the writer in tests.
+    """
+    return embedding_writer
+
+
+async def get_potential_url_counter():
+    """
+    Gets the potential url counter of the running crawl after
+    start_crawl has set it up. Makes it much simpler to mock the
+    counter in tests.
+    """
+    return potential_url_counter
+
+
 async def get_stream_token():
     """
     Returns the global stream token, setting up a new one if it's currently
@@ -191,12 +270,46 @@ async def check_token(token: str = Depends(oauth2_scheme)):
 
 async def get_embedding_model():
     """
-    Gets the embedding model after the lifespan has set it up. Makes
-    it much simpler to mock the model in tests.
+    Gets the embedding model, loading it on first use so every request
+    shares one model. Makes it much simpler to mock the model in tests.
     """
-    return sentence_transformers.SentenceTransformer(
-        "multi-qa-MiniLM-L6-cos-v1"
-    )
+    global embedding_model
+
+    if embedding_model is None:
+        embedding_model = sentence_transformers.SentenceTransformer(
+            "multi-qa-MiniLM-L6-cos-v1"
+        )
+
+    return embedding_model
+
+
+async def get_query_encoder(embedding_model=Depends(get_embedding_model)):
+    """
+    Gets the batcher that encodes search queries with the embedding
+    model, creating it on first use.
+    """
+    global query_encoder
+
+    if query_encoder is None:
+        query_encoder = EncodingBatcher(
+            embedding_model,
+            max_wait=float(os.getenv("QUERY_BATCH_WAIT", 0.005)),
+        )
+
+    return query_encoder
+
+
+async def get_reranker():
+    """
+    Gets the cross encoder used to rerank search results, loading it on
+    first use. Returns None if no RERANK_MODEL is configured.
+    """
+    global reranker
+
+    if reranker is None and os.getenv("RERANK_MODEL"):
+        reranker = sentence_transformers.CrossEncoder(os.getenv("RERANK_MODEL"))
+
+    return reranker
 
 
 def check_auth(token: str):
@@ -220,24 +333,153 @@ def check_auth(token: str):
 @app.get("/search", response_model=list[Result])
 async def search(
     query: str,
+    response: Response,
+    aggregation: Literal["sum", "max", "softmax"] = "sum",
+    hybrid: bool = True,
+    diversity: float = Query(0.0, ge=0, le=1),
+    site_limit: int = Query(0, ge=0),
+    page_size: int = Query(30, ge=1, le=100),
+    page_token: Optional[str] = None,
     postgres_client=Depends(get_postgres_client),
     qdrant_client=Depends(get_qdrant_client),
-    embedding_model=Depends(get_embedding_model),
+    query_encoder=Depends(get_query_encoder),
+    reranker=Depends(get_reranker),
 ):
     """
-    Searches the qdrant database for the query and returns results.
+    Searches the qdrant database for the query and returns a page of
+    results. The query can hold site:, after:, before: and type:
+    operators to filter the pages searched. The aggregation sets how a
+    page's matching chunks are scored, and hybrid adds a full text
+    search for exact tokens. Diversity and site_limit spread the
+    results over more distinct pages and sites. The
+    token for the next page, if there is one, is returned in the
+    X-Next-Page-Token header and passed back as page_token.
     """
 
     print(query)
 
     # Get the search results
-    results = await get_top_matches(
-        query, embedding_model, qdrant_client, postgres_client
-    )
+    try:
+        results, next_token = await get_result_page(
+            query,
+            query_encoder,
+            qdrant_client,
+            postgres_client,
+            page_size=page_size,
+            page_token=page_token,
+            aggregation=aggregation,
+            hybrid=hybrid,
+            reranker=reranker,
+            rerank_budget=float(os.getenv("RERANK_BUDGET", 0.2)),
+            diversity=diversity,
+            site_limit=site_limit,
+        )
+    except ValueError as e:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail=str(e),
+        )
+
+    if next_token is not None:
+        response.headers["X-Next-Page-Token"] = next_token
 
     return results
 
 
+@app.get("/search/stream")
+async def search_stream(
+    query: str,
+    aggregation: Literal["sum", "max", "softmax"] = "sum",
+    hybrid: bool = True,
+    diversity: float = Query(0.0, ge=0, le=1),
+    site_limit: int = Query(0, ge=0),
+    page_size: int = Query(30, ge=1, le=100),
+    postgres_client=Depends(get_postgres_client),
+    qdrant_client=Depends(get_qdrant_client),
+    query_encoder=Depends(get_query_encoder),
+    reranker=Depends(get_reranker),
+):
+    """
+    Searches for the query like /search, but streams the first page of
+    results as server sent events. The first stage's results are sent
+    as soon as they're ready, followed by the reranked results if the
+    reranker finishes in time. Each event holds the stage and its
+    results, and the stream ends with a "done" event without results.
+    """
+
+    print(query)
+
+    async def result_stream():
+        async for stage, results in stream_top_matches(
+            query,
+            query_encoder,
+            qdrant_client,
+            postgres_client,
+            match_limit=page_size,
+            aggregation=aggregation,
+            hybrid=hybrid,
+            reranker=reranker,
+            rerank_budget=float(os.getenv("RERANK_BUDGET", 0.2)),
+            diversity=diversity,
+            site_limit=site_limit,
+        ):
+            event = SearchEvent(stage=stage, results=results)
+            yield f"data: {event.model_dump_json()}\n\n"
+
+        yield f"data: {SearchEvent(stage='done').model_dump_json()}\n\n"
+
+    return StreamingResponse(result_stream(), media_type="text/event-stream")
+
+
+@app.get("/similar", response_model=list[Result])
+async def similar(
+    url: Optional[str] = None,
+    point_id: Optional[str] = None,
+    limit: int = Query(10, ge=1, le=100),
+    postgres_client=Depends(get_postgres_client),
+    qdrant_client=Depends(get_qdrant_client),
+):
+    """
+    Returns the pages most like the page at the url, or the page chunk
+    with the point id, from the stored vectors without encoding a query.
+    """
+    try:
+        results = await get_similar_pages(
+            qdrant_client,
+            postgres_client,
+            url=url,
+            point_id=point_id,
+            limit=limit,
+        )
+    except ValueError as e:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail=str(e),
+        )
+    except LookupError as e:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail=str(e),
+        )
+
+    return results
+
+
+@app.get("/similar-sites", response_model=list[SimilarSite])
+async def similar_sites(
+    site: str,
+    limit: int = Query(10, ge=1, le=100),
+    qdrant_client=Depends(get_qdrant_client),
+):
+    """
+    Returns the sites most like the site, given by its domain or any of
+    its urls, from the centroid of its stored vectors.
+    """
+    sites = await get_similar_sites(site, qdrant_client, limit=limit)
+
+    return [SimilarSite(site=site, score=score) for site, score in sites]
+
+
 @app.post("/login", response_model=Token)
 async def admin_login(
     login_data: LoginData,
@@ -508,9 +750,11 @@ async def start_crawl(
     embedding_model=Depends(get_embedding_model),
     crawl_message_queue=Depends(get_crawler_message_queue),
     stream_token=Depends(get_stream_token),
+    bulk_ingest: bool = False,
 ):
     """
-    Start the url crawling process.
+    Start the url crawling process. Set bulk_ingest for large initial
+    crawls, indexing is deferred until the crawl ends.
     """
     check_auth(token)
 
@@ -527,6 +771,23 @@ async def start_crawl(
     crawl_pause = pause
     crawl_end = end
 
+    # Set up the buffers for the crawl's resource and embedding writes
+    global resource_writer
+    global embedding_writer
+
+    resource_writer = storage.ResourceWriter(postgres_client)
+    embedding_writer = storage.EmbeddingWriter(
+        qdrant_client,
+        postgres_client,
+        resource_writer=resource_writer,
+        outbox_dir=os.getenv("QDRANT_OUTBOX_DIR", "qdrant_outbox"),
+    )
+
+    # Set up the counter for the crawl's potential urls
+    global potential_url_counter
+
+    potential_url_counter = storage.PotentialUrlCounter(postgres_client)
+
     # Set up the crawler
     asyncio.create_task(
         gather.gather(
@@ -536,6 +797,10 @@ async def start_crawl(
             pause=pause,
             end=end,
             message_queue=crawl_message_queue,
+            resource_writer=resource_writer,
+            embedding_writer=embedding_writer,
+            potential_url_counter=potential_url_counter,
+            bulk_ingest=bulk_ingest,
         )
     )
 
@@ -547,6 +812,9 @@ async def stop_crawl(
     crawl_end=Depends(get_crawl_end),
     token=Depends(oauth2_scheme),
     postgres_client=Depends(get_postgres_client),
+    resource_writer=Depends(get_resource_writer),
+    embedding_writer=Depends(get_embedding_writer),
+    potential_url_counter=Depends(get_potential_url_counter),
 ):
     """
     Uses a crawl token to find the crawling process and stop it.
@@ -556,6 +824,16 @@ async def stop_crawl(
     # End the crawl by calling the asyncio event
     crawl_end.set()
 
+    # Write any resources and embeddings the crawl still has buffered
+    if resource_writer is not None:
+        await resource_writer.close()
+
+    if embedding_writer is not None:
+        await embedding_writer.close()
+
+    if potential_url_counter is not None:
+        await potential_url_counter.close()
+
     global crawl_message_queue
     global stream_token
 
@@ -571,6 +849,27 @@ async def stop_crawl(
     return {"message": "Crawl stopped successfully"}
 
 
+@app.post("/update-authority")
+async def update_page_authority(
+    token=Depends(oauth2_scheme),
+    postgres_client=Depends(get_postgres_client),
+):
+    """
+    Rebuilds the link graph between the crawled pages and reranks their
+    authority in the background. Bulk ingest crawls do this when they
+    end, other crawls can run it once they're done.
+    """
+    check_auth(token)
+
+    async def update():
+        if await storage.rebuild_links(postgres_client):
+            await rank.update_authority(postgres_client)
+
+    asyncio.create_task(update())
+
+    return {"message": "Authority update started"}
+
+
 @app.post("/toggle-crawl")
 async def toggle_crawl(
     crawl_pause=Depends(get_crawl_pause),
@@ -1,12 +1,15 @@
 """
 Description:
-    Types used by the crawler and processor.
+    Types used by the crawler, processor and search.
 
 Created:
     2024-09-28
 """
 
 import asyncio
+import time
+from collections import OrderedDict
+import numpy as np
 
 
 class AsyncList:
@@ -32,3 +35,209 @@ class AsyncList:
             if self._list:
                 return self._list.pop(0)
             return None
+
+
+class LRUCache:
+    """
+    Simple least recently used cache. Once it's full, adding an item
+    evicts the item that was used longest ago.
+    """
+
+    def __init__(self, max_size: int = 1024):
+        self._max_size = max_size
+        self._items = OrderedDict()
+
+    def get(self, key, default=None):
+        if key not in self._items:
+            return default
+
+        self._items.move_to_end(key)
+        return self._items[key]
+
+    def set(self, key, value):
+        self._items[key] = value
+        self._items.move_to_end(key)
+
+        if len(self._items) > self._max_size:
+            self._items.popitem(last=False)
+
+    def clear(self):
+        self._items.clear()
+
+    def __len__(self):
+        return len(self._items)
+
+
+class TTLCache(LRUCache):
+    """
+    Least recently used cache whose items also expire a fixed number of
+    seconds after they're added, unless they're added with their own
+    time to live.
+    """
+
+    def __init__(self, max_size: int = 1024, ttl: float = 300.0):
+        super().__init__(max_size)
+        self._ttl = ttl
+
+    def get(self, key, default=None):
+        item = super().get(key)
+
+        if item is None:
+            return default
+
+        value, expires = item
+
+        if time.monotonic() > expires:
+            del self._items[key]
+            return default
+
+        return value
+
+    def set(self, key, value, ttl=None):
+        ttl = self._ttl if ttl is None else ttl
+        super().set(key, (value, time.monotonic() + ttl))
+
+
+class SemanticCache:
+    """
+    Cache keyed by embedding similarity rather than exact text. Stores
+    recent query vectors in a matrix and returns the value cached for
+    the most similar query, if it's within the cosine threshold and was
+    cached under the same context. Once full the oldest entry is
+    replaced, and entries expire a fixed number of seconds after they're
+    added, unless they're added with their own time to live.
+    """
+
+    def __init__(
+        self,
+        max_size: int = 256,
+        threshold: float = 0.95,
+        ttl: float = 300.0,
+    ):
+        self.threshold = threshold
+        self._max_size = max_size
+        self._ttl = ttl
+        self._vectors = None
+        self._entries = [None] * max_size
+        self._next = 0
+
+    def get(self, vector, context=None, default=None):
+        if self._vectors is None:
+            return default
+
+        # Cosine similarity of the query to every cached query
+        similarities = self._vectors @ self._normalise(vector)
+
+        now = time.monotonic()
+        for idx in np.argsort(similarities)[::-1]:
+            if similarities[idx] < self.threshold:
+                break
+
+            entry = self._entries[idx]
+            if entry is None or entry[2] < now or entry[0] != context:
+                continue
+
+            return entry[1]
+
+        return default
+
+    def set(self, vector, value, context=None, ttl=None):
+        ttl = self._ttl if ttl is None else ttl
+        vector = self._normalise(vector)
+
+        if self._vectors is None:
+            self._vectors = np.zeros((self._max_size, len(vector)), np.float32)
+
+        self._vectors[self._next] = vector
+        self._entries[self._next] = (context, value, time.monotonic() + ttl)
+        self._next = (self._next + 1) % self._max_size
+
+    def clear(self):
+        self._vectors = None
+        self._entries = [None] * self._max_size
+        self._next = 0
+
+    @staticmethod
+    def _normalise(vector):
+        vector = np.asarray(vector, dtype=np.float32)
+        return vector / (np.linalg.norm(vector) or 1.0)
+
+
+class SingleFlight:
+    """
+    Coalesces concurrent calls with the same key. The first caller
+    starts the call and everyone who arrives while it's running waits
+    for, and shares, its result. Streamed calls share every item their
+    async generator yields, so callers who arrive late still get the
+    items from the first. Cancelling one caller doesn't cancel the call
+    for the others.
+    """
+
+    def __init__(self):
+        self._calls = {}
+        self._streams = {}
+
+    async def do(self, key, func, *args, **kwargs):
+        call = self._calls.get(key)
+
+        if call is None:
+            call = asyncio.ensure_future(func(*args, **kwargs))
+            self._calls[key] = call
+            call.add_done_callback(lambda _: self._calls.pop(key, None))
+
+        return await asyncio.shield(call)
+
+    async def stream(self, key, func, *args, **kwargs):
+        stream = self._streams.get(key)
+
+        if stream is None:
+            stream = SharedStream(func(*args, **kwargs))
+            self._streams[key] = stream
+            stream.task.add_done_callback(lambda _: self._streams.pop(key, None))
+
+        async for item in stream:
+            yield item
+
+    def __len__(self):
+        return len(self._calls) + len(self._streams)
+
+
+class SharedStream:
+    """
+    Reads an async generator on a task of its own, keeping its items so
+    any number of readers can iterate over them from the first. Readers
+    wait for the items that haven't been yielded yet, and get the
+    generator's exception once they've read its items.
+    """
+
+    def __init__(self, generator):
+        self.items = []
+        self._updated = asyncio.get_running_loop().create_future()
+        self.task = asyncio.ensure_future(self._read(generator))
+
+    async def _read(self, generator):
+        try:
+            async for item in generator:
+                self.items.append(item)
+                self._notify()
+
+        finally:
+            self._notify()
+
+    def _notify(self):
+        self._updated.set_result(None)
+        self._updated = asyncio.get_running_loop().create_future()
+
+    async def __aiter__(self):
+        read = 0
+
+        while True:
+            while read < len(self.items):
+                yield self.items[read]
+                read += 1
+
+            if self.task.done():
+                self.task.result()
+                return
+
+            await asyncio.shield(self._updated)
@@ -70,3 +70,14 @@ class Result(BaseModel):
     score: float
     faviconLocation: str
     published: str
+    snippetHighlights: list[tuple[int, int]] = []
+
+
+class SearchEvent(BaseModel):
+    stage: str
+    results: list[Result] = []
+
+
+class SimilarSite(BaseModel):
+    site: str
+    score: float
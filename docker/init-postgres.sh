@@ -11,10 +11,32 @@ EOSQL
 psql -v ON_ERROR_STOP=1 --username "$POSTGRES_USER" --dbname "$POSTGRES_DB" <<-EOSQL
     CREATE TABLE resources (
         id SERIAL PRIMARY KEY,
-        url VARCHAR(2048) NOT NULL,
+        url VARCHAR(2048) NOT NULL UNIQUE,
         firstVisited TIMESTAMP NOT NULL,
         lastVisited TIMESTAMP NOT NULL,
         allVisits INT DEFAULT 1,
-        externalLinks TEXT[]
+        externalLinks TEXT[],
+        title TEXT,
+        siteName TEXT,
+        description TEXT,
+        published TIMESTAMP,
+        favicon TEXT,
+        authority DOUBLE PRECISION NOT NULL DEFAULT 0
+    );
+
+    CREATE TABLE chunks (
+        resource_id INT NOT NULL REFERENCES resources (id) ON DELETE CASCADE,
+        chunk INT NOT NULL,
+        content TEXT COMPRESSION lz4 NOT NULL,
+        tsv TSVECTOR GENERATED ALWAYS AS (to_tsvector('english', content)) STORED,
+        PRIMARY KEY (resource_id, chunk)
+    );
+
+    CREATE INDEX chunks_tsv_idx ON chunks USING GIN (tsv);
+
+    CREATE TABLE links (
+        source_id INT NOT NULL REFERENCES resources (id) ON DELETE CASCADE,
+        target_id INT NOT NULL REFERENCES resources (id) ON DELETE CASCADE,
+        PRIMARY KEY (source_id, target_id)
     );
 EOSQL
@@ -3,6 +3,7 @@ export type Result = {
 	siteName: string;
 	url: string;
 	snippet: string;
+	snippetHighlights: [number, number][];
 	score: number;
 	faviconLocation: string;
 	published: string;
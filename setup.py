@@ -1,6 +1,6 @@
-from qdrant_client import QdrantClient
-from qdrant_client.models import VectorParams, Distance
+from qdrant_client import QdrantClient, AsyncQdrantClient
 import asyncpg
+from app.core.storage import setup_collection
 
 
 async def setup_postgres(ayncpg: asyncpg.Connection):
@@ -13,12 +13,18 @@ async def setup_postgres(ayncpg: asyncpg.Connection):
     # Create the resource table
     resources_sql = """CREATE TABLE resources ( 
         id SERIAL PRIMARY KEY,
-        url VARCHAR(2048) NOT NULL,
+        url VARCHAR(2048) NOT NULL UNIQUE,
         firstVisited TIMESTAMP NOT NULL,
         lastVisited TIMESTAMP NOT NULL,
         allVisits INT DEFAULT 1,
         externalLinks TEXT[],
-        timeBetweenVisits INT
+        timeBetweenVisits INT,
+        title TEXT,
+        siteName TEXT,
+        description TEXT,
+        published TIMESTAMP,
+        favicon TEXT,
+        authority DOUBLE PRECISION NOT NULL DEFAULT 0
     );"""
 
     await client.execute(resources_sql)
@@ -44,21 +50,43 @@ async def setup_postgres(ayncpg: asyncpg.Connection):
 
     potential_urls_sql = """CREATE TABLE potential_urls ( 
         id SERIAL PRIMARY KEY,
-        url VARCHAR(2048) NOT NULL,
+        url VARCHAR(2048) NOT NULL UNIQUE,
         firstSeen TIMESTAMP NOT NULL,
         timesSeen INT DEFAULT 1
     );"""
 
     await client.execute(potential_urls_sql)
 
+    # Create the chunks table with its full text search index
+    chunks_sql = """CREATE TABLE chunks (
+        resource_id INT NOT NULL REFERENCES resources (id) ON DELETE CASCADE,
+        chunk INT NOT NULL,
+        content TEXT COMPRESSION lz4 NOT NULL,
+        tsv TSVECTOR GENERATED ALWAYS AS (to_tsvector('english', content)) STORED,
+        PRIMARY KEY (resource_id, chunk)
+    );"""
+
+    await client.execute(chunks_sql)
+    await client.execute("CREATE INDEX chunks_tsv_idx ON chunks USING GIN (tsv);")
+
+    # Create the links table
+    links_sql = """CREATE TABLE links (
+        source_id INT NOT NULL REFERENCES resources (id) ON DELETE CASCADE,
+        target_id INT NOT NULL REFERENCES resources (id) ON DELETE CASCADE,
+        PRIMARY KEY (source_id, target_id)
+    );"""
+
+    await client.execute(links_sql)
+
     print("added all tables")
 
 
 async def setup_qdrant(qdrant: QdrantClient):
+    # The collection schema is managed by the app, which uses an async
+    # client connected the same way as the one passed in
+    client = AsyncQdrantClient(**qdrant.init_options)
+
     # Add the embeddings collection if the containers have been restarted
-    created = qdrant.create_collection(
-        collection_name="embeddings",
-        vectors_config=VectorParams(size=384, distance=Distance.COSINE),
-    )
+    created = await setup_collection(client)
 
     print("Embeddings collection created:", created)
@@ -102,11 +102,17 @@ async def empty_postgres_client(base_postgres_details: str):
         # Create the resource table
         resources_sql = """CREATE TABLE resources ( 
             id SERIAL PRIMARY KEY,
-            url VARCHAR(2048) NOT NULL,
+            url VARCHAR(2048) NOT NULL UNIQUE,
             firstVisited TIMESTAMP NOT NULL,
             lastVisited TIMESTAMP NOT NULL,
             allVisits INT DEFAULT 1,
-            externalLinks TEXT[]
+            externalLinks TEXT[],
+            title TEXT,
+            siteName TEXT,
+            description TEXT,
+            published TIMESTAMP,
+            favicon TEXT,
+            authority DOUBLE PRECISION NOT NULL DEFAULT 0
         );"""
 
         await client.execute(resources_sql)
@@ -130,18 +136,41 @@ async def empty_postgres_client(base_postgres_details: str):
 
         potential_urls_sql = """CREATE TABLE potential_urls ( 
             id SERIAL PRIMARY KEY,
-            url VARCHAR(2048) NOT NULL,
+            url VARCHAR(2048) NOT NULL UNIQUE,
             firstSeen TIMESTAMP NOT NULL,
             timesSeen INT DEFAULT 1
         );"""
 
         await client.execute(potential_urls_sql)
 
+        # Create the chunks table
+        chunks_sql = """CREATE TABLE chunks (
+            resource_id INT NOT NULL REFERENCES resources (id) ON DELETE CASCADE,
+            chunk INT NOT NULL,
+            content TEXT NOT NULL,
+            tsv TSVECTOR GENERATED ALWAYS AS (to_tsvector('english', content)) STORED,
+            PRIMARY KEY (resource_id, chunk)
+        );"""
+
+        await client.execute(chunks_sql)
+        await client.execute("CREATE INDEX chunks_tsv_idx ON chunks USING GIN (tsv)")
+
+        # Create the links table
+        links_sql = """CREATE TABLE links (
+            source_id INT NOT NULL REFERENCES resources (id) ON DELETE CASCADE,
+            target_id INT NOT NULL REFERENCES resources (id) ON DELETE CASCADE,
+            PRIMARY KEY (source_id, target_id)
+        );"""
+
+        await client.execute(links_sql)
+
         yield client
 
     finally:
 
         # Clean up all the tables by dropping them
+        await client.execute("DROP TABLE links")
+        await client.execute("DROP TABLE chunks")
         await client.execute("DROP TABLE resources")
         await client.execute("DROP TABLE admins")
         await client.execute("DROP TABLE seed_urls")
@@ -150,6 +179,32 @@ async def empty_postgres_client(base_postgres_details: str):
         await client.close()
 
 
+@pytest_asyncio.fixture(scope="function")
+async def postgres_pool(base_postgres_details: str, empty_postgres_client):
+    """
+    A fixture that provides a connection pool to the database set up by
+    the empty_postgres_client fixture. The pool is closed before the
+    tables are dropped.
+    """
+    from app.core.storage import create_postgres_pool
+
+    # Get the port details
+    port = base_postgres_details
+
+    pool = await create_postgres_pool(
+        min_size=2,
+        max_size=4,
+        database="postgres",
+        user="postgres",
+        host="localhost",
+        port=port,
+    )
+
+    yield pool
+
+    await pool.close()
+
+
 @pytest_asyncio.fixture(scope="function")
 async def populated_postgres_client(base_postgres_details: str):
     """
@@ -174,7 +229,7 @@ async def populated_postgres_client(base_postgres_details: str):
         # Create the table
         table_sql = """CREATE TABLE resources ( 
             id SERIAL PRIMARY KEY,
-            url VARCHAR(2048) NOT NULL,
+            url VARCHAR(2048) NOT NULL UNIQUE,
             firstVisited TIMESTAMP NOT NULL,
             lastVisited TIMESTAMP NOT NULL,
             allVisits INT DEFAULT 1,
@@ -224,36 +279,66 @@ async def vector_client(base_vector_client):
     A fixture that provides a Qdrant client with the embeddings collection
     for testing. That is cleaned once the function is complete.
     """
-    from qdrant_client.models import VectorParams, Distance
+    from app.core.storage import setup_collection
 
-    await base_vector_client.create_collection(
-        collection_name="embeddings",
-        vectors_config=VectorParams(size=384, distance=Distance.COSINE),
-    )
+    await setup_collection(base_vector_client)
 
     yield base_vector_client
 
     await base_vector_client.delete_collection("embeddings")
 
 
+@pytest.fixture(scope="session")
+def search_resource_ids():
+    """
+    A fixture that provides the resource id of each url in the search
+    test data, the first row stored for each url.
+    """
+    from joblib import load
+
+    # Current file path for relative imports regardless of location
+    file_path = os.path.dirname(__file__)
+
+    rows = load(f"{file_path}/test_data/search_data/postgres_meta.joblib")
+
+    resource_ids = {}
+    for row in rows:
+        resource_ids.setdefault(row[1], row[0])
+
+    return resource_ids
+
+
 @pytest_asyncio.fixture(scope="function")
-async def search_vector_client(base_vector_client):
+async def search_vector_client(base_vector_client, search_resource_ids):
     """
     A fixture that provides a Qdrant client with the embeddings collection
     populated with test data crawled from CJ Handmer's blog.
     """
-    from qdrant_client.models import VectorParams, Distance
+    from app.core.storage import setup_collection
     from joblib import load
+    from urllib.parse import urlparse
 
-    await base_vector_client.create_collection(
-        collection_name="embeddings",
-        vectors_config=VectorParams(size=384, distance=Distance.COSINE),
-    )
+    await setup_collection(base_vector_client)
 
     # Current file path for relative imports regardless of location
     file_path = os.path.dirname(__file__)
 
     vectors = load(f"{file_path}/test_data/search_data/qdrant_vectors.joblib")
+
+    # The test data was stored with url payloads, swap them for the
+    # compact payload schema
+    chunks = {}
+    for vector in vectors:
+        url = vector.payload["text"]["url"]
+        chunks[url] = chunks.get(url, -1) + 1
+
+        vector.payload = {
+            "resource_id": search_resource_ids[url],
+            "chunk": chunks[url],
+            "site": urlparse(url).netloc.lower(),
+            "type": "webpage",
+        }
+
     await base_vector_client.upsert(
         collection_name="embeddings",
         points=vectors,
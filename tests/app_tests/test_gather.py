@@ -64,21 +64,23 @@ async def test_gather(
 
     assert len(points) == 4
 
-    # Check the database has the correct number of resources
-    results = await db_client.fetch("SELECT * FROM resources")
-    assert len(results) == 5
+    # Check the database has the correct number of resources, the
+    # revisited url updates its existing row
+    results = await db_client.fetch("SELECT * FROM resources ORDER BY id")
+    assert len(results) == 4
 
-    # Check the set of urls stored is the same
-    vector_urls = [p.payload["text"]["url"] for p in points]
-    db_urls = [r[1] for r in results]
-    assert set(vector_urls) == set(db_urls)
+    # Check the points are stored against the same resources
+    vector_ids = [p.payload["resource_id"] for p in points]
+    db_ids = [r[0] for r in results]
+    assert set(vector_ids) == set(db_ids)
 
     # Check the links and the urls are correct
-    assert results[1][1] == server_url
-    assert results[1][5][0] == f"{local_site}/page2.html"
+    assert results[0][1] == server_url
+    assert results[0][4] == 2
+    assert results[0][5][0] == f"{local_site}/page2.html"
 
-    assert results[2][1] == f"{local_site}/page2.html"
-    assert results[2][5][0] == f"{local_site}/page1.html"
+    assert results[1][1] == f"{local_site}/page2.html"
+    assert results[1][5][0] == f"{local_site}/page1.html"
 
 
 @pytest.mark.asyncio
@@ -159,18 +161,20 @@ async def test_pausing_gather(
 
     assert len(points) == 4
 
-    # Check the database has the correct number of resources
-    results = await db_client.fetch("SELECT * FROM resources")
-    assert len(results) == 5
+    # Check the database has the correct number of resources, the
+    # revisited url updates its existing row
+    results = await db_client.fetch("SELECT * FROM resources ORDER BY id")
+    assert len(results) == 4
 
-    # Check the set of urls stored is the same
-    vector_urls = [p.payload["text"]["url"] for p in points]
-    db_urls = [r[1] for r in results]
-    assert set(vector_urls) == set(db_urls)
+    # Check the points are stored against the same resources
+    vector_ids = [p.payload["resource_id"] for p in points]
+    db_ids = [r[0] for r in results]
+    assert set(vector_ids) == set(db_ids)
 
     # Check the links and the urls are correct
-    assert results[1][1] == server_url
-    assert results[1][5][0] == f"{local_site}/page2.html"
+    assert results[0][1] == server_url
+    assert results[0][4] == 2
+    assert results[0][5][0] == f"{local_site}/page2.html"
 
-    assert results[2][1] == f"{local_site}/page2.html"
-    assert results[2][5][0] == f"{local_site}/page1.html"
+    assert results[1][1] == f"{local_site}/page2.html"
+    assert results[1][5][0] == f"{local_site}/page1.html"
@@ -531,10 +531,10 @@ async def test_start_crawl(
     results = await empty_postgres_client.fetch("SELECT * FROM resources")
     assert len(results) == 4
 
-    # Check the set of urls stored is the same
-    vector_urls = [p.payload["text"]["url"] for p in points]
-    db_urls = [r[1] for r in results]
-    assert set(vector_urls) == set(db_urls)
+    # Check the points are stored against the same resources
+    vector_ids = [p.payload["resource_id"] for p in points]
+    db_ids = [r[0] for r in results]
+    assert set(vector_ids) == set(db_ids)
 
     # Check the links and the urls are correct
     assert results[0][1] == server_url
@@ -750,10 +750,10 @@ async def test_toggle_crawl(
     results = await empty_postgres_client.fetch("SELECT * FROM resources")
     assert len(results) == 4
 
-    # Check the set of urls stored is the same
-    vector_urls = [p.payload["text"]["url"] for p in points]
-    db_urls = [r[1] for r in results]
-    assert set(vector_urls) == set(db_urls)
+    # Check the points are stored against the same resources
+    vector_ids = [p.payload["resource_id"] for p in points]
+    db_ids = [r[0] for r in results]
+    assert set(vector_ids) == set(db_ids)
 
     # Check the links and the urls are correct
     assert results[0][1] == server_url
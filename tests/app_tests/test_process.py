@@ -2,6 +2,7 @@ import pytest
 import app.core.process as process
 import asyncio
 from bs4 import BeautifulSoup
+from datetime import datetime
 
 
 @pytest.mark.asyncio
@@ -137,3 +138,44 @@ async def test_process_with_empty_links(
     assert results[0][1] == "https://caseyhandmer.wordpress.com/"
     assert results[0][4] == 1
     assert len(results[0][5]) == 0
+
+
+def test_extract_page_metadata(soup):
+    """
+    Tests the page metadata is read from the head of the page, and the
+    fallbacks used when a page has none.
+    """
+    metadata = process.extract_page_metadata(
+        soup, "https://caseyhandmer.wordpress.com/"
+    )
+
+    assert metadata["title"] == "Casey Handmer's blog"
+    assert metadata["siteName"] == "Casey Handmer's blog"
+    assert metadata["description"] == (
+        "Space, Travel, Technology, 3D Printing, Energy, Writing"
+    )
+    assert metadata["published"] is None
+    assert metadata["favicon"].endswith("?w=32")
+
+    html = """<html><head>
+        <title> A post </title>
+        <link rel="shortcut icon" href="/icon.png">
+        <meta property="article:published_time" content="2024-01-02T03:04:05+02:00">
+    </head></html>"""
+    metadata = process.extract_page_metadata(
+        BeautifulSoup(html, "html.parser"), "https://example.com/posts/1"
+    )
+
+    assert metadata == {
+        "title": "A post",
+        "siteName": "example.com",
+        "description": "",
+        "published": datetime(2024, 1, 2, 1, 4, 5),
+        "favicon": "https://example.com/icon.png",
+    }
+
+    metadata = process.extract_page_metadata(
+        BeautifulSoup("<p>Hello</p>", "html.parser"), "https://example.com/a"
+    )
+
+    assert metadata["favicon"] == "https://example.com/favicon.ico"
@@ -0,0 +1,91 @@
+import pytest
+import numpy as np
+from datetime import datetime
+import app.core.rank as rank
+import app.core.storage as st
+
+
+def test_compute_pagerank():
+    """
+    Tests PageRank matches a dense power iteration, and that pages
+    without links share their rank.
+    """
+    # 0 -> 1, 0 -> 2, 1 -> 2, 2 -> 0, 3 has no links
+    sources = np.array([0, 0, 1, 2])
+    targets = np.array([1, 2, 2, 0])
+
+    ranks = rank.compute_pagerank(sources, targets, 4, tolerance=1e-12)
+
+    # Dense version, the dangling page links to every page
+    transitions = np.zeros((4, 4))
+    transitions[targets, sources] = 1 / np.bincount(sources, minlength=4)[sources]
+    transitions[:, 3] = 1 / 4
+    google = 0.85 * transitions + 0.15 / 4
+
+    expected = np.full(4, 1 / 4)
+    for _ in range(1000):
+        expected = google @ expected
+
+    assert np.isclose(ranks.sum(), 1)
+    assert np.allclose(ranks, expected)
+    assert ranks.argmax() == 2
+
+    assert len(rank.compute_pagerank(np.array([]), np.array([]), 0)) == 0
+
+
+@pytest.mark.asyncio
+async def test_update_authority(empty_postgres_client):
+    """
+    Tests the authority of each resource is stored from the links, with
+    the most linked to page having an authority of 1 and pages nothing
+    links to having an authority of 0.
+    """
+    the_time = datetime.now()
+    pages = {
+        "https://a.com": ["https://c.com"],
+        "https://b.com": ["https://c.com"],
+        "https://c.com": ["https://a.com"],
+    }
+
+    for url, links in pages.items():
+        await st.log_resource(
+            st.Resource(url, the_time, the_time, 1, links), empty_postgres_client
+        )
+
+    assert await st.rebuild_links(empty_postgres_client)
+
+    generation = st.get_index_generation()
+    assert await rank.update_authority(empty_postgres_client)
+    assert st.get_index_generation() > generation
+
+    rows = await empty_postgres_client.fetch(
+        "SELECT url, authority FROM resources ORDER BY authority DESC"
+    )
+
+    assert [row["url"] for row in rows] == [
+        "https://c.com",
+        "https://a.com",
+        "https://b.com",
+    ]
+    assert rows[0]["authority"] == 1
+    assert 0 < rows[1]["authority"] < 1
+    assert rows[2]["authority"] == 0
+
+
+@pytest.mark.asyncio
+async def test_update_authority_without_links(empty_postgres_client):
+    """
+    Tests pages get no authority when there are no links between them,
+    the same as pages crawled since the last update.
+    """
+    the_time = datetime.now()
+    for url in ["https://a.com", "https://b.com"]:
+        await st.log_resource(
+            st.Resource(url, the_time, the_time, 1, []), empty_postgres_client
+        )
+
+    assert await st.rebuild_links(empty_postgres_client)
+    assert await rank.update_authority(empty_postgres_client)
+
+    rows = await empty_postgres_client.fetch("SELECT authority FROM resources")
+    assert [row["authority"] for row in rows] == [0, 0]
@@ -1,6 +1,12 @@
 import pytest
 import app.core.search as search
 import time
+import asyncio
+import datetime
+import uuid
+import numpy as np
+from qdrant_client.models import Filter, FieldCondition, MatchValue, PointStruct
+from app.models.data_types import Result
 
 
 @pytest.mark.asyncio
@@ -28,7 +34,9 @@ async def test_get_top_matches(
 
 
 @pytest.mark.asyncio
-async def test_fetch_matches(search_vector_client, embedding_model):
+async def test_fetch_matches(
+    search_vector_client, search_resource_ids, embedding_model
+):
     """
     Tests the fetch_matches function correctly returns the closest matches.
     """
@@ -47,7 +55,10 @@ async def test_fetch_matches(search_vector_client, embedding_model):
     print("Time taken:", time.time() - start)
 
     # Get the urls and scores
-    urls = [m.payload["text"]["url"] for m in matches]
+    urls = {
+        resource_id: url for url, resource_id in search_resource_ids.items()
+    }
+    urls = [urls[m.payload["resource_id"]] for m in matches]
 
     scores = [m.score for m in matches]
 
@@ -69,3 +80,998 @@ async def test_fetch_matches(search_vector_client, embedding_model):
     assert round(scores[0], 6) == 0.529455
     assert round(scores[1], 6) == 0.517381
     assert round(scores[2], 6) == 0.515256
+
+
+@pytest.mark.asyncio
+async def test_fetch_grouped_matches(search_vector_client):
+    """
+    Tests the fetch_grouped_matches function returns one group per
+    resource, with the resource the query came from ranked first.
+    """
+    # Use a stored chunk as the query
+    points, _ = await search_vector_client.scroll(
+        collection_name="embeddings", limit=1, with_vectors=True
+    )
+    point = points[0]
+
+    groups = await search.fetch_grouped_matches(
+        search_vector_client, point.vector, limit=10, group_size=3
+    )
+
+    assert len(groups) == 10
+    assert len({group.id for group in groups}) == 10
+    assert all(len(group.hits) <= 3 for group in groups)
+
+    assert groups[0].id == point.payload["resource_id"]
+    assert groups[0].hits[0].id == point.id
+
+
+def test_aggregate_scores():
+    """
+    Tests each way of aggregating chunk scores, the softmax sits
+    between the max and the mean.
+    """
+    scores = [0.5, 0.4, 0.1]
+
+    assert search.aggregate_scores(scores, "sum") == pytest.approx(1.0)
+    assert search.aggregate_scores(scores, "max") == pytest.approx(0.5)
+
+    softmax = search.aggregate_scores(scores, "softmax")
+    assert np.mean(scores) < softmax < 0.5
+
+    with pytest.raises(ValueError):
+        search.aggregate_scores(scores, "median")
+
+
+@pytest.mark.asyncio
+async def test_get_top_matches_cache(
+    search_vector_client, empty_postgres_client, search_resource_ids
+):
+    """
+    Tests repeat searches reuse the cached query embedding and results,
+    and that writing to the index invalidates the cached results.
+    """
+    from app.core.storage import bump_index_generation
+
+    # Store the resources the test embeddings belong to
+    await empty_postgres_client.executemany(
+        "INSERT INTO resources (id, url, firstVisited, lastVisited) VALUES ($1, $2, now(), now())",
+        [(resource_id, url) for url, resource_id in search_resource_ids.items()],
+    )
+
+    # Embed queries with a stored chunk, counting the calls
+    points, _ = await search_vector_client.scroll(
+        collection_name="embeddings", limit=1, with_vectors=True
+    )
+
+    class CountingModel:
+        calls = 0
+
+        def encode(self, query, convert_to_numpy=True):
+            self.calls += 1
+            return np.array(points[0].vector)
+
+    model = CountingModel()
+    search.query_embedding_cache.clear()
+    search.search_result_cache.clear()
+    search.semantic_result_cache.clear()
+
+    first = await search.get_top_matches(
+        "Solar  Power", model, search_vector_client, empty_postgres_client
+    )
+    assert first[0].url in search_resource_ids
+    assert model.calls == 1
+
+    # Same normalised query, no embedding or search needed
+    await empty_postgres_client.execute("DELETE FROM resources")
+
+    second = await search.get_top_matches(
+        "solar power", model, search_vector_client, empty_postgres_client
+    )
+    assert second == first
+    assert model.calls == 1
+
+    # A new index generation searches again with the cached embedding
+    bump_index_generation()
+
+    third = await search.get_top_matches(
+        "solar power", model, search_vector_client, empty_postgres_client
+    )
+    assert third == []
+    assert model.calls == 1
+
+
+@pytest.mark.asyncio
+async def test_get_top_matches_semantic_cache(
+    search_vector_client, empty_postgres_client, search_resource_ids
+):
+    """
+    Tests paraphrased searches share results with snippets for their
+    own terms, and hybrid searches only share results with queries that
+    have the same lexemes.
+    """
+    await empty_postgres_client.executemany(
+        "INSERT INTO resources (id, url, firstVisited, lastVisited) VALUES ($1, $2, now(), now())",
+        [(resource_id, url) for url, resource_id in search_resource_ids.items()],
+    )
+
+    points, _ = await search_vector_client.scroll(
+        collection_name="embeddings", limit=10000, with_vectors=True
+    )
+    await empty_postgres_client.executemany(
+        "INSERT INTO chunks (resource_id, chunk, content) VALUES ($1, $2, $3)",
+        {
+            (point.payload["resource_id"], point.payload["chunk"], "solar and wind")
+            for point in points
+        },
+    )
+
+    # Every query has the same embedding
+    class Model:
+        def encode(self, query, convert_to_numpy=True):
+            return np.array(points[0].vector)
+
+    search.query_embedding_cache.clear()
+    search.lexical_query_cache.clear()
+    search.search_result_cache.clear()
+    search.semantic_result_cache.clear()
+
+    async def search_for(query, hybrid):
+        return await search.get_top_matches(
+            query,
+            Model(),
+            search_vector_client,
+            empty_postgres_client,
+            hybrid=hybrid,
+        )
+
+    first = await search_for("solar", hybrid=False)
+    hybrid_first = await search_for("solar", hybrid=True)
+    assert first and hybrid_first
+
+    # Searching again would find nothing, so results come from the cache
+    await empty_postgres_client.execute("DELETE FROM resources")
+
+    paraphrase = await search_for("wind", hybrid=False)
+    assert [r.url for r in paraphrase] == [r.url for r in first]
+    assert first[0].snippetHighlights == [(0, 5)]
+    assert paraphrase[0].snippetHighlights == [(10, 14)]
+
+    # Hybrid searches with the same lexemes share results, those with
+    # other lexemes aren't answered from the cache
+    assert await search_for("the Solar's", hybrid=True) == hybrid_first
+    assert await search_for("wind", hybrid=True) == []
+
+
+def test_ttl_cache():
+    """
+    Tests the TTL cache expires items and evicts the least recently
+    used item once it's full.
+    """
+    from app.models.app_types import TTLCache
+
+    cache = TTLCache(max_size=2, ttl=60)
+    cache.set("a", 1)
+    cache.set("b", 2)
+
+    # Using a makes b the least recently used
+    assert cache.get("a") == 1
+    cache.set("c", 3)
+
+    assert cache.get("b") is None
+    assert cache.get("a") == 1
+    assert cache.get("c") == 3
+
+    # Expired items are dropped
+    cache = TTLCache(max_size=2, ttl=-1)
+    cache.set("a", 1)
+    assert cache.get("a") is None
+    assert len(cache) == 0
+
+    # Items can be given their own time to live
+    cache.set("a", 1, ttl=60)
+    assert cache.get("a") == 1
+
+
+def test_semantic_cache():
+    """
+    Tests the semantic cache returns the value of a similar enough
+    query cached under the same context.
+    """
+    from app.models.app_types import SemanticCache
+
+    generator = np.random.default_rng(seed=0)
+    vector = generator.random(384)
+    paraphrase = vector + generator.normal(scale=0.01, size=384)
+    unrelated = generator.normal(size=384)
+
+    cache = SemanticCache(max_size=2, threshold=0.95)
+    assert cache.get(vector) is None
+
+    cache.set(vector, ["result"], context=1)
+
+    assert cache.get(paraphrase, context=1) == ["result"]
+    assert cache.get(unrelated, context=1) is None
+    assert cache.get(paraphrase, context=2) is None
+
+    # The oldest entry is replaced once the cache is full
+    cache.set(unrelated, ["other"], context=1)
+    cache.set(generator.normal(size=384), ["newest"], context=1)
+
+    assert cache.get(vector, context=1) is None
+    assert cache.get(unrelated, context=1) == ["other"]
+
+
+@pytest.mark.asyncio
+async def test_get_top_matches_single_flight(
+    search_vector_client, empty_postgres_client, search_resource_ids
+):
+    """
+    Tests concurrent identical searches share one search of the index,
+    with each caller getting its own copy of the results.
+    """
+    await empty_postgres_client.executemany(
+        "INSERT INTO resources (id, url, firstVisited, lastVisited) VALUES ($1, $2, now(), now())",
+        [(resource_id, url) for url, resource_id in search_resource_ids.items()],
+    )
+
+    points, _ = await search_vector_client.scroll(
+        collection_name="embeddings", limit=1, with_vectors=True
+    )
+
+    class CountingModel:
+        calls = 0
+
+        def encode(self, query, convert_to_numpy=True):
+            self.calls += 1
+            return np.array(points[0].vector)
+
+    model = CountingModel()
+
+    results = await asyncio.gather(
+        *[
+            search.get_top_matches(
+                "solar power",
+                model,
+                search_vector_client,
+                empty_postgres_client,
+                use_cache=False,
+            )
+            for _ in range(5)
+        ]
+    )
+
+    assert model.calls == 1
+    assert all(result == results[0] for result in results)
+    assert len({id(result) for result in results}) == 5
+    assert len(search.search_flights) == 0
+
+
+@pytest.mark.asyncio
+async def test_encoding_batcher():
+    """
+    Tests concurrent queries are encoded in one batch and each caller
+    gets the vector for its own query.
+    """
+
+    class BatchModel:
+        batches = []
+
+        def encode(self, queries, convert_to_numpy=True):
+            self.batches.append(list(queries))
+            return np.array([[len(query)] * 3 for query in queries], float)
+
+    model = BatchModel()
+    batcher = search.EncodingBatcher(model, max_wait=0.01, max_batch_size=4)
+
+    queries = ["a", "bb", "ccc"]
+    vectors = await asyncio.gather(*[batcher.encode(query) for query in queries])
+
+    assert model.batches == [queries]
+    for query, vector in zip(queries, vectors):
+        assert vector.tolist() == [len(query)] * 3
+
+    # A full batch is encoded without waiting
+    queries = ["a", "bb", "ccc", "dddd", "eeeee"]
+    vectors = await asyncio.gather(*[batcher.encode(query) for query in queries])
+
+    assert model.batches[1:] == [queries[:4], queries[4:]]
+    assert [vector[0] for vector in vectors] == [1, 2, 3, 4, 5]
+
+
+@pytest.mark.asyncio
+async def test_fetch_lexical_matches(empty_postgres_client):
+    """
+    Tests the lexical search finds exact tokens in the stored chunks
+    and ranks each resource once, and that site filters ignore case.
+    """
+    from app.core.storage import Resource, log_resource
+
+    the_time = datetime.datetime.now()
+    pages = {
+        "https://example.com/a": ["fixing error E0502 in rust", "borrowing twice"],
+        "https://Example.COM/b": ["a guide to async rust"],
+    }
+
+    for url, chunks in pages.items():
+        await log_resource(
+            Resource(url, the_time, the_time, 1, [], chunks), empty_postgres_client
+        )
+
+    matches = await search.fetch_lexical_matches("E0502", empty_postgres_client)
+    assert [match[:2] for match in matches] == [(1, 0)]
+
+    matches = await search.fetch_lexical_matches("rust", empty_postgres_client)
+    assert sorted(resource_id for resource_id, _, _ in matches) == [1, 2]
+
+    # Filters narrow down the resources searched
+    _, filters = search.parse_query("site:example.org")
+    matches = await search.fetch_lexical_matches(
+        "rust", empty_postgres_client, filters=filters
+    )
+    assert matches == []
+
+    _, filters = search.parse_query(f"site:example.com after:{the_time.date()}")
+    matches = await search.fetch_lexical_matches(
+        "rust", empty_postgres_client, filters=filters
+    )
+    assert sorted(resource_id for resource_id, _, _ in matches) == [1, 2]
+
+    _, filters = search.parse_query("type:pdf")
+    matches = await search.fetch_lexical_matches(
+        "rust", empty_postgres_client, filters=filters
+    )
+    assert matches == []
+
+
+def test_reciprocal_rank_fusion():
+    """
+    Tests resources ranked well by both searches come first.
+    """
+    fused = search.reciprocal_rank_fusion([[1, 2, 3], [3, 4, 2]], k=60)
+
+    assert [resource_id for resource_id, _ in fused][:2] == [3, 2]
+    assert fused[0][1] == pytest.approx(1 / 63 + 1 / 61)
+    assert len(fused) == 4
+
+
+@pytest.mark.asyncio
+async def test_get_top_matches_rerank(
+    search_vector_client, empty_postgres_client, search_resource_ids
+):
+    """
+    Tests the cross encoder reorders the best results, and that the
+    first stage order is kept when it runs out of time.
+    """
+    await empty_postgres_client.executemany(
+        "INSERT INTO resources (id, url, firstVisited, lastVisited) VALUES ($1, $2, now(), now())",
+        [(resource_id, url) for url, resource_id in search_resource_ids.items()],
+    )
+
+    points, _ = await search_vector_client.scroll(
+        collection_name="embeddings", limit=1, with_vectors=True
+    )
+
+    class Model:
+        def encode(self, query, convert_to_numpy=True):
+            return np.array(points[0].vector)
+
+    class ReverseReranker:
+        delay = 0
+
+        def predict(self, pairs):
+            time.sleep(self.delay)
+            return np.arange(len(pairs), dtype=float)
+
+    first_stage = await search.get_top_matches(
+        "solar", Model(), search_vector_client, empty_postgres_client, use_cache=False
+    )
+
+    reranker = ReverseReranker()
+    reranked = await search.get_top_matches(
+        "solar",
+        Model(),
+        search_vector_client,
+        empty_postgres_client,
+        reranker=reranker,
+        rerank_top_n=5,
+        use_cache=False,
+    )
+
+    # The top five are reversed, the rest keep their order
+    assert reranked[:5] == first_stage[:5][::-1]
+    assert reranked[5:] == first_stage[5:]
+
+    # Out of time falls back to the first stage order
+    reranker.delay = 0.5
+    fallback = await search.get_top_matches(
+        "solar",
+        Model(),
+        search_vector_client,
+        empty_postgres_client,
+        reranker=reranker,
+        rerank_top_n=5,
+        rerank_budget=0.05,
+        use_cache=False,
+    )
+
+    assert fallback == first_stage
+
+    # The abandoned rerank is still running, so the next search skips
+    # reranking instead of queueing behind it
+    reranker.delay = 0
+    start = time.monotonic()
+    busy = await search.get_top_matches(
+        "solar",
+        Model(),
+        search_vector_client,
+        empty_postgres_client,
+        reranker=reranker,
+        rerank_top_n=5,
+        rerank_budget=5,
+        use_cache=False,
+    )
+
+    assert busy == first_stage
+    assert time.monotonic() - start < 0.4
+
+    # Wait for the rerank thread to finish before the next test
+    search.rerank_executor.submit(lambda: None).result()
+
+
+def test_build_snippet():
+    """
+    Checks the snippet is the window of words with the most query terms
+    and the highlights point at the terms within it.
+    """
+    before = " ".join(f"before{i}" for i in range(100))
+    after = " ".join(f"after{i}" for i in range(100))
+    content = f"{before} fixing error E0502 in the Rust borrow checker {after}"
+
+    snippet, highlights = search.build_snippet(content, "rust e0502", length=10)
+
+    assert len(snippet.split()) == 10
+    assert [snippet[start:end] for start, end in highlights] == ["E0502", "Rust"]
+
+    # Short and empty content
+    assert search.build_snippet("about rust", "Rust") == ("about rust", [(6, 10)])
+    assert search.build_snippet("", "rust") == ("", [])
+
+
+@pytest.mark.asyncio
+async def test_get_result_page(
+    search_vector_client, empty_postgres_client, search_resource_ids
+):
+    """
+    Tests paging through a search returns every result once, that the
+    last page has no next token, and that tokens are tied to their
+    query and options.
+    """
+    await empty_postgres_client.executemany(
+        "INSERT INTO resources (id, url, firstVisited, lastVisited) VALUES ($1, $2, now(), now())",
+        [(resource_id, url) for url, resource_id in search_resource_ids.items()],
+    )
+
+    points, _ = await search_vector_client.scroll(
+        collection_name="embeddings", limit=1, with_vectors=True
+    )
+
+    class Model:
+        def encode(self, query, convert_to_numpy=True):
+            return np.array(points[0].vector)
+
+    all_results = await search.get_top_matches(
+        "solar",
+        Model(),
+        search_vector_client,
+        empty_postgres_client,
+        match_limit=search.MAX_SEARCH_DEPTH,
+        hybrid=False,
+        use_cache=False,
+    )
+
+    pages, page_token = [], None
+    while True:
+        page, page_token = await search.get_result_page(
+            "solar",
+            Model(),
+            search_vector_client,
+            empty_postgres_client,
+            page_size=4,
+            page_token=page_token,
+            hybrid=False,
+        )
+        pages.append(page)
+
+        if page_token is None:
+            break
+
+    urls = [result.url for page in pages for result in page]
+
+    assert len(pages) > 2
+    assert len(urls) == len(set(urls))
+    assert set(urls) == {result.url for result in all_results}
+    assert all(len(page) == 4 for page in pages[:-1])
+
+    _, page_token = await search.get_result_page(
+        "solar",
+        Model(),
+        search_vector_client,
+        empty_postgres_client,
+        page_size=4,
+        hybrid=False,
+    )
+
+    with pytest.raises(ValueError):
+        await search.get_result_page(
+            "wind",
+            Model(),
+            search_vector_client,
+            empty_postgres_client,
+            page_size=4,
+            page_token=page_token,
+        )
+
+    # Tokens are also tied to the options that order the results
+    with pytest.raises(ValueError):
+        await search.get_result_page(
+            "solar",
+            Model(),
+            search_vector_client,
+            empty_postgres_client,
+            page_size=4,
+            page_token=page_token,
+            hybrid=False,
+            diversity=0.5,
+        )
+
+    with pytest.raises(ValueError):
+        search.decode_page_token("not a token", "solar")
+
+
+def test_find_cursor():
+    """
+    Tests pages start after the cursor's url, or at their offset when
+    the cursor is gone, whatever the order of the scores.
+    """
+    results = [
+        Result(
+            title="",
+            siteName="",
+            url=f"https://example.com/{i}",
+            snippet="",
+            score=score,
+            faviconLocation="",
+            published="",
+        )
+        for i, score in enumerate([0.2, 0.9, 0.5, 0.8])
+    ]
+
+    assert search.find_cursor(results, 2, None) == 2
+    assert search.find_cursor(results, 2, "https://example.com/1") == 2
+    assert search.find_cursor(results, 1, "https://example.com/2") == 3
+    assert search.find_cursor(results, 2, "https://example.com/gone") == 2
+    assert search.find_cursor(results, 9, "https://example.com/gone") == 4
+
+
+@pytest.mark.asyncio
+async def test_stream_top_matches(
+    search_vector_client, empty_postgres_client, search_resource_ids
+):
+    """
+    Tests the first stage results are streamed before the reranked
+    results, and a repeated search streams the cached results.
+    """
+    await empty_postgres_client.executemany(
+        "INSERT INTO resources (id, url, firstVisited, lastVisited) VALUES ($1, $2, now(), now())",
+        [(resource_id, url) for url, resource_id in search_resource_ids.items()],
+    )
+
+    points, _ = await search_vector_client.scroll(
+        collection_name="embeddings", limit=1, with_vectors=True
+    )
+
+    class Model:
+        def encode(self, query, convert_to_numpy=True):
+            return np.array(points[0].vector)
+
+    class ReverseReranker:
+        def predict(self, pairs):
+            return np.arange(len(pairs), dtype=float)
+
+    stages = [
+        (stage, results)
+        async for stage, results in search.stream_top_matches(
+            "solar streaming",
+            Model(),
+            search_vector_client,
+            empty_postgres_client,
+            reranker=ReverseReranker(),
+            rerank_top_n=5,
+        )
+    ]
+
+    assert [stage for stage, _ in stages] == ["ranked", "reranked"]
+
+    (_, ranked), (_, reranked) = stages
+    assert reranked[:5] == ranked[:5][::-1]
+    assert reranked[5:] == ranked[5:]
+
+    stages = [
+        (stage, results)
+        async for stage, results in search.stream_top_matches(
+            "solar streaming",
+            Model(),
+            search_vector_client,
+            empty_postgres_client,
+            reranker=ReverseReranker(),
+            rerank_top_n=5,
+        )
+    ]
+
+    assert stages == [("cached", reranked)]
+
+
+@pytest.mark.asyncio
+async def test_stream_top_matches_single_flight(
+    search_vector_client, empty_postgres_client, search_resource_ids
+):
+    """
+    Tests concurrent identical streamed searches share one search of the
+    index with each other and with get_top_matches, with every stream
+    getting every stage.
+    """
+    await empty_postgres_client.executemany(
+        "INSERT INTO resources (id, url, firstVisited, lastVisited) VALUES ($1, $2, now(), now())",
+        [(resource_id, url) for url, resource_id in search_resource_ids.items()],
+    )
+
+    points, _ = await search_vector_client.scroll(
+        collection_name="embeddings", limit=1, with_vectors=True
+    )
+
+    class CountingModel:
+        calls = 0
+
+        def encode(self, query, convert_to_numpy=True):
+            self.calls += 1
+            return np.array(points[0].vector)
+
+    class ReverseReranker:
+        def predict(self, pairs):
+            return np.arange(len(pairs), dtype=float)
+
+    model = CountingModel()
+    options = dict(reranker=ReverseReranker(), rerank_top_n=5, use_cache=False)
+
+    async def stream():
+        return [
+            (stage, results)
+            async for stage, results in search.stream_top_matches(
+                "solar flight",
+                model,
+                search_vector_client,
+                empty_postgres_client,
+                **options,
+            )
+        ]
+
+    *streams, results = await asyncio.gather(
+        *[stream() for _ in range(4)],
+        search.get_top_matches(
+            "solar flight",
+            model,
+            search_vector_client,
+            empty_postgres_client,
+            **options,
+        ),
+    )
+
+    assert model.calls == 1
+    assert [stage for stage, _ in streams[0]] == ["ranked", "reranked"]
+    assert all(stages == streams[0] for stages in streams)
+    assert streams[0][-1][1] == results
+    assert len(search.search_flights) == 0
+
+
+def test_parse_query():
+    """
+    Tests search operators are pulled out of queries, and that ones
+    that can't be read are left in the text.
+    """
+    text, filters = search.parse_query(
+        "solar site:Example.com after:2024-01-01 SITE:https://b.org/page "
+        "before:2024-02-01T12:00:00+02:00 type:webpage power"
+    )
+
+    assert text == "solar power"
+    assert filters == search.SearchFilters(
+        sites=("b.org", "example.com"),
+        after=datetime.datetime(2024, 1, 1),
+        before=datetime.datetime(2024, 2, 1, 10),
+        types=("webpage",),
+    )
+
+    text, filters = search.parse_query("after:yesterday website:a.com")
+
+    assert text == "after:yesterday website:a.com"
+    assert filters == search.SearchFilters()
+    assert search.build_filter(filters) is None
+
+
+@pytest.mark.asyncio
+async def test_get_top_matches_filters(
+    search_vector_client, empty_postgres_client, search_resource_ids
+):
+    """
+    Tests search operators filter the resources inside the vector
+    search, so a filtered search still fills its results.
+    """
+    await empty_postgres_client.executemany(
+        "INSERT INTO resources (id, url, firstVisited, lastVisited) VALUES ($1, $2, now(), now())",
+        [(resource_id, url) for url, resource_id in search_resource_ids.items()],
+    )
+
+    points, _ = await search_vector_client.scroll(
+        collection_name="embeddings", limit=1, with_vectors=True
+    )
+
+    class Model:
+        def encode(self, query, convert_to_numpy=True):
+            return np.array(points[0].vector)
+
+    results = await search.get_top_matches(
+        "solar site:caseyhandmer.wordpress.com",
+        Model(),
+        search_vector_client,
+        empty_postgres_client,
+        match_limit=10,
+        hybrid=False,
+    )
+
+    assert len(results) == 10
+    assert all(
+        result.url.startswith("https://caseyhandmer.wordpress.com/")
+        for result in results
+    )
+
+    for query in ["solar site:example.com", "solar type:pdf"]:
+        results = await search.get_top_matches(
+            query,
+            Model(),
+            search_vector_client,
+            empty_postgres_client,
+            hybrid=False,
+        )
+
+        assert results == []
+
+
+def test_maximal_marginal_relevance():
+    """
+    Tests near duplicate candidates are pushed down the results, and
+    that sites are capped.
+    """
+    scores = np.array([1.0, 0.99, 0.5, 0.4])
+    vectors = np.array([[1, 0], [1, 0.01], [0, 1], [0, 0]], dtype=np.float32)
+    sites = ["a.com", "b.com", "c.com", "d.com"]
+
+    # Relevance alone keeps the order
+    order = search.maximal_marginal_relevance(scores, vectors, sites, diversity=0)
+    assert order == [0, 1, 2, 3]
+
+    # The near duplicate of the first candidate drops to the end
+    assert search.maximal_marginal_relevance(
+        scores, vectors, sites, limit=3, diversity=0.5
+    ) == [0, 2, 3]
+
+    sites = ["a.com", "a.com", "a.com", "b.com"]
+    assert search.maximal_marginal_relevance(
+        scores, None, sites, diversity=0, site_limit=2
+    ) == [0, 1, 3]
+
+    assert search.maximal_marginal_relevance(np.array([]), None, []) == []
+
+
+@pytest.mark.asyncio
+async def test_get_top_matches_diversity(
+    search_vector_client, empty_postgres_client, search_resource_ids
+):
+    """
+    Tests diversified searches still fill their results, and that the
+    site limit caps them.
+    """
+    await empty_postgres_client.executemany(
+        "INSERT INTO resources (id, url, firstVisited, lastVisited) VALUES ($1, $2, now(), now())",
+        [(resource_id, url) for url, resource_id in search_resource_ids.items()],
+    )
+
+    points, _ = await search_vector_client.scroll(
+        collection_name="embeddings", limit=1, with_vectors=True
+    )
+
+    class Model:
+        def encode(self, query, convert_to_numpy=True):
+            return np.array(points[0].vector)
+
+    plain = await search.get_top_matches(
+        "solar", Model(), search_vector_client, empty_postgres_client, match_limit=10
+    )
+    diverse = await search.get_top_matches(
+        "solar",
+        Model(),
+        search_vector_client,
+        empty_postgres_client,
+        match_limit=10,
+        diversity=0.7,
+    )
+
+    assert len(diverse) == 10
+    assert diverse[0] == plain[0]
+    assert diverse != plain
+
+    # Every test page is on the same site
+    capped = await search.get_top_matches(
+        "solar",
+        Model(),
+        search_vector_client,
+        empty_postgres_client,
+        match_limit=10,
+        site_limit=2,
+    )
+
+    assert capped == plain[:2]
+
+
+@pytest.mark.asyncio
+async def test_get_similar_pages(
+    search_vector_client, empty_postgres_client, search_resource_ids
+):
+    """
+    Tests similar pages are found from a page's url or one of its
+    chunks, leaving out the page itself, and that missing pages and
+    malformed point ids are reported.
+    """
+    await empty_postgres_client.executemany(
+        "INSERT INTO resources (id, url, firstVisited, lastVisited) VALUES ($1, $2, now(), now())",
+        [(resource_id, url) for url, resource_id in search_resource_ids.items()],
+    )
+
+    url, resource_id = next(iter(search_resource_ids.items()))
+
+    results = await search.get_similar_pages(
+        search_vector_client, empty_postgres_client, url=url, limit=5
+    )
+
+    assert len(results) == 5
+    assert url not in [result.url for result in results]
+    assert [result.score for result in results] == sorted(
+        [result.score for result in results], reverse=True
+    )
+
+    points, _ = await search_vector_client.scroll(
+        collection_name="embeddings",
+        scroll_filter=Filter(
+            must=[
+                FieldCondition(key="resource_id", match=MatchValue(value=resource_id))
+            ]
+        ),
+        limit=1,
+    )
+
+    results = await search.get_similar_pages(
+        search_vector_client, empty_postgres_client, point_id=points[0].id, limit=5
+    )
+
+    assert len(results) == 5
+    assert url not in [result.url for result in results]
+
+    # Pages and chunks that aren't stored can't be found
+    with pytest.raises(LookupError):
+        await search.get_similar_pages(
+            search_vector_client, empty_postgres_client, url="https://example.com"
+        )
+
+    with pytest.raises(LookupError):
+        await search.get_similar_pages(
+            search_vector_client, empty_postgres_client, point_id=str(uuid.uuid4())
+        )
+
+    with pytest.raises(ValueError):
+        await search.get_similar_pages(
+            search_vector_client, empty_postgres_client, point_id="not-a-uuid"
+        )
+
+    with pytest.raises(ValueError):
+        await search.get_similar_pages(search_vector_client, empty_postgres_client)
+
+
+@pytest.mark.asyncio
+async def test_get_similar_sites(vector_client):
+    """
+    Tests sites are ranked by how close their chunks are to the site's
+    centroid.
+    """
+    directions = {"a.com": 0, "b.com": 0, "c.com": 1}
+    points = []
+    for i, (site, direction) in enumerate(directions.items()):
+        for chunk in range(3):
+            vector = np.zeros(384, dtype=np.float32)
+            vector[direction] = 1
+            vector[2 + i * 3 + chunk] = 0.1
+            points.append(
+                PointStruct(
+                    id=i * 3 + chunk,
+                    vector=vector.tolist(),
+                    payload={"site": site, "resource_id": i},
+                )
+            )
+
+    await vector_client.upsert(collection_name="embeddings", points=points)
+
+    sites = await search.get_similar_sites("https://a.com/page", vector_client)
+
+    assert [site for site, _ in sites] == ["b.com", "c.com"]
+    assert await search.get_similar_sites("d.com", vector_client) == []
+
+
+@pytest.mark.asyncio
+async def test_get_top_matches_authority(
+    search_vector_client, empty_postgres_client, search_resource_ids
+):
+    """
+    Tests the authority of the resources is blended into their scores.
+    """
+    await empty_postgres_client.executemany(
+        "INSERT INTO resources (id, url, firstVisited, lastVisited) VALUES ($1, $2, now(), now())",
+        [(resource_id, url) for url, resource_id in search_resource_ids.items()],
+    )
+
+    points, _ = await search_vector_client.scroll(
+        collection_name="embeddings", limit=1, with_vectors=True
+    )
+
+    class Model:
+        def encode(self, query, convert_to_numpy=True):
+            return np.array(points[0].vector)
+
+    plain = await search.get_top_matches(
+        "solar", Model(), search_vector_client, empty_postgres_client, use_cache=False
+    )
+
+    await empty_postgres_client.execute(
+        "UPDATE resources SET authority = 1 WHERE url = $1", plain[-1].url
+    )
+
+    blended = await search.get_top_matches(
+        "solar",
+        Model(),
+        search_vector_client,
+        empty_postgres_client,
+        authority_weight=1.0,
+        use_cache=False,
+    )
+
+    assert blended[0].url == plain[-1].url
+    assert blended[0].score == 2 * plain[-1].score
+
+
+@pytest.mark.asyncio
+async def test_parse_lexical_query(empty_postgres_client):
+    """
+    Tests queries parse to their stemmed lexemes, ignoring word order and
+    stop words, while phrases and exclusions keep their structure.
+    """
+    search.lexical_query_cache.clear()
+
+    async def parse(query):
+        return await search.parse_lexical_query(
+            query, empty_postgres_client, use_cache=False
+        )
+
+    assert await parse("Power of the solar panels") == (
+        "'panel' & 'power' & 'solar'"
+    )
+    assert await parse("solar panel power") == await parse("powering solar panels")
+    assert await parse('"solar power"') != await parse('"power solar"')
+    assert await parse("solar -wind") != await parse("wind -solar")
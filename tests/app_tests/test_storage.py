@@ -2,10 +2,12 @@ import pytest
 import app.core.storage as st
 import qdrant_client
 import numpy as np
-from qdrant_client.models import VectorParams, Distance
+from qdrant_client.models import VectorParams, Distance, PointStruct
 from datetime import datetime
 from app.models.data_types import CrawledUrl, PotentialUrl, SeedUrl
 from typing import List
+import asyncio
+import asyncpg
 
 
 @pytest.mark.asyncio
@@ -44,7 +46,28 @@ async def test_store_embedding():
         points[0].vector
         == (vector / np.linalg.norm(vector)).astype(np.float32).tolist()
     )
-    assert points[0].payload["text"] == metadata
+    assert points[0].payload == metadata
+
+
+@pytest.mark.asyncio
+async def test_store_embedding_failure_keeps_generation():
+    """
+    Checks a write qdrant fails doesn't change the index generation, so
+    cached search results stay valid.
+    """
+    # A client with no embeddings collection fails every write
+    client = qdrant_client.AsyncQdrantClient(":memory:")
+
+    generation = st.get_index_generation()
+
+    stored = await st.store_embedding(
+        vector=np.array([1, 2, 3, 4, 5]),
+        metadata={"test": "example meta"},
+        vector_client=client,
+    )
+
+    assert stored is False
+    assert st.get_index_generation() == generation
 
 
 @pytest.mark.asyncio
@@ -94,7 +117,7 @@ async def test_store_two_embedding(vector_client):
     idx1 = [
         idx
         for idx, point in enumerate(points)
-        if point.payload == {"text": metadata1}
+        if point.payload == metadata1
     ][0]
     idx2 = 0 if idx1 == 1 else 1
 
@@ -103,12 +126,12 @@ async def test_store_two_embedding(vector_client):
         points[idx1].vector
         == (vector1 / np.linalg.norm(vector1)).astype(np.float32).tolist()
     )
-    assert points[idx1].payload["text"] == metadata1
+    assert points[idx1].payload == metadata1
     assert (
         points[idx2].vector
         == (vector2 / np.linalg.norm(vector2)).astype(np.float32).tolist()
     )
-    assert points[idx2].payload["text"] == metadata2
+    assert points[idx2].payload == metadata2
 
 
 @pytest.mark.asyncio
@@ -323,6 +346,79 @@ async def test_add_potential_url(empty_postgres_client):
     assert results[0][3] == 2
 
 
+@pytest.mark.asyncio
+async def test_potential_url_counter(empty_postgres_client):
+    """
+    Checks the potential url counter counts sightings in memory and
+    adds them to the stored counts in one batch on flush.
+    """
+    first_seen = datetime(2024, 1, 1)
+    later = datetime(2024, 1, 2)
+
+    counter = st.PotentialUrlCounter(
+        empty_postgres_client,
+        max_size=100,
+        flush_interval=60,
+    )
+    counter.start()
+
+    # Repeat sightings are counted without being written
+    await counter.add(["https://example.com", "https://casey.com"], first_seen)
+    await counter.add(["https://example.com", "not a url"], later)
+
+    results = await empty_postgres_client.fetch("SELECT * FROM potential_urls")
+    assert len(results) == 0
+
+    assert await counter.flush()
+
+    results = await empty_postgres_client.fetch(
+        "SELECT url, firstSeen, timesSeen FROM potential_urls ORDER BY url"
+    )
+    assert [tuple(result) for result in results] == [
+        ("https://casey.com", first_seen, 1),
+        ("https://example.com", first_seen, 2),
+    ]
+
+    # Later flushes add to the stored counts, keeping the first sighting
+    await counter.add(["https://example.com"], later)
+    assert await counter.close()
+
+    result = await empty_postgres_client.fetchrow(
+        "SELECT firstSeen, timesSeen FROM potential_urls WHERE url = $1",
+        "https://example.com",
+    )
+    assert tuple(result) == (first_seen, 3)
+
+
+@pytest.mark.asyncio
+async def test_potential_url_counter_bad_row(empty_postgres_client):
+    """
+    Checks urls too long to store are skipped, and a url postgres
+    rejects is dropped without holding up the urls counted with it.
+    """
+    the_time = datetime(2024, 1, 1)
+
+    counter = st.PotentialUrlCounter(empty_postgres_client, flush_interval=60)
+
+    long_url = "https://example.com/" + "a" * 2048
+    bad_url = "https://example.com/\x00"
+    urls = ["https://example.com/page1", "https://example.com/page2"]
+
+    await counter.add([long_url, bad_url] + urls, the_time)
+
+    assert not await counter.flush()
+
+    results = await empty_postgres_client.fetch("SELECT url FROM potential_urls")
+    assert sorted(result[0] for result in results) == urls
+
+    # Nothing is left to retry, so later flushes succeed
+    await counter.add(["https://example.com/page3"], the_time)
+    assert await counter.close()
+
+    results = await empty_postgres_client.fetch("SELECT url FROM potential_urls")
+    assert len(results) == 3
+
+
 @pytest.mark.asyncio
 async def test_get_potential_urls(empty_postgres_client):
     """
@@ -350,3 +446,729 @@ async def test_get_potential_urls(empty_postgres_client):
         assert result.url in urls_to_add[idx]
         assert result.firstSeen is not None
         assert result.timesSeen == 1
+
+
+@pytest.mark.asyncio
+async def test_concurrent_queries_with_pool(postgres_pool):
+    """
+    Checks the storage functions can share a connection pool and run
+    their queries at the same time without clashing.
+    """
+    the_time = datetime.now()
+
+    urls_to_add = [f"https://example.com/page{idx}" for idx in range(10)]
+
+    resources = [
+        st.Resource(
+            url=url,
+            firstVisited=the_time,
+            lastVisited=the_time,
+            allVisits=1,
+            externalLinks=[],
+        )
+        for url in urls_to_add
+    ]
+
+    # Log all the resources and read them back at the same time
+    results = await asyncio.gather(
+        *[st.log_resource(resource, postgres_pool) for resource in resources],
+        st.get_crawled_urls(postgres_pool),
+    )
+
+    assert all(results[:-1])
+
+    # Check every resource made it into the database
+    crawled_urls = await st.get_crawled_urls(postgres_pool)
+
+    assert {url.url for url in crawled_urls} == set(urls_to_add)
+
+
+@pytest.mark.asyncio
+async def test_acquire_connection(postgres_pool, empty_postgres_client):
+    """
+    Checks acquire_connection lends a connection from a pool and passes
+    a plain connection straight through.
+    """
+    async with st.acquire_connection(postgres_pool) as connection:
+        assert isinstance(connection, asyncpg.pool.PoolConnectionProxy)
+        assert await connection.fetchval("SELECT 1") == 1
+
+    async with st.acquire_connection(empty_postgres_client) as connection:
+        assert connection is empty_postgres_client
+
+
+@pytest.mark.asyncio
+async def test_resource_writer(empty_postgres_client):
+    """
+    Checks the resource writer buffers resources and writes them in a
+    batch once the buffer is full, and flushes the remainder on close.
+    """
+    the_time = datetime.now()
+
+    writer = st.ResourceWriter(
+        empty_postgres_client,
+        max_size=2,
+        flush_interval=60,
+    )
+    writer.start()
+
+    resources = [
+        st.Resource(
+            url=f"https://example.com/page{idx}",
+            firstVisited=the_time,
+            lastVisited=the_time,
+            allVisits=1,
+            externalLinks=[],
+        )
+        for idx in range(3)
+    ]
+
+    # Nothing is written until the buffer fills
+    await writer.add(resources[0])
+
+    results = await empty_postgres_client.fetch("SELECT * FROM resources")
+    assert len(results) == 0
+
+    # A full buffer is written in one go
+    await writer.add(resources[1])
+
+    results = await empty_postgres_client.fetch("SELECT * FROM resources")
+    assert len(results) == 2
+
+    # Closing the writer flushes what's left
+    await writer.add(resources[2])
+    assert await writer.close()
+
+    results = await empty_postgres_client.fetch("SELECT * FROM resources")
+    assert [result[1] for result in results] == [r.url for r in resources]
+
+
+@pytest.mark.asyncio
+async def test_resource_writer_bad_row(empty_postgres_client):
+    """
+    Checks a resource postgres rejects, like a url too long for its
+    column, is dropped without holding up the resources after it.
+    """
+    the_time = datetime.now()
+
+    writer = st.ResourceWriter(empty_postgres_client, flush_interval=60)
+
+    long_url = "https://example.com/" + "a" * 2048
+    urls = [long_url, "https://example.com/page1", "https://example.com/page2"]
+
+    for url in urls:
+        await writer.add(st.Resource(url, the_time, the_time, 1, []))
+
+    assert not await writer.flush()
+    assert writer.dropped_urls == {long_url}
+
+    results = await empty_postgres_client.fetch("SELECT url FROM resources")
+    assert sorted(result[0] for result in results) == urls[1:]
+
+    # Nothing is left to retry, so later flushes succeed
+    await writer.add(
+        st.Resource("https://example.com/page3", the_time, the_time, 1, [])
+    )
+    assert await writer.close()
+
+    results = await empty_postgres_client.fetch("SELECT url FROM resources")
+    assert len(results) == 3
+
+
+@pytest.mark.asyncio
+async def test_resource_writer_flush_interval(empty_postgres_client):
+    """
+    Checks the resource writer flushes buffered resources once the
+    flush interval has passed.
+    """
+    writer = st.ResourceWriter(
+        empty_postgres_client,
+        max_size=100,
+        flush_interval=0.1,
+    )
+    writer.start()
+
+    await writer.add(
+        st.Resource(
+            url="https://example.com",
+            firstVisited=datetime.now(),
+            lastVisited=datetime.now(),
+            allVisits=1,
+            externalLinks=[],
+        )
+    )
+
+    await asyncio.sleep(0.3)
+
+    results = await empty_postgres_client.fetch("SELECT * FROM resources")
+    assert len(results) == 1
+
+    await writer.close()
+
+
+@pytest.mark.asyncio
+async def test_log_resource_revisit(empty_postgres_client):
+    """
+    Checks logging a resource that's already stored updates its row
+    instead of adding a new one.
+    """
+    first_time = datetime(2024, 1, 1)
+    second_time = datetime(2024, 1, 2)
+
+    # Log the resource for the first time
+    assert await st.log_resource(
+        st.Resource(
+            url="https://example.com",
+            firstVisited=first_time,
+            lastVisited=first_time,
+            allVisits=1,
+            externalLinks=[],
+        ),
+        empty_postgres_client,
+    )
+
+    # Then revisit it
+    assert await st.log_resource(
+        st.Resource(
+            url="https://example.com",
+            firstVisited=second_time,
+            lastVisited=second_time,
+            allVisits=1,
+            externalLinks=["https://snowchild.com"],
+        ),
+        empty_postgres_client,
+    )
+
+    results = await empty_postgres_client.fetch("SELECT * FROM resources")
+
+    # Check there's still one row with updated visit details
+    assert len(results) == 1
+    assert results[0][1] == "https://example.com"
+    assert results[0][2] == first_time
+    assert results[0][3] == second_time
+    assert results[0][4] == 2
+    assert results[0][5] == ["https://snowchild.com"]
+
+
+@pytest.mark.asyncio
+async def test_migrate_postgres(empty_postgres_client):
+    """
+    Checks migrate_postgres merges duplicate urls in an existing
+    resources table, adds the unique url index and the chunks table.
+    """
+    # Recreate an old database without the unique url index, chunks or
+    # links
+    await empty_postgres_client.execute("DROP TABLE chunks")
+    await empty_postgres_client.execute("DROP TABLE links")
+    await empty_postgres_client.execute("ALTER TABLE resources DROP COLUMN authority")
+    await empty_postgres_client.execute(
+        "ALTER TABLE resources DROP CONSTRAINT resources_url_key"
+    )
+
+    first, last = datetime(2024, 1, 1), datetime(2024, 2, 1)
+    for visited, visits in [(first, 2), (last, 3)]:
+        await empty_postgres_client.execute(
+            "INSERT INTO resources (url, firstVisited, lastVisited, allVisits) "
+            "VALUES ($1, $2, $2, $3)",
+            "https://example.com",
+            visited,
+            visits,
+        )
+
+    # Migrate the database, twice to check it's safe to rerun
+    await st.migrate_postgres(empty_postgres_client)
+    await st.migrate_postgres(empty_postgres_client)
+
+    results = await empty_postgres_client.fetch("SELECT * FROM resources")
+
+    # The first row is kept with the visits of both
+    assert len(results) == 1
+    assert results[0][0] == 1
+    assert results[0][2] == first
+    assert results[0][3] == last
+    assert results[0][4] == 5
+
+    # Check the url index is unique
+    index = await empty_postgres_client.fetchrow(
+        "SELECT indexdef FROM pg_indexes WHERE indexname = 'resources_url_key'"
+    )
+
+    assert "UNIQUE" in index[0]
+
+    # Check the chunks and links tables were added
+    assert await empty_postgres_client.fetchval(
+        "SELECT to_regclass('chunks') IS NOT NULL"
+    )
+    assert await empty_postgres_client.fetchval(
+        "SELECT to_regclass('links') IS NOT NULL"
+    )
+
+
+@pytest.mark.asyncio
+async def test_store_embedding_replaces_page(
+    vector_client, empty_postgres_client
+):
+    """
+    Checks storing a page again overwrites its points, and deletes the
+    points of chunks the new version of the page no longer has.
+    """
+    generator = np.random.default_rng(seed=0)
+    url = "https://example.com"
+
+    # The page's resource is logged before its embeddings
+    the_time = datetime.now()
+    await st.log_resource(
+        st.Resource(url, the_time, the_time, 1, []), empty_postgres_client
+    )
+
+    # Store a page with three chunks
+    assert await st.store_embedding(
+        vector=list(generator.random((3, 384))),
+        metadata=[{"url": url}] * 3,
+        vector_client=vector_client,
+        db_client=empty_postgres_client,
+    )
+
+    # Store a shorter version of the same page
+    vectors = list(generator.random((2, 384)))
+    assert await st.store_embedding(
+        vector=vectors,
+        metadata=[{"url": url}] * 2,
+        vector_client=vector_client,
+        db_client=empty_postgres_client,
+    )
+
+    points, _ = await vector_client.scroll(
+        collection_name="embeddings", with_payload=True, with_vectors=True
+    )
+
+    # Check only the new version's points remain
+    assert len(points) == 2
+    assert {point.id for point in points} == {
+        st.point_id(url, 0),
+        st.point_id(url, 1),
+    }
+
+    for point in points:
+        idx = 0 if point.id == st.point_id(url, 0) else 1
+        vector = vectors[idx]
+        assert np.allclose(point.vector, vector / np.linalg.norm(vector))
+        assert point.payload == {"resource_id": 1, "chunk": idx}
+
+
+@pytest.mark.asyncio
+async def test_store_embedding_without_resource(vector_client, empty_postgres_client):
+    """
+    Checks a page's embeddings aren't stored if its resource hasn't
+    been logged.
+    """
+    assert not await st.store_embedding(
+        vector=np.random.rand(2, 384),
+        metadata=[{"url": "https://example.com"}] * 2,
+        vector_client=vector_client,
+        db_client=empty_postgres_client,
+    )
+
+    count = await vector_client.count("embeddings")
+    assert count.count == 0
+
+
+def test_point_id():
+    """
+    Checks point ids are stable for the same url and chunk, and differ
+    between chunks and urls.
+    """
+    assert st.point_id("https://example.com", 0) == st.point_id(
+        "https://example.com", 0
+    )
+    assert st.point_id("https://example.com", 0) != st.point_id(
+        "https://example.com", 1
+    )
+    assert st.point_id("https://example.com", 0) != st.point_id(
+        "https://snowchild.com", 0
+    )
+
+
+def test_build_batch():
+    """
+    Checks a 2D array of vectors is turned into a columnar batch with
+    one id and payload per vector, and a single vector into a batch of
+    one.
+    """
+    vectors = np.random.rand(3, 5).astype(np.float32)
+    metadata = [{"url": "https://example.com", "site": "example.com"}] * 3
+
+    batch = st.build_batch(vectors, metadata, {"https://example.com": 7})
+
+    assert batch.ids == [st.point_id("https://example.com", i) for i in range(3)]
+    assert np.allclose(batch.vectors, vectors)
+    assert batch.payloads == [
+        {"resource_id": 7, "chunk": i, "site": "example.com"} for i in range(3)
+    ]
+
+    batch = st.build_batch(vectors[0], {"test": "example meta"})
+    assert len(batch.ids) == 1
+    assert np.allclose(batch.vectors, vectors[:1])
+
+    with pytest.raises(ValueError):
+        st.build_batch(vectors, metadata[:2], {"https://example.com": 7})
+
+    # Urls must have a stored resource
+    with pytest.raises(ValueError):
+        st.build_batch(vectors, metadata)
+
+
+@pytest.mark.asyncio
+async def test_embedding_writer(vector_client, empty_postgres_client, tmp_path):
+    """
+    Checks the embedding writer batches the points of several pages
+    and sends them all to qdrant with their resource ids when it's
+    closed.
+    """
+    generator = np.random.default_rng(seed=0)
+
+    resource_writer = st.ResourceWriter(empty_postgres_client, flush_interval=60)
+    writer = st.EmbeddingWriter(
+        vector_client,
+        empty_postgres_client,
+        resource_writer=resource_writer,
+        batch_size=100,
+        flush_interval=60,
+        outbox_dir=str(tmp_path),
+    )
+    writer.start()
+
+    # Add two pages, neither fills the batch
+    the_time = datetime.now()
+    for url in ["https://example.com", "https://snowchild.com"]:
+        await resource_writer.add(st.Resource(url, the_time, the_time, 1, []))
+        await writer.add(generator.random((2, 384)), [{"url": url}] * 2)
+
+    points, _ = await vector_client.scroll(collection_name="embeddings")
+    assert len(points) == 0
+
+    # Closing sends the batch
+    assert await writer.close()
+
+    points, _ = await vector_client.scroll(
+        collection_name="embeddings", with_payload=True
+    )
+
+    # The resources were flushed first so the points carry their ids
+    resource_ids = await st.get_resource_ids(
+        ["https://example.com", "https://snowchild.com"], empty_postgres_client
+    )
+
+    assert len(points) == 4
+    assert {point.payload["resource_id"] for point in points} == set(
+        resource_ids.values()
+    )
+    assert all("url" not in point.payload for point in points)
+
+
+@pytest.mark.asyncio
+async def test_embedding_writer_outbox(tmp_path):
+    """
+    Checks a batch that fails to reach qdrant is saved to the outbox
+    and sent once qdrant is available again.
+    """
+    # A client with no embeddings collection rejects every batch
+    client = qdrant_client.AsyncQdrantClient(":memory:")
+
+    writer = st.EmbeddingWriter(
+        client,
+        batch_size=1,
+        outbox_dir=str(tmp_path),
+    )
+
+    await writer.add(np.array([1, 2, 3, 4, 5]), {"test": "example meta"})
+
+    # The failed batch ends up in the outbox
+    assert not await writer.close()
+    assert len(list(tmp_path.iterdir())) == 1
+
+    # Once the collection exists the outbox is emptied into qdrant
+    await client.create_collection(
+        collection_name="embeddings",
+        vectors_config=VectorParams(size=5, distance=Distance.COSINE),
+    )
+
+    assert await writer.retry_outbox()
+    assert len(list(tmp_path.iterdir())) == 0
+
+    points, _ = await client.scroll(collection_name="embeddings")
+    assert len(points) == 1
+
+
+@pytest.mark.asyncio
+async def test_embedding_writer_dead_letter(tmp_path):
+    """
+    Checks an outbox batch that can't be read is moved to the dead
+    letter folder without holding up the batches after it.
+    """
+    client = qdrant_client.AsyncQdrantClient(":memory:")
+
+    writer = st.EmbeddingWriter(
+        client,
+        batch_size=1,
+        outbox_dir=str(tmp_path),
+    )
+
+    # A batch truncated by a crash, older than the failed batch
+    (tmp_path / "truncated.joblib").write_bytes(b"\x80\x04")
+
+    await writer.add(np.array([1, 2, 3, 4, 5]), {"test": "example meta"})
+    assert not await writer.close()
+
+    await client.create_collection(
+        collection_name="embeddings",
+        vectors_config=VectorParams(size=5, distance=Distance.COSINE),
+    )
+
+    assert await writer.retry_outbox()
+    assert [file.name for file in tmp_path.iterdir()] == ["dead_letter"]
+    assert [file.name for file in (tmp_path / "dead_letter").iterdir()] == [
+        "truncated.joblib"
+    ]
+
+    points, _ = await client.scroll(collection_name="embeddings")
+    assert len(points) == 1
+
+
+@pytest.mark.asyncio
+async def test_embedding_writer_outbox_first(tmp_path):
+    """
+    Checks batches waiting in the outbox are sent before new batches,
+    and new batches join the outbox while it can't be emptied.
+    """
+    client = qdrant_client.AsyncQdrantClient(":memory:")
+
+    writer = st.EmbeddingWriter(
+        client,
+        batch_size=1,
+        outbox_dir=str(tmp_path),
+    )
+
+    # Without a collection both batches end up in the outbox
+    await writer.add(np.array([1, 2, 3, 4, 5]), {"test": "old"})
+    await asyncio.gather(*writer._send_tasks)
+    await writer.add(np.array([5, 4, 3, 2, 1]), {"test": "new"})
+    await asyncio.gather(*writer._send_tasks)
+
+    assert len(list(tmp_path.iterdir())) == 2
+
+    await client.create_collection(
+        collection_name="embeddings",
+        vectors_config=VectorParams(size=5, distance=Distance.COSINE),
+    )
+
+    # The next batch empties the outbox before it's sent
+    await writer.add(np.array([1, 1, 1, 1, 1]), {"test": "newest"})
+    assert await writer.close()
+    assert len(list(tmp_path.iterdir())) == 0
+
+    count = await client.count("embeddings")
+    assert count.count == 3
+
+
+def test_is_rejected():
+    """
+    Checks invalid requests are recognised from both REST and gRPC
+    errors, and errors worth retrying aren't.
+    """
+    import grpc
+    import httpx
+    from qdrant_client.http.exceptions import UnexpectedResponse
+
+    def rest_error(status_code):
+        return UnexpectedResponse(status_code, "", b"", httpx.Headers())
+
+    def grpc_error(code):
+        return grpc.aio.AioRpcError(
+            code, grpc.aio.Metadata(), grpc.aio.Metadata(), details=""
+        )
+
+    assert st.is_rejected(rest_error(400))
+    assert not st.is_rejected(rest_error(404))
+    assert not st.is_rejected(rest_error(503))
+
+    assert st.is_rejected(grpc_error(grpc.StatusCode.INVALID_ARGUMENT))
+    assert st.is_rejected(grpc_error(grpc.StatusCode.FAILED_PRECONDITION))
+    assert not st.is_rejected(grpc_error(grpc.StatusCode.UNAVAILABLE))
+
+    assert not st.is_rejected(ValueError("Collection not found"))
+
+
+@pytest.mark.asyncio
+async def test_setup_collection():
+    """
+    Checks setup_collection creates the embeddings collection when it's
+    missing and migrates it when it already exists.
+    """
+    client = qdrant_client.AsyncQdrantClient(":memory:")
+
+    # Create the collection from scratch
+    assert await st.setup_collection(client, vector_size=5)
+
+    collection = await client.get_collection("embeddings")
+    assert collection.config.params.vectors.size == 5
+    assert collection.config.params.vectors.distance == Distance.COSINE
+
+    # Points stored with the legacy url payload are dropped when an
+    # existing collection is migrated
+    await client.upsert(
+        collection_name="embeddings",
+        points=[
+            PointStruct(
+                id=1,
+                vector=[1, 2, 3, 4, 5],
+                payload={"text": {"url": "https://example.com"}},
+            ),
+            PointStruct(
+                id=2,
+                vector=[1, 2, 3, 4, 5],
+                payload={"resource_id": 1, "chunk": 0},
+            ),
+        ],
+    )
+
+    # Running it again migrates rather than recreates the collection
+    assert not await st.setup_collection(client, vector_size=5)
+
+    points, _ = await client.scroll(collection_name="embeddings")
+    assert [point.id for point in points] == [2]
+
+
+def test_quantization_config():
+    """
+    Checks the quantization config is built for each quantization type
+    and unknown types are rejected.
+    """
+    scalar = st.quantization_config("scalar")
+    assert scalar.scalar.type == "int8"
+    assert scalar.scalar.always_ram
+
+    binary = st.quantization_config("binary")
+    assert binary.binary.always_ram
+
+    assert st.quantization_config("none") is None
+
+    with pytest.raises(ValueError):
+        st.quantization_config("float8")
+
+
+@pytest.mark.asyncio
+async def test_bulk_ingest(vector_client):
+    """
+    Checks bulk ingest returns the collection's indexing threshold so it
+    can be restored, and that storing embeddings in between works.
+    """
+    threshold = await st.begin_bulk_ingest(vector_client)
+    assert threshold == 20000
+
+    vectors = np.random.rand(3, 384)
+    metadata = [{"test": "example meta"}] * 3
+    await st.store_embedding(vectors, metadata, vector_client)
+
+    await st.end_bulk_ingest(vector_client, threshold)
+
+    count = await vector_client.count("embeddings")
+    assert count.count == 3
+
+
+@pytest.mark.asyncio
+async def test_log_resource_chunks(empty_postgres_client):
+    """
+    Checks a resource's chunks are written with it, and a revisit with
+    fewer chunks overwrites them and deletes the rest.
+    """
+    the_time = datetime.now()
+    resource = st.Resource(
+        "https://example.com", the_time, the_time, 1, [], ["one", "two", "three"]
+    )
+
+    assert await st.log_resource(resource, empty_postgres_client)
+
+    resource.chunks = ["uno", "dos"]
+    assert await st.log_resource(resource, empty_postgres_client)
+
+    rows = await empty_postgres_client.fetch(
+        "SELECT resource_id, chunk, content FROM chunks ORDER BY chunk"
+    )
+
+    assert [tuple(row) for row in rows] == [(1, 0, "uno"), (1, 1, "dos")]
+
+
+@pytest.mark.asyncio
+async def test_log_resource_metadata(empty_postgres_client):
+    """
+    Checks a resource's page metadata is logged and a revisit replaces
+    it.
+    """
+    the_time = datetime.now()
+    resource = st.Resource(
+        "https://example.com",
+        the_time,
+        the_time,
+        1,
+        [],
+        title="Example",
+        siteName="example.com",
+        description="An example page",
+        published=datetime(2024, 1, 2),
+        favicon="https://example.com/favicon.ico",
+    )
+
+    assert await st.log_resource(resource, empty_postgres_client)
+
+    resource.title = "Example, again"
+    assert await st.log_resource(resource, empty_postgres_client)
+
+    row = await empty_postgres_client.fetchrow(
+        "SELECT title, siteName, description, published, favicon FROM resources"
+    )
+
+    assert tuple(row) == (
+        "Example, again",
+        "example.com",
+        "An example page",
+        datetime(2024, 1, 2),
+        "https://example.com/favicon.ico",
+    )
+
+
+@pytest.mark.asyncio
+async def test_rebuild_links(empty_postgres_client):
+    """
+    Checks the links table holds the links between crawled pages, and
+    that rebuilding it drops links that are gone.
+    """
+    the_time = datetime.now()
+    pages = {
+        "https://a.com": ["https://b.com", "https://c.com", "https://elsewhere.com"],
+        "https://b.com": ["https://a.com", "https://b.com"],
+        "https://c.com": [],
+    }
+
+    for url, links in pages.items():
+        await st.log_resource(
+            st.Resource(url, the_time, the_time, 1, links), empty_postgres_client
+        )
+
+    assert await st.rebuild_links(empty_postgres_client)
+
+    rows = await empty_postgres_client.fetch(
+        "SELECT source_id, target_id FROM links ORDER BY source_id, target_id"
+    )
+    assert [tuple(row) for row in rows] == [(1, 2), (1, 3), (2, 1)]
+
+    await st.log_resource(
+        st.Resource("https://b.com", the_time, the_time, 1, []),
+        empty_postgres_client,
+    )
+    assert await st.rebuild_links(empty_postgres_client)
+
+    rows = await empty_postgres_client.fetch(
+        "SELECT source_id, target_id FROM links ORDER BY source_id, target_id"
+    )
+    assert [tuple(row) for row in rows] == [(1, 2), (1, 3)]